@@ -0,0 +1,175 @@
+"""
+Load harness for the upload endpoints: sends concurrent uploads to the sync
+view through the WSGI handler, one thread per client, and to the async view
+through the ASGI handler, one task per client, reporting throughput,
+latency and the status codes returned.
+
+    python benchmarks/bench_async_upload.py [concurrent uploads]
+
+Runs in process against a fresh SQLite database in a temporary directory,
+so no server is needed. The async view answers 429 once
+EXIF_IMAGE_ASYNC_UPLOAD_LIMIT uploads are in flight, where the sync view
+holds a thread for every waiting client; the harness retries those uploads
+after the time the response asks for.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testsite.settings.dev")
+
+from django.conf import settings  # noqa: E402
+
+directory = tempfile.TemporaryDirectory()
+settings.DATABASES["default"] = {
+    "ENGINE": "django.db.backends.sqlite3",
+    "NAME": os.path.join(directory.name, "db.sqlite3"),
+    "OPTIONS": {"timeout": 60},
+}
+settings.MEDIA_ROOT = directory.name
+settings.ALLOWED_HOSTS = ["*"]
+
+import django  # noqa: E402
+
+django.setup()
+
+# Every 429 would be logged as a warning.
+logging.disable(logging.WARNING)
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core.asgi import get_asgi_application  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from django.test.client import BOUNDARY, MULTIPART_CONTENT  # noqa: E402
+from django.test.client import encode_multipart  # noqa: E402
+
+from wagtail_exifimage.models import ImageUploadAccessKey  # noqa: E402
+from wagtail_exifimage.tests import make_jpeg  # noqa: E402
+
+
+def make_body(key, number):
+    data = make_jpeg(iptc=((25, f"Load {number}"), (15, "Load/Test")))
+    post = {"upload_key": key, "collections": "Load/Test"}
+    post["file"] = io.BytesIO(data)
+    post["file"].name = f"load-{number}.jpg"
+    return encode_multipart(BOUNDARY, post)
+
+
+def call_wsgi(application, path, body):
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": path,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "CONTENT_TYPE": MULTIPART_CONTENT,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.url_scheme": "http",
+    }
+    status = []
+    start = time.perf_counter()
+    b"".join(application(environ, lambda s, headers: status.append(s)))
+    return int(status[0].split()[0]), time.perf_counter() - start
+
+
+async def call_asgi(application, path, body):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "server": ("localhost", 80),
+        "headers": [
+            (b"content-type", MULTIPART_CONTENT.encode()),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    status = []
+    retry_after = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+            retry_after.extend(
+                int(value)
+                for name, value in message["headers"]
+                if name.lower() == b"retry-after"
+            )
+
+    await application(scope, receive, send)
+    return status[0], retry_after[0] if retry_after else None
+
+
+async def upload_asgi(application, path, body):
+    """Uploads like a client honouring Retry-After would."""
+    start = time.perf_counter()
+    while True:
+        status, retry_after = await call_asgi(application, path, body)
+        if status != 429:
+            return status, time.perf_counter() - start
+        await asyncio.sleep(retry_after)
+
+
+def report(name, results, elapsed):
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{name:<6} {len(results) / elapsed:>9.1f} "
+        f"{statistics.median(latencies) * 1000:>9.0f} {p95 * 1000:>9.0f}  "
+        + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+    )
+
+
+def main(count):
+    call_command("migrate", verbosity=0)
+    user = get_user_model().objects.create(username="load")
+    key = ImageUploadAccessKey.get_key(user.username)
+    bodies = [make_body(key, number) for number in range(count)]
+
+    print(f"{count} concurrent uploads")
+    print(f"{'':<6} {'uploads/s':>9} {'p50 ms':>9} {'p95 ms':>9}  statuses")
+
+    wsgi = get_wsgi_application()
+    with ThreadPoolExecutor(count) as executor:
+        start = time.perf_counter()
+        results = list(
+            executor.map(
+                lambda body: call_wsgi(wsgi, "/exif-image/upload/", body), bodies
+            )
+        )
+        report("sync", results, time.perf_counter() - start)
+
+    asgi = get_asgi_application()
+
+    async def run_asgi():
+        return await asyncio.gather(
+            *(upload_asgi(asgi, "/exif-image/async-upload/", body) for body in bodies)
+        )
+
+    start = time.perf_counter()
+    results = asyncio.run(run_asgi())
+    report("async", results, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
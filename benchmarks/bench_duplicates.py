@@ -0,0 +1,87 @@
+"""
+Measures near-duplicate lookups among stored perceptual hashes, comparing a
+linear scan of every hash with the multi-index hash, and the cost of
+hashing an image.
+
+    python benchmarks/bench_duplicates.py [stored hashes]
+"""
+
+import io
+import os
+import sys
+import time
+from random import Random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from wagtail_exifimage.duplicates import (  # noqa: E402
+    DEFAULT_MAX_DISTANCE,
+    MultiIndexHash,
+    hamming_distance,
+    perceptual_hash,
+)
+
+QUERIES = 200
+
+
+def make_hashes(count, random):
+    # A photo archive holds bursts and edits of the same shot, a few bits
+    # apart, among unrelated pictures.
+    hashes = []
+    while len(hashes) < count:
+        value = random.getrandbits(64)
+        hashes.append(value)
+        for _ in range(random.randrange(4)):
+            hashes.append(value ^ (1 << random.randrange(64)))
+    return hashes[:count]
+
+
+def linear_scan(hashes, query, max_distance):
+    return sorted(
+        (distance, item)
+        for item, value in enumerate(hashes)
+        if (distance := hamming_distance(query, value)) <= max_distance
+    )
+
+
+def main(count):
+    random = Random(18)
+    hashes = make_hashes(count, random)
+    queries = [value ^ (1 << random.randrange(64)) for value in hashes[:QUERIES]]
+
+    start = time.perf_counter()
+    index = MultiIndexHash()
+    for item, value in enumerate(hashes):
+        index.add(value, item)
+    build = time.perf_counter() - start
+
+    print(f"{count} stored hashes, {QUERIES} queries within {DEFAULT_MAX_DISTANCE}")
+    print(f"{'':<12} {'ms per query':>12}")
+    start = time.perf_counter()
+    expected = [linear_scan(hashes, query, DEFAULT_MAX_DISTANCE) for query in queries]
+    print(
+        f"{'linear scan':<12} {(time.perf_counter() - start) / QUERIES * 1000:>12.3f}"
+    )
+
+    start = time.perf_counter()
+    found = [sorted(index.search(query, DEFAULT_MAX_DISTANCE)) for query in queries]
+    print(
+        f"{'multi-index':<12} {(time.perf_counter() - start) / QUERIES * 1000:>12.3f}"
+    )
+    assert found == expected
+    print(f"Multi-index built in {build:.2f} s")
+
+    output = io.BytesIO()
+    Image.effect_mandelbrot((6000, 4000), (-2.0, -1.5, 1.0, 1.5), 64).convert(
+        "RGB"
+    ).save(output, "JPEG")
+    start = time.perf_counter()
+    for _ in range(10):
+        perceptual_hash(output)
+    print(f"Hashing a 24 MP JPEG: {(time.perf_counter() - start) / 10 * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,131 @@
+"""
+Compares the single-pass metadata extractor against the previous
+exifread + IPTCInfo path, reporting bytes read, file opens and time per file.
+
+    python benchmarks/bench_extraction.py [image.jpg ...]
+
+Without arguments a large sample JPEG with EXIF and IPTC data is generated.
+"""
+
+import builtins
+import io
+import os
+import struct
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exifread  # noqa: E402
+from iptcinfo3 import IPTCInfo  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from wagtail_exifimage.utils import (  # noqa: E402
+    get_basic_exif_data,
+    get_exif_tags,
+    get_iptc_fields,
+)
+
+ROUNDS = 20
+
+
+def two_pass_exif_data(filename):
+    """The extraction path used before the single-pass extractor."""
+    with open(filename, "rb") as fh:
+        result = get_exif_tags(exifread.process_file(fh), filename)
+    result.update(get_iptc_fields(IPTCInfo(filename)))
+    return result
+
+
+class CountingFile(io.FileIO):
+    bytes_read = 0
+    opens = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        CountingFile.opens += 1
+
+    def read(self, size=-1):
+        data = super().read(size)
+        CountingFile.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        count = super().readinto(buffer)
+        CountingFile.bytes_read += count or 0
+        return count
+
+
+def counting_open(filename, mode="r", *args, **kwargs):
+    if mode == "rb" and not args and not kwargs:
+        return io.BufferedReader(CountingFile(filename, "rb"), buffer_size=4096)
+    return real_open(filename, mode, *args, **kwargs)
+
+
+real_open = builtins.open
+
+
+def measure(extract, filename):
+    CountingFile.bytes_read = CountingFile.opens = 0
+    with mock.patch("builtins.open", counting_open):
+        result = extract(filename)
+    bytes_read, opens = CountingFile.bytes_read, CountingFile.opens
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        extract(filename)
+    elapsed = (time.perf_counter() - start) / ROUNDS
+    return result, bytes_read, opens, elapsed
+
+
+def make_sample(directory):
+    iim = b""
+    for dataset, value in [(105, b"Headline"), (15, b"2023/Norway")] + [
+        (25, b"keyword %d" % i) for i in range(40)
+    ]:
+        iim += struct.pack("!BBBH", 0x1C, 2, dataset, len(value)) + value
+    payload = (
+        b"Photoshop 3.0\x008BIM\x04\x04\x00\x00" + struct.pack("!I", len(iim)) + iim
+    )
+
+    exif = Image.Exif()
+    exif[0x010F] = "SONY"
+    exif[0x0110] = "ILCE-7M3"
+    exif[0x8769] = {0x9003: "2023:04:24 16:00:00", 0x8827: 400}
+
+    output = io.BytesIO()
+    Image.frombytes("RGB", (3000, 2000), os.urandom(3000 * 2000 * 3)).save(
+        output, "JPEG", exif=exif, quality=95
+    )
+    data = output.getvalue()
+    segment = bytes([0xFF, 0xED]) + struct.pack("!H", len(payload) + 2) + payload
+    filename = os.path.join(directory, "sample.jpg")
+    with open(filename, "wb") as fh:
+        fh.write(data[:2] + segment + data[2:])
+    return filename
+
+
+def main(filenames):
+    print(f"{'file':<30} {'path':<12} {'opens':>5} {'bytes read':>12} {'ms/file':>9}")
+    for filename in filenames:
+        name = os.path.basename(filename)[:30]
+        old, old_bytes, old_opens, old_time = measure(two_pass_exif_data, filename)
+        new, new_bytes, new_opens, new_time = measure(get_basic_exif_data, filename)
+        print(
+            f"{name:<30} {'two-pass':<12} {old_opens:>5} {old_bytes:>12} {old_time * 1000:>9.3f}"
+        )
+        print(
+            f"{name:<30} {'single-pass':<12} {new_opens:>5} {new_bytes:>12} {new_time * 1000:>9.3f}"
+        )
+        if old != new:
+            print(f"  WARNING: results differ for {filename}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            main([make_sample(directory)])
@@ -0,0 +1,91 @@
+"""
+Measures tag assignment for keyword-heavy images, comparing one
+image.tags.add() call per tag with the bulk add_tags, in queries and time.
+
+    python benchmarks/bench_tags.py [keywords per image]
+
+Runs against a fresh in-memory SQLite database.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testsite.settings.dev")
+
+from django.conf import settings  # noqa: E402
+
+settings.DATABASES["default"] = {
+    "ENGINE": "django.db.backends.sqlite3",
+    "NAME": ":memory:",
+}
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.db import connection  # noqa: E402
+
+from wagtail_exifimage.models import AdvancedIPTCExifImage  # noqa: E402
+from wagtail_exifimage.tags import add_tags, tag_resolver  # noqa: E402
+
+IMAGES = 50
+
+
+def create_images(prefix):
+    return [
+        AdvancedIPTCExifImage.objects.create(
+            title=f"{prefix} {i}",
+            file=f"{prefix}-{i}.jpg",
+            width=64,
+            height=48,
+            has_processed_metadata=True,
+        )
+        for i in range(IMAGES)
+    ]
+
+
+def per_tag(image, keywords):
+    for keyword in keywords:
+        image.tags.add(keyword)
+
+
+def cold_add_tags(image, keywords):
+    tag_resolver.clear()
+    add_tags(image, keywords)
+
+
+def run(name, function, images, keywords):
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        start = time.perf_counter()
+        for image in images:
+            function(image, keywords)
+        elapsed = time.perf_counter() - start
+    print(f"{name:<16} {queries / IMAGES:>9.1f} {elapsed / IMAGES * 1000:>12.2f}")
+
+
+def main(count):
+    call_command("migrate", verbosity=0)
+    keywords = [f"Keyword {i}" for i in range(count)]
+    # The first image creates the tags, the rest reuse them.
+    per_tag(create_images("warmup")[0], keywords)
+
+    print(f"{count} keywords, {IMAGES} images")
+    print(f"{'':<16} {'queries':>9} {'ms per image':>12}")
+    run("tags.add per tag", per_tag, create_images("per-tag"), keywords)
+    run("add_tags", add_tags, create_images("bulk"), keywords)
+    tag_resolver.clear()
+    run("add_tags, cold", cold_add_tags, create_images("cold"), keywords)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 40)
@@ -0,0 +1,92 @@
+"""
+Measures transform_metadata against 10,000 transformation rules, comparing
+the previous nested scan over fields, rules and keywords with the compiled
+lookup table.
+
+    python benchmarks/bench_transform_rules.py [rules]
+
+Rules are built in memory, so no database is needed.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testsite.settings.dev")
+
+import django  # noqa: E402
+
+django.setup()
+
+from wagtail_exifimage.services import (  # noqa: E402
+    TransformationRules,
+    TransformationValue,
+)
+
+ROUNDS = 200
+FIELDS = ["camera_make", "camera_model", "lens_model", "location", "city"]
+
+
+def make_rules(count):
+    rules = {}
+    for i in range(count):
+        field = FIELDS[i % len(FIELDS)]
+        rules.setdefault(field, []).append(
+            TransformationValue(
+                source_field=field,
+                keywords=[f"value {i}", f"alias {i}", f"other {i}"],
+                target_value=f"Target {i}",
+                target_field=field,
+            )
+        )
+    return rules
+
+
+def scan(transformation_values, metadata):
+    """The transform_metadata loop before the rules were compiled."""
+    result = dict(metadata)
+    for t_field, t_values in transformation_values.items():
+        for transformation in t_values:
+            for field in metadata.keys():
+                if field == t_field:
+                    if metadata[field].lower() in transformation.keywords:
+                        result[transformation.target_field] = (
+                            transformation.target_value
+                        )
+    return result
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        result = function(*args)
+    return (time.perf_counter() - start) / ROUNDS, result
+
+
+def main(count):
+    transformation_values = make_rules(count)
+    metadata = {field: f"Value {count - 1 - i}" for i, field in enumerate(FIELDS)}
+    metadata.update(title="Sunset", caption="Somewhere", keywords="Norway")
+
+    start = time.perf_counter()
+    rules = TransformationRules(
+        transformation
+        for transformations in transformation_values.values()
+        for transformation in transformations
+    )
+    compile_time = time.perf_counter() - start
+
+    scanned, expected = timed(scan, transformation_values, metadata)
+    compiled, result = timed(rules.apply, metadata)
+    assert result == expected
+
+    print(f"rules: {count}, lookup keys: {len(rules)}")
+    print(f"compile once:  {compile_time * 1000:>9.3f} ms")
+    print(f"nested scan:   {scanned * 1000:>9.3f} ms per image")
+    print(f"compiled:      {compiled * 1000:>9.3f} ms per image")
+    print(f"speedup:       {scanned / compiled:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
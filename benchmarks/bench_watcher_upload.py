@@ -0,0 +1,121 @@
+"""
+Compares the watcher's two upload modes against a local stand-in for the
+upload endpoint: a pool of threads posting through the pooled requests
+session, and an event loop posting through the aiohttp uploader.
+
+    python benchmarks/bench_watcher_upload.py [files] [latency ms] [concurrency]
+
+The stand-in server reads each upload and answers it after the given
+latency, as a distant server would. Both modes upload the same files with
+the same number of uploads in flight, reporting files per second.
+"""
+
+import asyncio
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wagtail_exifimage.bin.async_upload import AsyncUploader  # noqa: E402
+from wagtail_exifimage.bin.http_client import make_session, upload_timeout  # noqa: E402
+
+FILE_SIZE = 512 * 1024
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        time.sleep(self.server.latency)
+        body = b'{"id": 1}'
+        self.send_response(201)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def upload_with_threads(url, filenames, concurrency):
+    session = make_session(pool_size=concurrency)
+
+    def upload(filename):
+        with open(filename, "rb") as f:
+            return session.post(
+                url,
+                data={"collections": "Bench"},
+                files={"file": f},
+                timeout=upload_timeout(FILE_SIZE),
+            ).status_code
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        statuses = list(executor.map(upload, filenames))
+    session.close()
+    return statuses
+
+
+def upload_with_event_loop(url, filenames, concurrency):
+    async def run():
+        async with AsyncUploader(concurrency) as uploader:
+            results = await asyncio.gather(
+                *(
+                    uploader.upload(url, filename, {"collections": "Bench"})
+                    for filename in filenames
+                )
+            )
+        return [status for status, _ in results]
+
+    return asyncio.run(run())
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+
+    server = StandInServer(("127.0.0.1", 0), StandInHandler)
+    server.latency = latency / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/exif-image/upload/"
+
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = []
+        for number in range(count):
+            filename = os.path.join(directory, f"{number}.jpg")
+            with open(filename, "wb") as f:
+                f.write(os.urandom(FILE_SIZE))
+            filenames.append(filename)
+
+        print(
+            f"{count} files of {FILE_SIZE // 1024} KiB, {latency} ms latency, "
+            f"{concurrency} in flight"
+        )
+        for name, upload in (
+            ("threads", upload_with_threads),
+            ("asyncio", upload_with_event_loop),
+        ):
+            started = time.perf_counter()
+            statuses = upload(url, filenames, concurrency)
+            elapsed = time.perf_counter() - started
+            assert statuses == [201] * count, set(statuses)
+            print(f"{name:>8}: {count / elapsed:8.1f} files/s")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
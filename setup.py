@@ -17,7 +17,9 @@ setup(
         "wagtail",
         "django-click",
         "python-dotenv",
+        "numpy",
     ],
+    extras_require={"async": ["aiohttp>=3.10"]},
     packages=find_packages(),  # ["wagtail_exifimage"],
     include_package_data=True,
     entry_points={
@@ -3,7 +3,9 @@ from django.contrib import admin
 from .models import (
     AdvancedIPTCExifImage,
     BasicExifImage,
+    ChunkedUpload,
     ImageUploadAccessKey,
+    MetadataJob,
     MetadataDefaultValue,
     MetadataTransformationSetup,
     MetadataTransformationValue,
@@ -59,3 +61,14 @@ class MetadataTransformationSetupAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change):
         obj.user = request.user
         super().save_model(request, obj, form, change)
+
+
+@admin.register(MetadataJob)
+class MetadataJobAdmin(admin.ModelAdmin):
+    list_display = ["user", "filename", "status", "attempts", "created_at"]
+    list_filter = ["status"]
+
+
+@admin.register(ChunkedUpload)
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = ["user", "filename", "offset", "size", "updated_at"]
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+from concurrent.futures import Future
+from typing import Iterable, Set, Tuple
+
+import aiohttp
+
+from wagtail_exifimage.bin.http_client import (
+    DEFAULT_BACKOFF,
+    DEFAULT_RETRIES,
+    MAX_BACKOFF,
+    RETRY_STATUSES,
+    upload_timeout,
+)
+from wagtail_exifimage.bin.known_digests import DEFAULT_TIMEOUT
+
+DEFAULT_CONCURRENCY = 32
+RETRY_AFTER_STATUSES = (429, 503)
+
+logger = logging.getLogger(__name__)
+
+
+def form_fields(metadata: dict):
+    """Yields the form fields for metadata, the way requests encodes them."""
+    for name, value in metadata.items():
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            yield name, str(item)
+
+
+class AsyncUploader:
+    """
+    Uploads files with aiohttp, at most concurrency at a time over as many
+    kept-alive connections. File bodies are streamed from disk.
+
+    Like the session of make_session, requests failing to connect or
+    answered with 429 or a 5xx status are sent again up to retries times,
+    after an exponential backoff with jitter or the delay asked for with
+    Retry-After, and the last response is returned once the retries are
+    used up. Requests sent but left unanswered are not sent again. Create
+    it in a coroutine, and use it as an async context manager or call close.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self._session.close()
+
+    def _delay(self, attempt: int, response=None) -> float:
+        if response is not None and response.status in RETRY_AFTER_STATUSES:
+            try:
+                return min(float(response.headers["Retry-After"]), MAX_BACKOFF)
+            except (KeyError, ValueError):
+                pass
+        delay = self.backoff * 2**attempt + random.uniform(0, self.backoff)
+        return min(delay, MAX_BACKOFF)
+
+    async def _request(self, method: str, url: str, make_body, **kwargs):
+        """
+        Sends a request, building its body afresh for each attempt with
+        make_body, and returns its (status, text).
+        """
+        attempt = 0
+        while True:
+            try:
+                async with self._session.request(
+                    method, url, data=make_body(), **kwargs
+                ) as response:
+                    text = await response.text()
+                    if response.status not in RETRY_STATUSES or attempt == self.retries:
+                        return response.status, text
+                    delay = self._delay(attempt, response)
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as ex:
+                # Raised before anything was sent, unlike a read timeout or
+                # a dropped connection after which the server may have
+                # stored the upload.
+                if attempt == self.retries:
+                    raise
+                logger.debug(f"Retrying {url} after {ex!r}")
+                delay = self._delay(attempt)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def known_digests(
+        self, url: str, upload_key: str, digests: Iterable[str]
+    ) -> Set[str]:
+        """
+        Returns the digests the server already has an image for, like
+        find_known_digests.
+        """
+        body = json.dumps({"digests": list(digests)})
+        async with self._semaphore:
+            status, text = await self._request(
+                "POST",
+                url,
+                lambda: body,
+                headers={
+                    "X-Upload-Key": upload_key,
+                    "Content-Type": "application/json",
+                },
+                timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT),
+            )
+        if status != 200:
+            raise aiohttp.ClientError(f"Checking digests failed: {status}")
+        return set(json.loads(text)["known"])
+
+    async def upload(self, url: str, filename: str, metadata: dict) -> Tuple[int, str]:
+        """
+        Posts a file and its metadata to the upload endpoint at url and
+        returns the (status, text) of the response.
+        """
+        connect, read = upload_timeout(os.path.getsize(filename))
+        # aiohttp closes a file once it is sent, so each attempt opens it.
+        files = []
+
+        def make_body():
+            files.append(open(filename, "rb"))
+            form = aiohttp.FormData()
+            for name, value in form_fields(metadata):
+                form.add_field(name, value)
+            form.add_field("file", files[-1], filename=os.path.basename(filename))
+            return form
+
+        async with self._semaphore:
+            try:
+                return await self._request(
+                    "POST",
+                    url,
+                    make_body,
+                    timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+                )
+            finally:
+                for f in files:
+                    f.close()
+
+
+class EventLoopThread:
+    """
+    Runs coroutines on an event loop in a thread of its own, for callers in
+    other threads. call schedules a coroutine without waiting for it, but
+    blocks while concurrency of them are running, so a caller filling it
+    faster than it uploads is held back. The caller handles the outcome
+    through the future call returns.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY):
+        self.loop = asyncio.new_event_loop()
+        self._concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine):
+        """Runs a coroutine on the loop and returns its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def call(self, coroutine_function, *args) -> Future:
+        """
+        Schedules coroutine_function(*args) and returns the future of its
+        result, once fewer than concurrency coroutines are running.
+        """
+        self._slots.acquire()
+        future = asyncio.run_coroutine_threadsafe(coroutine_function(*args), self.loop)
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def stop(self, final=None):
+        """
+        Waits for the running coroutines and then for the final one, if
+        given, before stopping the loop.
+        """
+        for _ in range(self._concurrency):
+            self._slots.acquire()
+        if final is not None:
+            self.run(final)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
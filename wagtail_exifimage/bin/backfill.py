@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, List, Optional, Tuple
+
+DEFAULT_WORKERS = 8
+DEFAULT_RATE = 50
+# Files the backfill leaves waiting in the pipeline at most, so that live
+# events never queue behind more than these.
+DEFAULT_MAX_BACKLOG = 16
+BACKLOG_POLL_INTERVAL = 0.1
+PROGRESS_INTERVAL = 10
+
+logger = logging.getLogger(__name__)
+
+
+def scan_directory(path: str, suffixes: Tuple[str, ...]):
+    """
+    Returns the (path, size, mtime_ns) of the files in a directory ending in
+    one of suffixes, and its subdirectories. Symbolic links to directories
+    are not followed.
+    """
+    files = []
+    directories = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.lower().endswith(suffixes) and entry.is_file():
+                        st = entry.stat()
+                        files.append((entry.path, st.st_size, st.st_mtime_ns))
+                except OSError as ex:
+                    logger.warning(f"Could not read {entry.path}: {ex}")
+    except OSError as ex:
+        logger.warning(f"Could not scan {path}: {ex}")
+    return files, directories
+
+
+def walk(
+    root: str, suffixes: Tuple[str, ...], workers: int = DEFAULT_WORKERS
+) -> Iterator[List[Tuple[str, int, int]]]:
+    """
+    Walks the tree below root scanning up to workers directories at a time,
+    and yields the matching files of each directory as it is scanned. Only
+    a few directories are scanned ahead of the caller, so a slow caller does
+    not hold the files of the whole tree in memory.
+    """
+    executor = ThreadPoolExecutor(workers)
+    directories = [root]
+    pending = set()
+    try:
+        while directories or pending:
+            while directories and len(pending) < workers * 2:
+                pending.add(
+                    executor.submit(scan_directory, directories.pop(), suffixes)
+                )
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                directories.extend(subdirectories)
+                yield files
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+class RateLimiter:
+    """
+    Spaces calls to wait at least 1 / rate seconds apart; a rate of 0 does
+    not limit them.
+    """
+
+    def __init__(self, rate: float, stopped: threading.Event = None):
+        self.interval = 1 / rate if rate else 0
+        self.stopped = stopped or threading.Event()
+        self._next = time.monotonic()
+
+    def wait(self) -> bool:
+        """Waits for the next slot; returns False when stopped meanwhile."""
+        now = time.monotonic()
+        if self._next > now and self.stopped.wait(self._next - now):
+            return False
+        self._next = max(self._next, now) + self.interval
+        return not self.stopped.is_set()
+
+
+@dataclass
+class BackfillProgress:
+    directories: int = 0
+    files: int = 0
+    queued: int = 0
+    started: float = field(default_factory=time.monotonic)
+    reported: float = field(default_factory=time.monotonic)
+
+    def report_when_due(self):
+        if time.monotonic() - self.reported >= PROGRESS_INTERVAL:
+            self.reported = time.monotonic()
+            logger.info(f"Backfill: {self}")
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.started
+        return (
+            f"{self.directories} folders and {self.files} files scanned, "
+            f"{self.queued} new or changed files queued in {elapsed:.0f}s "
+            f"({self.files / max(elapsed, 0.001):.0f} files/s)"
+        )
+
+
+def backfill(
+    root: str,
+    suffixes: Tuple[str, ...],
+    ledger,
+    submit: Callable[[str], None],
+    rate: float = DEFAULT_RATE,
+    workers: int = DEFAULT_WORKERS,
+    stopped: threading.Event = None,
+    backlog: Optional[Callable[[], int]] = None,
+    max_backlog: int = DEFAULT_MAX_BACKLOG,
+) -> BackfillProgress:
+    """
+    Files the images below root that the ledger does not have as done with
+    their current size and modification time with submit, at most rate of
+    them per second. When backlog is given, it returns the number of files
+    waiting to upload, and files are only filed while fewer than
+    max_backlog are waiting, so live events are not kept waiting behind
+    the backfill. Progress is logged every PROGRESS_INTERVAL seconds.
+    """
+    stopped = stopped or threading.Event()
+    limiter = RateLimiter(rate, stopped)
+    progress = BackfillProgress()
+    logger.info(f"Backfill of {root} started")
+    for files in walk(root, suffixes, workers):
+        progress.directories += 1
+        progress.files += len(files)
+        done = ledger.done_among(files)
+        for path, _, _ in files:
+            if path in done:
+                continue
+            while backlog and backlog() >= max_backlog:
+                if stopped.wait(BACKLOG_POLL_INTERVAL):
+                    break
+            if not limiter.wait():
+                logger.info(f"Backfill stopped: {progress}")
+                return progress
+            submit(path)
+            progress.queued += 1
+            progress.report_when_due()
+        progress.report_when_due()
+    logger.info(f"Backfill done: {progress}")
+    return progress
@@ -0,0 +1,104 @@
+import logging
+import os
+from typing import Callable, Optional
+from urllib.parse import urljoin
+
+import requests
+
+from wagtail_exifimage.cache import get_file_digest
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_TIMEOUT = 30
+MAX_RESUMES = 5
+
+
+def chunked_upload_url(upload_url: str) -> str:
+    """
+    Returns the chunked upload endpoint next to the regular upload endpoint.
+    """
+    return urljoin(upload_url, "../chunked-upload/")
+
+
+def upload_in_chunks(
+    session,
+    url: str,
+    filename: str,
+    metadata: dict,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timeout: float = DEFAULT_TIMEOUT,
+    max_resumes: int = MAX_RESUMES,
+    digest: str = None,
+    upload_url: str = None,
+    on_start: Optional[Callable[[str], None]] = None,
+):
+    """
+    Uploads a file to the chunked upload endpoint at url, one chunk per PUT.
+    After a failed or refused chunk the upload resumes from the offset the
+    server reports, up to max_resumes times in a row without progress.
+    Returns the last response: the one completing the upload, or the one it
+    stopped at.
+
+    An upload started earlier is resumed from the offset a HEAD of its
+    upload_url reports, unless the server no longer knows it. The URL of a
+    new upload is passed to on_start, to keep for resuming it after a
+    restart.
+    """
+    headers = {"X-Upload-Key": metadata["upload_key"]}
+    size = os.path.getsize(filename)
+    digest = digest or get_file_digest(filename)
+
+    r = None
+    if upload_url:
+        r = session.head(upload_url, headers=headers, timeout=timeout)
+        if r.status_code == 404:
+            logging.info(f"Upload of {filename} expired, starting it over")
+            r = None
+        elif r.status_code != 200:
+            return r
+    if r is None:
+        r = session.post(
+            url,
+            data={**metadata, "filename": os.path.basename(filename), "size": size},
+            timeout=timeout,
+        )
+        if r.status_code != 201:
+            return r
+        upload_url = urljoin(url, r.json()["url"])
+        if on_start:
+            on_start(upload_url)
+    complete_url = urljoin(upload_url, "complete/")
+
+    offset = int(r.headers["X-Upload-Offset"])
+    resumes = 0
+    with open(filename, "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            try:
+                r = session.put(
+                    upload_url,
+                    data=chunk,
+                    headers={**headers, "X-Upload-Offset": str(offset)},
+                    timeout=timeout,
+                )
+            except requests.RequestException as ex:
+                logging.warning(f"Chunk at {offset} of {filename} failed: {ex}")
+                r = None
+
+            if r is None or r.status_code == 409:
+                resumes += 1
+                if resumes > max_resumes:
+                    raise requests.RequestException(
+                        f"Gave up uploading {filename} after {max_resumes} resumes"
+                    )
+                r = session.head(upload_url, headers=headers, timeout=timeout)
+            if r.status_code != 200:
+                return r
+            if int(r.headers["X-Upload-Offset"]) > offset:
+                resumes = 0
+            offset = int(r.headers["X-Upload-Offset"])
+
+    return session.post(
+        complete_url, data={"sha256": digest}, headers=headers, timeout=timeout
+    )
@@ -0,0 +1,60 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+# The slowest upload speed a file is given time for, in bytes per second.
+MIN_THROUGHPUT = 256 * 1024
+
+
+def make_session(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+) -> requests.Session:
+    """
+    Returns a session keeping up to pool_size connections per host alive, to
+    share between the upload threads.
+
+    Requests failing to connect, or answered with 429 or a 5xx status, are
+    sent again up to retries times, after an exponential backoff starting at
+    backoff seconds with up to as much random jitter, or after the delay the
+    server asked for with Retry-After. Once the retries are used up the last
+    response is returned. A request that was sent but got no answer, like
+    an upload timing out while the server stores it, is never sent again:
+    the server may have stored it, and with EXIF_IMAGE_DUPLICATES left at
+    allow it would store a second copy.
+    """
+    retry = Retry(
+        total=retries,
+        read=0,
+        backoff_factor=backoff,
+        backoff_jitter=backoff,
+        backoff_max=MAX_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def upload_timeout(size: int) -> tuple:
+    """
+    Returns the (connect, read) timeout for sending size bytes, leaving time
+    to send them at MIN_THROUGHPUT.
+    """
+    return CONNECT_TIMEOUT, READ_TIMEOUT + size / MIN_THROUGHPUT
@@ -1,6 +1,9 @@
+import asyncio
+import functools
 import logging
 import os
 import sys
+import threading
 import time
 
 import markdown
@@ -9,7 +12,39 @@ import watchdog.events
 import watchdog.observers
 from dotenv import load_dotenv
 
-from wagtail_exifimage.utils import get_basic_exif_data
+from wagtail_exifimage.bin import backfill
+from wagtail_exifimage.bin.chunked_upload import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_THRESHOLD,
+    chunked_upload_url,
+    upload_in_chunks,
+)
+from wagtail_exifimage.bin.http_client import (
+    DEFAULT_BACKOFF,
+    DEFAULT_RETRIES,
+    make_session,
+    upload_timeout,
+)
+from wagtail_exifimage.bin.known_digests import find_known_digests, known_digests_url
+from wagtail_exifimage.bin.ledger import (
+    DEFAULT_MAX_ATTEMPTS,
+    FAILED,
+    PENDING,
+    SKIPPED,
+    UploadLedger,
+    get_upload_ledger,
+    upload_state,
+)
+from wagtail_exifimage.bin.pipeline import (
+    DEFAULT_SETTLE_TIME,
+    DEFAULT_WORKERS,
+    UploadPipeline,
+)
+from wagtail_exifimage.cache import (
+    DEFAULT_MAX_ENTRIES,
+    get_file_digest,
+    get_metadata_cache,
+)
 
 load_dotenv()
 
@@ -17,82 +52,295 @@ EXIF_IMAGE_WATCHED_FOLDER = os.getenv("EXIF_IMAGE_WATCHED_FOLDER")
 EXIF_IMAGE_UPLOAD_URL = os.getenv("EXIF_IMAGE_UPLOAD_URL")
 EXIF_IMAGE_UPLOAD_DEFAULT_COLLECTION = os.getenv("EXIF_IMAGE_UPLOAD_DEFAULT_COLLECTION")
 EXIF_IMAGE_UPLOAD_KEY = os.getenv("EXIF_IMAGE_UPLOAD_KEY")
+EXIF_IMAGE_METADATA_CACHE = os.getenv(
+    "EXIF_IMAGE_METADATA_CACHE", "image_service_metadata.sqlite3"
+)
+EXIF_IMAGE_METADATA_CACHE_SIZE = int(
+    os.getenv("EXIF_IMAGE_METADATA_CACHE_SIZE", DEFAULT_MAX_ENTRIES)
+)
+EXIF_IMAGE_CHUNKED_UPLOAD_THRESHOLD = int(
+    os.getenv("EXIF_IMAGE_CHUNKED_UPLOAD_THRESHOLD", DEFAULT_THRESHOLD)
+)
+EXIF_IMAGE_CHUNK_SIZE = int(os.getenv("EXIF_IMAGE_CHUNK_SIZE", DEFAULT_CHUNK_SIZE))
+EXIF_IMAGE_UPLOAD_LEDGER = os.getenv(
+    "EXIF_IMAGE_UPLOAD_LEDGER", "image_service_ledger.sqlite3"
+)
+EXIF_IMAGE_UPLOAD_MAX_ATTEMPTS = int(
+    os.getenv("EXIF_IMAGE_UPLOAD_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)
+)
+EXIF_IMAGE_UPLOAD_WORKERS = int(os.getenv("EXIF_IMAGE_UPLOAD_WORKERS", DEFAULT_WORKERS))
+EXIF_IMAGE_SETTLE_TIME = float(os.getenv("EXIF_IMAGE_SETTLE_TIME", DEFAULT_SETTLE_TIME))
+EXIF_IMAGE_UPLOAD_RETRIES = int(os.getenv("EXIF_IMAGE_UPLOAD_RETRIES", DEFAULT_RETRIES))
+EXIF_IMAGE_UPLOAD_BACKOFF = float(
+    os.getenv("EXIF_IMAGE_UPLOAD_BACKOFF", DEFAULT_BACKOFF)
+)
+# Uploads through an event loop instead of a thread per upload; needs aiohttp.
+EXIF_IMAGE_ASYNC_UPLOADS = bool(int(os.getenv("EXIF_IMAGE_ASYNC_UPLOADS", 0)))
+EXIF_IMAGE_ASYNC_CONCURRENCY = int(os.getenv("EXIF_IMAGE_ASYNC_CONCURRENCY", 32))
+# Images already in the watched folder and not uploaded yet are found at
+# startup and queued at up to EXIF_IMAGE_BACKFILL_RATE files per second.
+EXIF_IMAGE_BACKFILL = bool(int(os.getenv("EXIF_IMAGE_BACKFILL", 1)))
+EXIF_IMAGE_BACKFILL_RATE = float(
+    os.getenv("EXIF_IMAGE_BACKFILL_RATE", backfill.DEFAULT_RATE)
+)
+EXIF_IMAGE_BACKFILL_WORKERS = int(
+    os.getenv("EXIF_IMAGE_BACKFILL_WORKERS", backfill.DEFAULT_WORKERS)
+)
+
+IMAGE_SUFFIXES = (".jpg", ".png", ".webp")
 
 logging.basicConfig(filename="image_service.log", encoding="utf-8", level=logging.DEBUG)
 
 
+def metadata_cache():
+    return get_metadata_cache(EXIF_IMAGE_METADATA_CACHE, EXIF_IMAGE_METADATA_CACHE_SIZE)
+
+
+def upload_ledger():
+    return get_upload_ledger(EXIF_IMAGE_UPLOAD_LEDGER, EXIF_IMAGE_UPLOAD_MAX_ATTEMPTS)
+
+
+@functools.lru_cache(maxsize=None)
+def http_session():
+    return make_session(
+        EXIF_IMAGE_UPLOAD_WORKERS, EXIF_IMAGE_UPLOAD_RETRIES, EXIF_IMAGE_UPLOAD_BACKOFF
+    )
+
+
+def is_known(upload_key, url, digest):
+    """
+    Asks the server whether it already has a file, assuming it does not when
+    it cannot tell.
+    """
+    try:
+        known = find_known_digests(
+            http_session(), known_digests_url(url), upload_key, [digest]
+        )
+    except requests.RequestException as ex:
+        logging.warning(f"Could not check for known files at {url}: {ex}")
+        return False
+    return digest in known
+
+
+def read_metadata(upload_key, filename, digest, collections):
+    """
+    Returns the metadata to post with a file.
+    """
+    metadata = metadata_cache().get_basic_exif_data(filename, digest)
+    metadata["collections"] = collections
+    metadata["upload_key"] = upload_key
+
+    base_path = os.path.split(filename)[0]
+    story_file = os.path.join(base_path, "story.md")
+    if os.path.exists(story_file):
+        with open(story_file, encoding="utf-8") as input_file:
+            metadata["story"] = markdown.markdown(input_file.read())
+    return metadata
+
+
 def upload_file(upload_key, url, filename, collections):
     """
-    Will try to upload an image and its metadata to a given url.
+    Will try to upload an image and its metadata to a given url, recording
+    the outcome in the upload ledger.
     """
     if not os.path.exists(filename):
         return
 
+    size, mtime_ns = UploadLedger.stat(filename)
+    digest = None
+
+    def record(state, response=None):
+        upload_ledger().record(filename, size, mtime_ns, state, digest, response)
+
     try:
-        metadata = get_basic_exif_data(filename)
-        metadata["collections"] = collections
-        metadata["upload_key"] = upload_key
+        digest = get_file_digest(filename)
+        if is_known(upload_key, url, digest):
+            logging.info(f"Skipped {filename}, the server already has it")
+            record(SKIPPED)
+            return
 
-        base_path = os.path.split(filename)[0]
-        story_file = os.path.join(base_path, "story.md")
-        if os.path.exists(story_file):
-            with open(story_file, encoding="utf-8") as input_file:
-                metadata["story"] = markdown.markdown(input_file.read())
+        record(PENDING)
+        metadata = read_metadata(upload_key, filename, digest, collections)
 
         try:
-            with open(filename, "rb") as f:
-                r = requests.post(url, data=metadata, files={"file": f}, timeout=10)
-                # content_type = r.headers.get("content-type") // application/json
-                logging.info(f"Uploaded {filename}. Result: {r.content}")
-        except ConnectionError as ex:
+            if size > EXIF_IMAGE_CHUNKED_UPLOAD_THRESHOLD:
+                r = upload_in_chunks(
+                    http_session(),
+                    chunked_upload_url(url),
+                    filename,
+                    metadata,
+                    EXIF_IMAGE_CHUNK_SIZE,
+                    upload_timeout(EXIF_IMAGE_CHUNK_SIZE),
+                    digest=digest,
+                    upload_url=upload_ledger().get_upload(filename, size, mtime_ns),
+                    on_start=functools.partial(
+                        upload_ledger().set_upload, filename, size, mtime_ns
+                    ),
+                )
+            else:
+                with open(filename, "rb") as f:
+                    r = http_session().post(
+                        url,
+                        data=metadata,
+                        files={"file": f},
+                        timeout=upload_timeout(size),
+                    )
+            # content_type = r.headers.get("content-type") // application/json
+            logging.info(f"Uploaded {filename}. Result: {r.content}")
+            record(upload_state(r.status_code), r.text)
+        except requests.RequestException as ex:
             logging.warning(f"Error connecting to {url}: {ex}")
+            record(FAILED, str(ex))
         except PermissionError as ex:
             logging.warning(f"Permission error reading {filename}: {ex}")
+            record(FAILED, str(ex))
     except Exception as ex:
         logging.warning(f"Error processing {filename}: {ex}")
+        record(FAILED, str(ex))
     except KeyboardInterrupt:
         sys.exit(0)
 
 
+def get_collections(source_path, filename):
+    """
+    Returns the collection path for a file, from its folder below the
+    watched folder.
+    """
+    p, _ = os.path.split(filename)
+    collections = p[len(source_path) :].replace(os.sep, "/")
+    if not collections and EXIF_IMAGE_UPLOAD_DEFAULT_COLLECTION:
+        collections = EXIF_IMAGE_UPLOAD_DEFAULT_COLLECTION
+    return collections
+
+
+def upload_watched_file(source_path, filename):
+    """
+    Uploads a settled file from the watched folder, unless the ledger has it
+    as done.
+    """
+    try:
+        stat = UploadLedger.stat(filename)
+    except FileNotFoundError:
+        return
+    if not upload_ledger().is_done(filename, *stat):
+        upload_file(
+            EXIF_IMAGE_UPLOAD_KEY,
+            EXIF_IMAGE_UPLOAD_URL,
+            filename,
+            get_collections(source_path, filename),
+        )
+
+
+async def upload_file_async(uploader, upload_key, url, filename, collections):
+    """
+    Uploads a file like upload_file, with an AsyncUploader. Files too large
+    to send in one request are left to upload_file in a thread.
+    """
+    try:
+        size, mtime_ns = UploadLedger.stat(filename)
+    except FileNotFoundError:
+        return
+    if size > EXIF_IMAGE_CHUNKED_UPLOAD_THRESHOLD:
+        await asyncio.to_thread(upload_file, upload_key, url, filename, collections)
+        return
+
+    digest = None
+
+    def record(state, response=None):
+        upload_ledger().record(filename, size, mtime_ns, state, digest, response)
+
+    try:
+        digest = await asyncio.to_thread(get_file_digest, filename)
+        try:
+            known = await uploader.known_digests(
+                known_digests_url(url), upload_key, [digest]
+            )
+        except Exception as ex:
+            logging.warning(f"Could not check for known files at {url}: {ex}")
+            known = set()
+        if digest in known:
+            logging.info(f"Skipped {filename}, the server already has it")
+            record(SKIPPED)
+            return
+
+        record(PENDING)
+        metadata = await asyncio.to_thread(
+            read_metadata, upload_key, filename, digest, collections
+        )
+        status, text = await uploader.upload(url, filename, metadata)
+        logging.info(f"Uploaded {filename}. Result: {text}")
+        record(upload_state(status), text)
+    except Exception as ex:
+        logging.warning(f"Error processing {filename}: {ex}")
+        record(FAILED, str(ex))
+
+
+async def upload_watched_file_async(uploader, source_path, filename):
+    """
+    Uploads a settled file from the watched folder with an AsyncUploader,
+    unless the ledger has it as done.
+    """
+    try:
+        stat = UploadLedger.stat(filename)
+    except FileNotFoundError:
+        return
+    if not upload_ledger().is_done(filename, *stat):
+        await upload_file_async(
+            uploader,
+            EXIF_IMAGE_UPLOAD_KEY,
+            EXIF_IMAGE_UPLOAD_URL,
+            filename,
+            get_collections(source_path, filename),
+        )
+
+
 class Handler(watchdog.events.PatternMatchingEventHandler):
     """
-    The handler looking for new images.
+    The handler looking for new images. It only files them with the upload
+    pipeline, so the observer thread is never kept waiting. Images created,
+    written to or renamed into place are filed under their final path, and
+    the pipeline coalesces the events for each path into one upload; images
+    deleted or renamed away are dropped unless already settled.
     """
 
-    def __init__(self, source_path: str):
-        self.uploaded_files = []
-        self.source_path = source_path
+    def __init__(self, pipeline: UploadPipeline):
+        self.pipeline = pipeline
         # Set the patterns for PatternMatchingEventHandler
         watchdog.events.PatternMatchingEventHandler.__init__(
             self,
-            patterns=["*.jpg", "*.png", "*.webp"],
+            patterns=[f"*{suffix}" for suffix in IMAGE_SUFFIXES],
             ignore_directories=True,
             case_sensitive=False,
         )
 
     def on_created(self, event):
-        init_size = -1
-        while True:
-            current_size = os.path.getsize(event.src_path)
-            if current_size == init_size:
-                break
-            else:
-                init_size = os.path.getsize(event.src_path)
-                time.sleep(2)
-
-        if event.src_path not in self.uploaded_files:
-            p, _ = os.path.split(event.src_path)
-            collections = p[len(self.source_path) :].replace(os.sep, "/")
-            if not collections and EXIF_IMAGE_UPLOAD_DEFAULT_COLLECTION:
-                collections = EXIF_IMAGE_UPLOAD_DEFAULT_COLLECTION
-
-            upload_file(
-                EXIF_IMAGE_UPLOAD_KEY,
-                EXIF_IMAGE_UPLOAD_URL,
-                event.src_path,
-                collections,
-            )
-            self.uploaded_files.append(event.src_path)
+        self.pipeline.submit(event.src_path)
+
+    on_modified = on_created
+
+    def on_moved(self, event):
+        self.pipeline.discard(event.src_path)
+        # Renames from a temporary name are let through by the patterns too.
+        if event.dest_path.lower().endswith(IMAGE_SUFFIXES):
+            self.pipeline.submit(event.dest_path)
+
+    def on_deleted(self, event):
+        self.pipeline.discard(event.src_path)
+
+
+def resume_unfinished(source_path, pipeline):
+    """
+    Files the files left pending or failed when the watcher last ran with
+    the upload pipeline, leaving out those that failed too often.
+    """
+    for filename in upload_ledger().unfinished():
+        if not filename.startswith(source_path):
+            continue
+        if not os.path.exists(filename):
+            upload_ledger().record(filename, 0, 0, SKIPPED, response="File removed")
+            continue
+        logging.info(f"Resuming {filename}")
+        pipeline.submit(filename)
 
 
 def main():
@@ -113,17 +361,71 @@ def main():
         logging.error(f"Path does not exist: {src_path}")
         sys.exit(1)
 
+    if EXIF_IMAGE_ASYNC_UPLOADS:
+        # Settled files are handed to an event loop uploading up to
+        # EXIF_IMAGE_ASYNC_CONCURRENCY of them at a time.
+        from wagtail_exifimage.bin.async_upload import AsyncUploader, EventLoopThread
+
+        async def make_uploader():
+            return AsyncUploader(
+                EXIF_IMAGE_ASYNC_CONCURRENCY,
+                EXIF_IMAGE_UPLOAD_RETRIES,
+                EXIF_IMAGE_UPLOAD_BACKOFF,
+            )
+
+        runner = EventLoopThread(EXIF_IMAGE_ASYNC_CONCURRENCY)
+        uploader = runner.run(make_uploader())
+        pipeline = UploadPipeline(
+            functools.partial(
+                runner.call, upload_watched_file_async, uploader, src_path
+            ),
+            1,
+            EXIF_IMAGE_SETTLE_TIME,
+        )
+    else:
+        runner = None
+        pipeline = UploadPipeline(
+            functools.partial(upload_watched_file, src_path),
+            EXIF_IMAGE_UPLOAD_WORKERS,
+            EXIF_IMAGE_SETTLE_TIME,
+        )
+    resume_unfinished(src_path, pipeline)
+
     logging.info(f"Watching {src_path} for new files ...")
-    event_handler = Handler(src_path)
+    event_handler = Handler(pipeline)
     observer = watchdog.observers.Observer()
     observer.schedule(event_handler, path=src_path, recursive=True)
     observer.start()
+
+    # Files added while the watcher was not running are found by a scan
+    # started once the observer is, so none fall between the two.
+    stopped = threading.Event()
+    if EXIF_IMAGE_BACKFILL:
+        scan = threading.Thread(
+            target=backfill.backfill,
+            args=(src_path, IMAGE_SUFFIXES, upload_ledger(), pipeline.submit),
+            kwargs={
+                "rate": EXIF_IMAGE_BACKFILL_RATE,
+                "workers": EXIF_IMAGE_BACKFILL_WORKERS,
+                "stopped": stopped,
+                "backlog": pipeline.backlog,
+            },
+            daemon=True,
+        )
+        scan.start()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
+        stopped.set()
         observer.stop()
     observer.join()
+    pipeline.stop()
+    if runner:
+        runner.stop(uploader.close())
+
+    logging.info(f"Metadata cache: {metadata_cache().stats()}")
+    logging.info(f"Upload ledger: {upload_ledger().stats()}")
 
 
 if __name__ == "__main__":
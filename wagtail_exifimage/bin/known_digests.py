@@ -0,0 +1,41 @@
+from typing import Iterable, Set
+from urllib.parse import urljoin
+
+import requests
+
+BATCH_SIZE = 500
+DEFAULT_TIMEOUT = 10
+
+
+def known_digests_url(upload_url: str) -> str:
+    """
+    Returns the known digests endpoint next to the regular upload endpoint.
+    """
+    return urljoin(upload_url, "../known-digests/")
+
+
+def find_known_digests(
+    session,
+    url: str,
+    upload_key: str,
+    digests: Iterable[str],
+    batch_size: int = BATCH_SIZE,
+    timeout: float = DEFAULT_TIMEOUT,
+) -> Set[str]:
+    """
+    Returns the digests the server already has an image for, asking for
+    batch_size digests at a time.
+    """
+    digests = list(digests)
+    known = set()
+    for start in range(0, len(digests), batch_size):
+        r = session.post(
+            url,
+            json={"digests": digests[start : start + batch_size]},
+            headers={"X-Upload-Key": upload_key},
+            timeout=timeout,
+        )
+        if r.status_code != 200:
+            raise requests.HTTPError(f"Checking digests failed: {r.status_code}")
+        known.update(r.json()["known"])
+    return known
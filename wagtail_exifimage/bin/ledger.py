@@ -0,0 +1,264 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, Optional, Set, Tuple
+
+PENDING = "pending"
+UPLOADED = "uploaded"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+DONE_STATES = (UPLOADED, SKIPPED)
+# Failed uploads of a file are tried again on restarts until this many have
+# failed, then the file is given up on until it changes.
+DEFAULT_MAX_ATTEMPTS = 5
+# Matches the files done or given up on, with _done_params.
+DONE_CONDITION = "(state IN (?, ?) OR (state = ? AND attempts >= ?))"
+# Paths looked up per query, well below SQLite's limit on parameters.
+QUERY_SIZE = 500
+
+
+class UploadLedger:
+    """
+    A persistent record of the files the watcher has seen, stored in a local
+    SQLite file.
+
+    Each file is keyed by its path, with the size and modification time it
+    had when it was recorded, its digest, its upload state, the server's
+    last response and the URL of its unfinished chunked upload. A file counts as done once uploaded or skipped, until its
+    size or modification time changes. Files left pending or failed are
+    picked up again on the next start, failed ones until max_attempts
+    uploads of them failed; after that they count as done as well, so a
+    file the server keeps refusing is not sent on every start. Lookups go
+    through the primary key, so memory use does not grow with the number of
+    files.
+    """
+
+    def __init__(self, path: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    digest TEXT,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    response TEXT,
+                    updated REAL NOT NULL,
+                    upload TEXT
+                )
+                """)
+            columns = {
+                row[1] for row in self._connection.execute("PRAGMA table_info(files)")
+            }
+            if "upload" not in columns:
+                # Ledgers written before chunked uploads were resumable.
+                self._connection.execute("ALTER TABLE files ADD COLUMN upload TEXT")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS files_state ON files (state, path)"
+            )
+
+    @staticmethod
+    def stat(path: str):
+        """Returns the size and modification time the ledger keys a file by."""
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def get_state(self, path: str, size: int, mtime_ns: int) -> Optional[str]:
+        """
+        Returns the state of a file, or None when it has not been seen with
+        this size and modification time.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            ).fetchone()
+        return row and row[0]
+
+    def is_done(self, path: str, size: int, mtime_ns: int) -> bool:
+        """
+        Returns whether a file with this size and modification time was
+        uploaded, skipped or given up on.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                f"""
+                SELECT 1 FROM files
+                WHERE path = ? AND size = ? AND mtime_ns = ? AND {DONE_CONDITION}
+                """,
+                (path, size, mtime_ns, *self._done_params()),
+            ).fetchone()
+        return row is not None
+
+    def _done_params(self) -> tuple:
+        return (*DONE_STATES, FAILED, self.max_attempts)
+
+    def record(
+        self,
+        path: str,
+        size: int,
+        mtime_ns: int,
+        state: str,
+        digest: str = None,
+        response: str = None,
+    ):
+        """
+        Records the state of a file, counting the attempt when it failed.
+        A new size or modification time resets the attempts and forgets the
+        chunked upload, as does a file that is done.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO files (
+                    path, size, mtime_ns, digest, state, attempts, response, updated
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    attempts = CASE
+                        WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns
+                        THEN attempts + excluded.attempts
+                        ELSE excluded.attempts
+                    END,
+                    upload = CASE
+                        WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns
+                        AND excluded.state NOT IN (?, ?)
+                        THEN upload
+                    END,
+                    size = excluded.size,
+                    mtime_ns = excluded.mtime_ns,
+                    digest = COALESCE(excluded.digest, digest),
+                    state = excluded.state,
+                    response = COALESCE(excluded.response, response),
+                    updated = excluded.updated
+                """,
+                (
+                    path,
+                    size,
+                    mtime_ns,
+                    digest,
+                    state,
+                    int(state == FAILED),
+                    response,
+                    time.time(),
+                    *DONE_STATES,
+                ),
+            )
+
+    def get_upload(self, path: str, size: int, mtime_ns: int) -> Optional[str]:
+        """
+        Returns the URL of the unfinished chunked upload of a file with this
+        size and modification time, if any.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT upload FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            ).fetchone()
+        return row and row[0]
+
+    def set_upload(self, path: str, size: int, mtime_ns: int, upload_url: str):
+        """
+        Keeps the URL of a chunked upload started for a recorded file, to
+        resume it after a restart.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                UPDATE files SET upload = ?
+                WHERE path = ? AND size = ? AND mtime_ns = ?
+                """,
+                (upload_url, path, size, mtime_ns),
+            )
+
+    def done_among(self, files: Iterable[Tuple[str, int, int]]) -> Set[str]:
+        """
+        Returns the paths among (path, size, mtime_ns) files that are done
+        with that size and modification time, like is_done, looking them up
+        QUERY_SIZE at a time.
+        """
+        files = {path: (size, mtime_ns) for path, size, mtime_ns in files}
+        paths = list(files)
+        done = set()
+        for start in range(0, len(paths), QUERY_SIZE):
+            batch = paths[start : start + QUERY_SIZE]
+            with self._lock:
+                rows = self._connection.execute(
+                    f"""
+                    SELECT path, size, mtime_ns FROM files
+                    WHERE {DONE_CONDITION}
+                    AND path IN ({", ".join("?" * len(batch))})
+                    """,
+                    (*self._done_params(), *batch),
+                ).fetchall()
+            done.update(path for path, *stat in rows if files[path] == tuple(stat))
+        return done
+
+    def unfinished(self, batch_size: int = 1000) -> Iterator[str]:
+        """
+        Yields the paths of pending files and of failed ones not given up
+        on, reading batch_size of them at a time so the ledger can be updated
+        while they are handled.
+        """
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    """
+                    SELECT path FROM files
+                    WHERE (state = ? OR (state = ? AND attempts < ?)) AND path > ?
+                    ORDER BY path LIMIT ?
+                    """,
+                    (PENDING, FAILED, self.max_attempts, last, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            for (path,) in rows:
+                yield path
+            last = rows[-1][0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT state, COUNT(*) FROM files GROUP BY state"
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_upload_ledger(
+    path: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS
+) -> UploadLedger:
+    """
+    Returns the process-wide ledger stored at the given path.
+    """
+    with _ledgers_lock:
+        if path not in _ledgers:
+            _ledgers[path] = UploadLedger(path, max_attempts)
+        return _ledgers[path]
+
+
+def upload_state(status_code: int) -> str:
+    """
+    Returns the ledger state for the status of an upload response. A
+    duplicate the server refused is as good as uploaded.
+    """
+    if 200 <= status_code < 300:
+        return UPLOADED
+    if status_code == 409:
+        return SKIPPED
+    return FAILED
@@ -0,0 +1,216 @@
+import functools
+import heapq
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+DEFAULT_WORKERS = 4
+DEFAULT_SETTLE_TIME = 2.0
+DEFAULT_QUEUE_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+
+class PendingFile:
+    def __init__(self, path: str, now: float):
+        self.path = path
+        self.seen = now
+        self.deadline = now
+        self.signature = None
+        self.settled = None
+
+
+class UploadPipeline:
+    """
+    Uploads the files reported by the watcher without blocking its event
+    thread.
+
+    submit only files a path. A stability checker thread looks at each
+    pending file every settle_time seconds and hands it on once its size
+    and modification time stopped changing between two looks, and no event
+    was filed for it in between. Bursts of events for a file being written
+    in several passes or renamed into place thus coalesce into one upload,
+    and a file discarded before it settled is never uploaded. A bounded
+    queue feeds the settled files to a pool of worker threads calling
+    upload, so that many files upload in parallel while the checker waits
+    when the workers fall behind. An upload may also return a
+    concurrent.futures.Future, when it runs elsewhere; its file then counts
+    as uploading until the future is done. Each upload is logged with the
+    time spent in each stage and the number of files waiting.
+    """
+
+    def __init__(
+        self,
+        upload: Callable[[str], Optional[Future]],
+        workers: int = DEFAULT_WORKERS,
+        settle_time: float = DEFAULT_SETTLE_TIME,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+    ):
+        self.upload = upload
+        self.settle_time = settle_time
+        self._pending = {}
+        self._active = set()
+        self._changed = set()
+        self._deadlines = []
+        self._condition = threading.Condition()
+        self._queue = queue.Queue(queue_size)
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._check, daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, path: str):
+        """
+        Files a path to upload once it has settled. Filing a path already
+        settling pushes its next look back by settle_time; filing one being
+        uploaded files it again once the upload is done.
+        """
+        now = time.monotonic()
+        with self._condition:
+            if path in self._active:
+                self._changed.add(path)
+                return
+            pending = self._pending.get(path)
+            if pending is None:
+                pending = self._pending[path] = PendingFile(path, now)
+            else:
+                pending.deadline = now + self.settle_time
+            heapq.heappush(self._deadlines, (pending.deadline, path))
+            self._condition.notify()
+
+    def discard(self, path: str):
+        """Drops a path still settling, for a file deleted or moved away."""
+        with self._condition:
+            if self._pending.pop(path, None):
+                logger.debug(f"{path} went away before it settled")
+            self._changed.discard(path)
+
+    def stats(self) -> dict:
+        with self._condition:
+            settling = len(self._pending)
+        return {"settling": settling, "queued": self._queue.qsize()}
+
+    def backlog(self) -> int:
+        """Returns the number of files settling or queued."""
+        stats = self.stats()
+        return stats["settling"] + stats["queued"]
+
+    def stop(self, wait: bool = True):
+        """
+        Stops the pipeline, after uploading the files already settled when
+        wait is set. Files still settling are left to the ledger.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._threads[0].join()
+        if not wait:
+            # Drop what has not started yet.
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+        for _ in self._threads[1:]:
+            self._queue.put(None)
+        for thread in self._threads[1:]:
+            thread.join()
+
+    def _check(self):
+        while True:
+            with self._condition:
+                while not self._stopping and (
+                    not self._deadlines or self._deadlines[0][0] > time.monotonic()
+                ):
+                    timeout = (
+                        self._deadlines[0][0] - time.monotonic()
+                        if self._deadlines
+                        else None
+                    )
+                    self._condition.wait(timeout)
+                if self._stopping:
+                    return
+                deadline, path = heapq.heappop(self._deadlines)
+                pending = self._pending.get(path)
+                # Skip the looks a later event or a discard made obsolete.
+                if pending is None or pending.deadline != deadline:
+                    continue
+
+            try:
+                st = os.stat(path)
+                signature = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                signature = None
+
+            with self._condition:
+                if self._pending.get(path) is not pending:
+                    continue
+                if pending.deadline != deadline:
+                    # An event came in while looking; its look is due later.
+                    pending.signature = signature
+                    continue
+                if signature is None:
+                    del self._pending[path]
+                    logger.debug(f"{path} went away before it settled")
+                    continue
+                if signature != pending.signature:
+                    pending.signature = signature
+                    pending.deadline = time.monotonic() + self.settle_time
+                    heapq.heappush(self._deadlines, (pending.deadline, path))
+                    continue
+                pending.settled = time.monotonic()
+                del self._pending[path]
+                self._active.add(path)
+            # Blocks while the workers are behind.
+            self._queue.put(pending)
+
+    def _work(self):
+        while True:
+            pending = self._queue.get()
+            if pending is None:
+                return
+            started = time.monotonic()
+            try:
+                result = self.upload(pending.path)
+            except Exception as ex:
+                self._finish(pending, started, ex)
+                continue
+            if isinstance(result, Future):
+                # The upload runs elsewhere; the file stays in flight until
+                # it is done.
+                result.add_done_callback(
+                    functools.partial(self._future_done, pending, started)
+                )
+            else:
+                self._finish(pending, started)
+
+    def _future_done(self, pending: PendingFile, started: float, future: Future):
+        self._finish(
+            pending, started, None if future.cancelled() else future.exception()
+        )
+
+    def _finish(self, pending: PendingFile, started: float, error=None):
+        finished = time.monotonic()
+        if error is not None:
+            logger.error(f"Uploading {pending.path} failed", exc_info=error)
+        with self._condition:
+            self._active.discard(pending.path)
+            changed = pending.path in self._changed
+            self._changed.discard(pending.path)
+        if changed:
+            self.submit(pending.path)
+        stats = self.stats()
+        logger.info(
+            f"Processed {pending.path}: settled in "
+            f"{pending.settled - pending.seen:.2f}s, queued "
+            f"{started - pending.settled:.2f}s, uploaded in "
+            f"{finished - started:.2f}s; {stats['settling']} settling, "
+            f"{stats['queued']} queued"
+        )
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from .utils import PARSER_VERSION, get_basic_exif_data
+
+DEFAULT_MAX_ENTRIES = 100_000
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_file_digest(filename, chunk_size=1024 * 1024) -> str:
+    """
+    Returns the SHA-256 hex digest of a file's content, given either its path
+    or a binary file object.
+    """
+    if not hasattr(filename, "read"):
+        with open(filename, "rb") as fh:
+            return get_file_digest(fh, chunk_size)
+
+    digest = hashlib.sha256()
+    filename.seek(0)
+    for chunk in iter(lambda: filename.read(chunk_size), b""):
+        digest.update(chunk)
+    filename.seek(0)
+    return digest.hexdigest()
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot serialize {type(value)}")
+
+
+def _decode(value):
+    if "__datetime__" in value:
+        return datetime.fromisoformat(value["__datetime__"])
+    return value
+
+
+class MetadataCache:
+    """
+    A persistent cache of extracted metadata, stored in a local SQLite file.
+
+    Entries are keyed by the SHA-256 digest of the file content and the
+    parser version, so identical bytes are only ever parsed once, and a new
+    parser version never sees stale results. When the cache grows beyond
+    max_entries, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    digest TEXT NOT NULL,
+                    parser_version INTEGER NOT NULL,
+                    metadata TEXT NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (digest, parser_version)
+                )
+                """)
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)"
+            )
+        (self._entries,) = self._connection.execute(
+            "SELECT COUNT(*) FROM metadata"
+        ).fetchone()
+
+    def get(self, digest: str):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT metadata FROM metadata WHERE digest = ? AND parser_version = ?",
+                (digest, PARSER_VERSION),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            with self._connection:
+                self._connection.execute(
+                    "UPDATE metadata SET last_used = ? WHERE digest = ? AND parser_version = ?",
+                    (time.time(), digest, PARSER_VERSION),
+                )
+        return json.loads(row[0], object_hook=_decode)
+
+    def set(self, digest: str, metadata: dict):
+        data = json.dumps(metadata, default=_encode)
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO metadata VALUES (?, ?, ?, ?)",
+                (digest, PARSER_VERSION, data, time.time()),
+            )
+            if cursor.rowcount:
+                self._entries += 1
+                self._evict()
+
+    def _evict(self):
+        if self._entries > self.max_entries:
+            cursor = self._connection.execute(
+                """
+                DELETE FROM metadata WHERE rowid IN (
+                    SELECT rowid FROM metadata ORDER BY last_used LIMIT ?
+                )
+                """,
+                (self._entries - self.max_entries,),
+            )
+            self._entries -= cursor.rowcount
+
+    def get_basic_exif_data(
+        self, filename, digest: str = None, extract=get_basic_exif_data
+    ) -> dict:
+        """
+        Returns the metadata for a file, parsing it with extract only on a
+        cache miss.
+        """
+        digest = digest or get_file_digest(filename)
+        metadata = self.get(digest)
+        if metadata is None:
+            metadata = extract(filename)
+            self.set(digest, metadata)
+        return metadata
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": self._entries}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_metadata_cache(path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+    """
+    Returns the process-wide cache stored at the given path.
+    """
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = MetadataCache(path, max_entries)
+        return _caches[path]
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ChunkedUpload
+
+READ_SIZE = 64 * 1024
+DEFAULT_MAX_SIZE = 2 * 1024**3
+DEFAULT_TTL = 24 * 60 * 60
+# Running hashes kept in memory; an upload whose hash was dropped, or that
+# resumes in another process, has its part file hashed once to rebuild it.
+MAX_HASHERS = 256
+
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+class ChunkOffsetMismatch(Exception):
+    """
+    A chunk was sent for another offset than the one the upload is at, for
+    instance after an interruption. The client resumes from offset.
+    """
+
+    def __init__(self, offset: int):
+        super().__init__(f"The upload is at offset {offset}")
+        self.offset = offset
+
+
+class ChunkTooLarge(Exception):
+    pass
+
+
+def max_size() -> int:
+    return getattr(settings, "EXIF_IMAGE_CHUNKED_UPLOAD_MAX_SIZE", DEFAULT_MAX_SIZE)
+
+
+def upload_ttl() -> int:
+    return getattr(settings, "EXIF_IMAGE_CHUNKED_UPLOAD_TTL", DEFAULT_TTL)
+
+
+def upload_dir() -> str:
+    """
+    Returns the local directory the part files are written to. Every process
+    serving uploads must see the same directory, a shared filesystem when
+    they run on several hosts, for an upload to resume on any of them.
+    """
+    return getattr(
+        settings,
+        "EXIF_IMAGE_CHUNKED_UPLOAD_DIR",
+        os.path.join(settings.MEDIA_ROOT, "exif_image_uploads"),
+    )
+
+
+def part_path(upload: ChunkedUpload) -> str:
+    return os.path.join(upload_dir(), f"{upload.pk}.part")
+
+
+def running_hash(upload: ChunkedUpload):
+    """
+    Returns a copy of the SHA-256 of the first offset bytes of the upload.
+    """
+    with _hashers_lock:
+        offset, hasher = _hashers.get(upload.pk, (None, None))
+    if offset == upload.offset:
+        return hasher.copy()
+
+    hasher = hashlib.sha256()
+    remaining = upload.offset
+    if remaining:
+        with open(part_path(upload), "rb") as f:
+            while remaining:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def _remember_hash(upload: ChunkedUpload, hasher):
+    with _hashers_lock:
+        _hashers[upload.pk] = (upload.offset, hasher)
+        _hashers.move_to_end(upload.pk)
+        while len(_hashers) > MAX_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def start_upload(user, filename: str, size: int, metadata: dict) -> ChunkedUpload:
+    upload = ChunkedUpload.objects.create(
+        user=user, filename=os.path.basename(filename), size=size, metadata=metadata
+    )
+    os.makedirs(upload_dir(), exist_ok=True)
+    open(part_path(upload), "wb").close()
+    return upload
+
+
+def append_chunk(upload: ChunkedUpload, offset: int, stream) -> ChunkedUpload:
+    """
+    Writes the chunk read from stream to the part file at offset, updating
+    the running hash as the bytes go by. Bytes past a previous, interrupted
+    chunk are discarded first, so a chunk can always be sent again.
+    """
+    with transaction.atomic():
+        upload = ChunkedUpload.objects.select_for_update().get(pk=upload.pk)
+        if offset != upload.offset:
+            raise ChunkOffsetMismatch(upload.offset)
+
+        hasher = running_hash(upload)
+        with open(part_path(upload), "r+b") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                offset += len(data)
+                if offset > upload.size:
+                    f.truncate(upload.offset)
+                    raise ChunkTooLarge(f"The upload is {upload.size} bytes")
+                f.write(data)
+                hasher.update(data)
+
+        upload.offset = offset
+        upload.save(update_fields=["offset", "updated_at"])
+    _remember_hash(upload, hasher)
+    return upload
+
+
+def discard_upload(upload: ChunkedUpload):
+    with _hashers_lock:
+        _hashers.pop(upload.pk, None)
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
+
+
+def expire_uploads(ttl: int = None) -> int:
+    """
+    Discards the uploads that received no chunk for ttl seconds, by default
+    EXIF_IMAGE_CHUNKED_UPLOAD_TTL, and returns how many there were.
+    """
+    cutoff = timezone.now() - timedelta(seconds=upload_ttl() if ttl is None else ttl)
+    expired = 0
+    for upload in ChunkedUpload.objects.filter(updated_at__lt=cutoff).iterator():
+        discard_upload(upload)
+        expired += 1
+    return expired
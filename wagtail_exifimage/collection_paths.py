@@ -0,0 +1,83 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from django.db import transaction
+from wagtail.models import Collection
+
+from .indexes import CommittedIndex
+
+# Bounds how long a collection deleted by another process can linger in the
+# index of this one.
+INDEX_TIMEOUT = 300
+
+
+class CollectionPathResolver:
+    """
+    Maps collection paths, like ["2023", "Norway", "Lofoten"] below the first
+    root collection, to collection ids through an index of every path.
+
+    The index is loaded with two queries and kept until a collection changes.
+    A path that is not in the index is created level by level in a single
+    transaction, holding a row lock on each parent while its children are
+    checked and added. Concurrent uploads creating the same path therefore
+    never add duplicate siblings, and treebeard never computes two children
+    from the same parent state.
+    """
+
+    def __init__(self):
+        self._index: CommittedIndex[Dict[Tuple[str, ...], int]] = CommittedIndex(
+            self._load, INDEX_TIMEOUT
+        )
+        self._create_lock = threading.Lock()
+
+    def resolve(self, names: List[str]) -> Optional[int]:
+        names = tuple(names)
+        if not names:
+            return
+
+        index = self._index.get()
+        collection_id = index.get(names)
+        if collection_id is None:
+            with self._create_lock:
+                collection_id = self._create(names, index)
+        return collection_id
+
+    def _load(self) -> Dict[Tuple[str, ...], int]:
+        root = Collection.get_first_root_node()
+        names_by_path = {root.path: ()}
+        index = {(): root.pk}
+        rows = (
+            Collection.objects.filter(path__startswith=root.path, depth__gt=root.depth)
+            .order_by("path")
+            .values_list("pk", "path", "name")
+        )
+        for pk, path, name in rows:
+            parent_names = names_by_path.get(path[: -Collection.steplen])
+            if parent_names is None:
+                continue
+            names = parent_names + (name,)
+            names_by_path[path] = names
+            # With duplicate sibling names, the first one wins.
+            index.setdefault(names, pk)
+        return index
+
+    def _create(self, names: Tuple[str, ...], index) -> int:
+        level = len(names)
+        while level and names[:level] not in index:
+            level -= 1
+
+        with transaction.atomic():
+            parent_id = index[names[:level]]
+            for name in names[level:]:
+                parent = Collection.objects.select_for_update().get(pk=parent_id)
+                child = parent.get_children().filter(name=name).order_by("path").first()
+                if child is None:
+                    child = parent.add_child(name=name)
+                parent_id = child.pk
+        return parent_id
+
+    def clear(self):
+        self._index.clear()
+
+
+collection_resolver = CollectionPathResolver()
@@ -0,0 +1,287 @@
+import threading
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+from .cache import get_file_digest
+from .indexes import CommittedIndex
+from .upload_handlers import get_upload_metadata
+
+ALLOW = "allow"
+REJECT = "reject"
+LINK = "link"
+
+DEFAULT_MAX_DISTANCE = 8
+# Bounds how long an image added or deleted by another process can be
+# missing from, or linger in, the near-duplicate index of this one.
+INDEX_TIMEOUT = 300
+
+HASH_SIZE = 8
+SAMPLE_SIZE = 32
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    n = np.arange(size)
+    matrix = np.cos(np.pi * np.outer(n, 2 * n + 1) / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
+
+
+DCT = _dct_matrix(SAMPLE_SIZE)
+BIT_WEIGHTS = 1 << np.arange(HASH_SIZE * HASH_SIZE - 1, -1, -1, dtype=np.uint64)
+
+
+def perceptual_hash(file) -> int:
+    """
+    Returns the 64-bit DCT perceptual hash of an image, given its path or a
+    binary file object. Images differing only in scale, compression or small
+    edits get hashes a few bits apart.
+    """
+    if hasattr(file, "seek"):
+        file.seek(0)
+    try:
+        with Image.open(file) as image:
+            # JPEGs are decoded at a fraction of their size.
+            image.draft("L", (SAMPLE_SIZE * 2, SAMPLE_SIZE * 2))
+            pixels = np.asarray(
+                image.convert("L").resize(
+                    (SAMPLE_SIZE, SAMPLE_SIZE), Image.Resampling.LANCZOS
+                ),
+                dtype=np.float64,
+            )
+    finally:
+        if hasattr(file, "seek"):
+            file.seek(0)
+
+    frequencies = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The DC term is the mean brightness and would skew the median.
+    bits = frequencies > np.median(frequencies[1:])
+    return int(BIT_WEIGHTS[bits].sum())
+
+
+def to_signed(value: int) -> int:
+    """Maps a 64-bit hash onto the range of a BigIntegerField."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(bits: int, radius: int) -> Tuple[int, ...]:
+    """Returns every mask of up to radius set bits among the low bits."""
+    return tuple(
+        sum(1 << bit for bit in flipped)
+        for count in range(min(radius, bits) + 1)
+        for flipped in combinations(range(bits), count)
+    )
+
+
+class MultiIndexHash:
+    """
+    A multi-index hash of 64-bit hashes for Hamming distance queries.
+
+    Each hash is filed under each of its four 16-bit chunks. Two hashes at
+    most max_distance bits apart have at least one chunk at most
+    max_distance // 4 bits apart, so a query only probes the buckets of its
+    chunks with that many bits flipped, and checks the full distance of the
+    few hashes found there.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+
+    def __init__(self):
+        self.tables = [{} for _ in range(self.CHUNKS)]
+        self.size = 0
+
+    def _chunks(self, value: int):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(value >> (self.CHUNK_BITS * i)) & mask for i in range(self.CHUNKS)]
+
+    def add(self, value: int, item):
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            table.setdefault(chunk, []).append((value, item))
+        self.size += 1
+
+    def remove(self, value: int, item):
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            bucket = table.get(chunk, [])
+            if (value, item) not in bucket:
+                return
+            bucket.remove((value, item))
+            if not bucket:
+                del table[chunk]
+        self.size -= 1
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, object]]:
+        """
+        Returns the (distance, item) pairs within max_distance, nearest first.
+        """
+        masks = _flip_masks(self.CHUNK_BITS, max_distance // self.CHUNKS)
+        seen = set()
+        results = []
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            for mask in masks:
+                for entry in table.get(chunk ^ mask, ()):
+                    if entry in seen:
+                        continue
+                    seen.add(entry)
+                    distance = hamming_distance(value, entry[0])
+                    if distance <= max_distance:
+                        results.append((distance, entry[1]))
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+class PerceptualHashIndex:
+    """
+    Process-wide multi-index hashes of the perceptual hashes of each user's
+    images, each loaded with one query and kept up to date by the image
+    save and delete signals.
+    """
+
+    def __init__(self):
+        self._indexes: Dict[Optional[int], CommittedIndex[MultiIndexHash]] = {}
+        self._lock = threading.Lock()
+
+    def _user_index(self, user_id: Optional[int]) -> CommittedIndex[MultiIndexHash]:
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                index = self._indexes[user_id] = CommittedIndex(
+                    partial(self._load, user_id), INDEX_TIMEOUT
+                )
+            return index
+
+    def search(
+        self, user_id: Optional[int], value: int, max_distance: int
+    ) -> List[Tuple[int, int]]:
+        return self._user_index(user_id).get().search(value, max_distance)
+
+    def _load(self, user_id: Optional[int]) -> MultiIndexHash:
+        from .models import BasicExifImage
+
+        index = MultiIndexHash()
+        rows = BasicExifImage.objects.filter(
+            uploaded_by_user_id=user_id, perceptual_hash__isnull=False
+        )
+        for pk, value in rows.values_list("pk", "perceptual_hash").iterator():
+            index.add(to_unsigned(value), pk)
+        return index
+
+    def add(self, user_id: Optional[int], image_id: int, value: int):
+        self._user_index(user_id).update(
+            lambda index: index.add(to_unsigned(value), image_id)
+        )
+
+    def remove(self, user_id: Optional[int], image_id: int, value: int):
+        self._user_index(user_id).update(
+            lambda index: index.remove(to_unsigned(value), image_id)
+        )
+
+    def clear(self):
+        with self._lock:
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            index.clear()
+
+
+phash_index = PerceptualHashIndex()
+
+
+@dataclass
+class Duplicate:
+    image_id: int
+    distance: int
+
+    def as_dict(self) -> dict:
+        return {"duplicate_of": self.image_id, "distance": self.distance}
+
+
+class DuplicateImage(Exception):
+    """
+    An upload matched a stored image under the EXIF_IMAGE_DUPLICATES policy;
+    linked is set when the upload should be answered with that image.
+    """
+
+    def __init__(self, duplicate: Duplicate, linked: bool):
+        super().__init__(f"Duplicate of image {duplicate.image_id}")
+        self.duplicate = duplicate
+        self.linked = linked
+
+
+def duplicate_policy() -> str:
+    return getattr(settings, "EXIF_IMAGE_DUPLICATES", ALLOW)
+
+
+def max_distance() -> int:
+    return getattr(settings, "EXIF_IMAGE_NEAR_DUPLICATE_DISTANCE", DEFAULT_MAX_DISTANCE)
+
+
+def image_hashes(file) -> Tuple[str, Optional[int]]:
+    """
+    Returns the SHA-256 and the signed perceptual hash of an image file, the
+    latter None when the file cannot be decoded.
+    """
+    upload_metadata = get_upload_metadata(file)
+    digest = upload_metadata.sha256 if upload_metadata else get_file_digest(file)
+    try:
+        value = to_signed(perceptual_hash(file))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        value = None
+    return digest, value
+
+
+def find_duplicate(
+    digest: str, value: Optional[int], user_id: Optional[int]
+) -> Optional[Duplicate]:
+    """
+    Returns the image of the user with the same content, or else the nearest
+    one within EXIF_IMAGE_NEAR_DUPLICATE_DISTANCE bits of the perceptual
+    hash. Images of other users never count.
+    """
+    from .models import BasicExifImage
+
+    image_id = (
+        BasicExifImage.objects.filter(
+            uploaded_by_user_id=user_id, content_digest=digest
+        )
+        .order_by("pk")
+        .values_list("pk", flat=True)
+        .first()
+    )
+    if image_id is not None:
+        return Duplicate(image_id, 0)
+
+    if value is None or not max_distance():
+        return
+    matches = phash_index.search(user_id, to_unsigned(value), max_distance())
+    if matches:
+        distance, image_id = matches[0]
+        return Duplicate(image_id, distance)
+
+
+def check_duplicates(file, user_id: Optional[int]) -> Tuple[str, Optional[int]]:
+    """
+    Applies the duplicate policy to a file uploaded by a user, raising
+    DuplicateImage for a match among their images to reject or link.
+    Returns the hashes to store on its image.
+    """
+    digest, value = image_hashes(file)
+    policy = duplicate_policy()
+    if policy != ALLOW:
+        duplicate = find_duplicate(digest, value, user_id)
+        if duplicate:
+            raise DuplicateImage(duplicate, linked=policy == LINK)
+    return digest, value
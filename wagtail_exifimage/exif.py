@@ -0,0 +1,210 @@
+import struct
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from exifread.tags.exif import EXIF_TAGS, GPS_TAGS
+from exifread.utils import Ratio
+
+from .jpeg import EXIF_HEADER
+
+EXIF_OFFSET = 0x8769
+GPS_OFFSET = 0x8825
+
+ASCII = 2
+RATIO_TYPES = {5, 10}
+FLOAT_TYPES = {11: "f", 12: "d"}
+SIGNED_TYPES = {6, 8, 9, 10}
+TYPE_LENGTHS = {
+    1: 1,
+    2: 1,
+    3: 2,
+    4: 4,
+    5: 8,
+    6: 1,
+    7: 1,
+    8: 2,
+    9: 4,
+    10: 8,
+    11: 4,
+    12: 8,
+    13: 4,
+}
+INTEGER_FORMATS = {
+    (1, False): "B",
+    (1, True): "b",
+    (2, False): "H",
+    (2, True): "h",
+    (4, False): "I",
+    (4, True): "i",
+}
+
+IFD_TAGS = {"Image": EXIF_TAGS, "EXIF": EXIF_TAGS, "GPS": GPS_TAGS}
+
+
+@dataclass
+class ExifTag:
+    """
+    A decoded tag, with the same printable value exifread would produce.
+    """
+
+    printable: str
+    values: Any = field(default=None, repr=False)
+
+    def __str__(self):
+        return self.printable
+
+
+@lru_cache(maxsize=16)
+def _tag_ids(tag_names: Tuple[str, ...]) -> Dict[str, Set[int]]:
+    """
+    Maps "IFD TagName" strings to the tag ids wanted in each IFD.
+    """
+    ids_by_name = {
+        ifd_name: {entry[0]: tag for tag, entry in tags.items()}
+        for ifd_name, tags in IFD_TAGS.items()
+    }
+    result = {ifd_name: set() for ifd_name in IFD_TAGS}
+    for tag_name in tag_names:
+        ifd_name, _, name = tag_name.partition(" ")
+        tag = ids_by_name.get(ifd_name, {}).get(name)
+        if tag is not None:
+            result[ifd_name].add(tag)
+
+    if result["EXIF"]:
+        result["Image"].add(EXIF_OFFSET)
+    if result["GPS"]:
+        result["Image"].add(GPS_OFFSET)
+    return result
+
+
+class TargetedExifDecoder:
+    """
+    Decodes only the wanted entries of IFD0, the EXIF IFD and the GPS IFD
+    from an APP1 payload. MakerNotes, thumbnails and every other IFD are
+    never touched.
+    """
+
+    def __init__(self, tag_names: Iterable[str]):
+        self.tag_ids = _tag_ids(tuple(tag_names))
+
+    def decode(self, payload: bytes) -> Dict[str, ExifTag]:
+        tiff = memoryview(payload)
+        if payload.startswith(EXIF_HEADER):
+            tiff = tiff[len(EXIF_HEADER) :]
+        if len(tiff) < 8 or bytes(tiff[:2]) not in (b"II", b"MM"):
+            return {}
+
+        self.data = tiff
+        self.endian = "<" if bytes(tiff[:2]) == b"II" else ">"
+        self.tags = {}
+
+        pointers = self._dump_ifd(self._read("I", 4), "Image")
+        if EXIF_OFFSET in pointers:
+            self._dump_ifd(pointers[EXIF_OFFSET], "EXIF")
+        if GPS_OFFSET in pointers:
+            self._dump_ifd(pointers[GPS_OFFSET], "GPS")
+        return self.tags
+
+    def _unpack(self, fmt: str, offset: int, count: int = 1) -> tuple:
+        size = struct.calcsize(fmt) * count
+        if offset < 0 or offset + size > len(self.data):
+            raise ValueError("offset out of range")
+        return struct.unpack_from(f"{self.endian}{count}{fmt}", self.data, offset)
+
+    def _read(self, fmt: str, offset: int) -> int:
+        return self._unpack(fmt, offset)[0]
+
+    def _dump_ifd(self, ifd: int, ifd_name: str) -> Dict[int, int]:
+        wanted = self.tag_ids[ifd_name]
+        tag_dict = IFD_TAGS[ifd_name]
+        pointers = {}
+        try:
+            entries = self._read("H", ifd)
+        except ValueError:
+            return pointers
+
+        for i in range(entries):
+            entry = ifd + 2 + 12 * i
+            if entry + 12 > len(self.data):
+                break
+
+            tag = self._read("H", entry)
+            if tag not in wanted:
+                continue
+            field_type = self._read("H", entry + 2)
+            if field_type not in TYPE_LENGTHS:
+                continue
+            count = self._read("I", entry + 4)
+            offset = entry + 8
+            try:
+                if count * TYPE_LENGTHS[field_type] > 4:
+                    offset = self._read("I", offset)
+                values = self._values(field_type, count, offset)
+            except ValueError:
+                continue
+
+            if tag in (EXIF_OFFSET, GPS_OFFSET):
+                if values:
+                    pointers[tag] = values[0]
+                continue
+
+            tag_entry = tag_dict.get(tag)
+            self.tags[f"{ifd_name} {tag_entry[0]}"] = ExifTag(
+                self._printable(field_type, count, values, tag_entry), values
+            )
+        return pointers
+
+    def _values(self, field_type: int, count: int, offset: int):
+        if field_type == ASCII:
+            if not count:
+                return ""
+            value = bytes(self.data[offset : offset + count]).split(b"\x00", 1)[0]
+            try:
+                return value.decode("utf-8")
+            except UnicodeDecodeError:
+                return value
+
+        # exifread gives up on values this long outside MakerNotes.
+        if count >= 1000:
+            return []
+
+        signed = field_type in SIGNED_TYPES
+        if field_type in RATIO_TYPES:
+            raw = self._unpack("i" if signed else "I", offset, count * 2)
+            return [Ratio(raw[i], raw[i + 1]) for i in range(0, 2 * count, 2)]
+        if field_type in FLOAT_TYPES:
+            # exifread keeps each float as a one-element tuple.
+            values = self._unpack(FLOAT_TYPES[field_type], offset, count)
+            return [(value,) for value in values]
+
+        fmt = INTEGER_FORMATS[(TYPE_LENGTHS[field_type], signed)]
+        return list(self._unpack(fmt, offset, count))
+
+    @staticmethod
+    def _printable(field_type: int, count: int, values, tag_entry) -> str:
+        if count == 1 and field_type != ASCII:
+            printable = str(values[0])
+        elif count > 50 and len(values) > 20 and not isinstance(values, str):
+            printable = str(values[0:20])[0:-1] + ", ... ]"
+        else:
+            printable = str(values)
+
+        mapping = tag_entry[1] if tag_entry else None
+        if mapping is None or isinstance(mapping, tuple):
+            return printable
+        if callable(mapping):
+            return mapping(values)
+
+        printable = ""
+        for value in values:
+            printable += mapping.get(value, repr(value))
+        return printable
+
+
+def decode_exif(payload: bytes, tag_names: List[str]) -> Dict[str, ExifTag]:
+    """
+    Decodes the named tags, like "Image Make" or "EXIF FNumber", from the
+    payload of an EXIF APP1 segment.
+    """
+    return TargetedExifDecoder(tag_names).decode(payload)
@@ -0,0 +1,167 @@
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+from django.conf import settings
+
+from .jpeg import HeaderSegments, read_header_segments
+from .utils import decode_header_segments, get_basic_exif_data
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_TASKS_PER_CHILD = 100
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class MetadataExtractionTimeout(Exception):
+    pass
+
+
+def _extract(source, fast):
+    """
+    Runs in a worker process. The source is a path, the header segments of
+    a JPEG or the file content.
+    """
+    if isinstance(source, HeaderSegments):
+        return decode_header_segments(source, fast)
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return get_basic_exif_data(source, fast)
+
+
+def _source(filename):
+    """
+    Returns what to send to a worker for a path or a file object: the path
+    when the file is on disk. Otherwise the header of a JPEG is read here,
+    stopping at the image data, and only its EXIF and IPTC payloads are
+    sent. Other formats are sent whole, as exifread seeks through them.
+    """
+    if not hasattr(filename, "read"):
+        return filename
+    if hasattr(filename, "temporary_file_path"):
+        return filename.temporary_file_path()
+
+    filename.seek(0)
+    try:
+        segments = read_header_segments(filename)
+        if segments.is_jpeg:
+            return segments
+        filename.seek(0)
+        return filename.read()
+    finally:
+        filename.seek(0)
+
+
+class ExtractionPool:
+    """
+    Runs metadata extraction in a pool of worker processes, keeping the
+    CPU-bound tag decoding off the GIL of the server process.
+
+    At most max_pending extractions are queued or running at once; further
+    callers wait for a slot. An extraction taking longer than timeout
+    seconds raises MetadataExtractionTimeout, and the pool is replaced so
+    the pathological file no longer holds a worker. Workers are recycled
+    after max_tasks_per_child extractions, to bound memory growth in
+    exifread and iptcinfo3.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        max_pending: int = None,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_tasks_per_child: int = DEFAULT_MAX_TASKS_PER_CHILD,
+    ):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        self._slots = threading.BoundedSemaphore(max_pending or workers * 2)
+        self._lock = threading.Lock()
+        self._executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        kwargs = {}
+        if self.max_tasks_per_child and sys.version_info >= (3, 11):
+            kwargs["max_tasks_per_child"] = self.max_tasks_per_child
+        # Workers are spawned rather than forked, which recycling requires,
+        # and which keeps database connections out of the children.
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=get_context("spawn"), **kwargs
+        )
+
+    def _restart(self, executor):
+        """
+        Replaces the executor with a new one and kills its workers. The
+        extractions of other callers still queued or running on it fail
+        with BrokenProcessPool and are submitted again by their callers.
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = self._create_executor()
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False)
+
+    def get_basic_exif_data(self, filename, fast=True) -> dict:
+        source = _source(filename)
+        with self._slots:
+            for retry in (True, False):
+                executor = self._executor
+                try:
+                    future = executor.submit(_extract, source, fast)
+                except RuntimeError:
+                    # Shut down or broken since it was read, by another
+                    # caller's timeout or a crashed worker.
+                    self._restart(executor)
+                    if not retry:
+                        raise
+                    continue
+                try:
+                    return future.result(timeout=self.timeout)
+                except FutureTimeoutError:
+                    self._restart(executor)
+                    raise MetadataExtractionTimeout(
+                        f"Extracting metadata took more than {self.timeout} seconds"
+                    )
+                except (BrokenProcessPool, CancelledError):
+                    # Another caller's timeout replaced the pool under us.
+                    self._restart(executor)
+                    if not retry:
+                        raise
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def get_extraction_pool():
+    """
+    Returns the process-wide extraction pool configured by the
+    EXIF_IMAGE_EXTRACTION_* settings, or None to extract in process.
+    """
+    global _pool
+    workers = getattr(settings, "EXIF_IMAGE_EXTRACTION_WORKERS", 0)
+    if not workers:
+        return
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExtractionPool(
+                workers,
+                getattr(settings, "EXIF_IMAGE_EXTRACTION_QUEUE_SIZE", None),
+                getattr(settings, "EXIF_IMAGE_EXTRACTION_TIMEOUT", DEFAULT_TIMEOUT),
+                getattr(
+                    settings,
+                    "EXIF_IMAGE_EXTRACTION_MAX_TASKS_PER_CHILD",
+                    DEFAULT_MAX_TASKS_PER_CHILD,
+                ),
+            )
+        return _pool
@@ -0,0 +1,81 @@
+import functools
+import threading
+import time
+from typing import Callable, Generic, Optional, TypeVar
+
+from django.db import transaction
+
+T = TypeVar("T")
+
+
+def _on_commit_pending(func) -> bool:
+    """
+    Returns whether func is still to run on commit of the transaction in
+    progress. Rolling back the transaction, or the savepoint func was added
+    in, drops it.
+    """
+    connection = transaction.get_connection()
+    return connection.in_atomic_block and any(
+        callback is func for _, callback, *_ in connection.run_on_commit
+    )
+
+
+class CommittedIndex(Generic[T]):
+    """
+    A process-wide index of database rows, built by load and kept for up to
+    timeout seconds.
+
+    An index is only kept once the transaction that loaded it commits, and
+    only if no change was applied since it was loaded, so an index read in a
+    transaction that is rolled back, or outdated meanwhile, is never kept.
+    Until then the transaction goes on using the index it loaded instead of
+    loading it again for every lookup, as a batch of uploads would; changes
+    made in the transaction reach the index once it commits.
+    """
+
+    def __init__(self, load: Callable[[], T], timeout: float):
+        self.load = load
+        self.timeout = timeout
+        self._index: Optional[T] = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self) -> T:
+        with self._lock:
+            index = self._index
+            if index is not None and time.monotonic() - self._loaded_at < self.timeout:
+                return index
+            generation = self._generation
+
+        pending = getattr(self._local, "pending", None)
+        if pending and pending[1] == generation and _on_commit_pending(pending[2]):
+            return pending[0]
+
+        index = self.load()
+        remember = functools.partial(self._remember, index, generation)
+        self._local.pending = (index, generation, remember)
+        transaction.on_commit(remember)
+        return index
+
+    def _remember(self, index: T, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self._index = index
+                self._loaded_at = time.monotonic()
+
+    def update(self, change: Callable[[T], None]):
+        """
+        Applies a committed change to the index kept, if any, and outdates
+        the indexes being loaded.
+        """
+        with self._lock:
+            self._generation += 1
+            if self._index is not None:
+                change(self._index)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._index = None
@@ -0,0 +1,168 @@
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from .duplicates import DuplicateImage
+from .models import MetadataJob
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VISIBILITY_TIMEOUT = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 30
+
+
+def job_queue_enabled() -> bool:
+    return getattr(settings, "EXIF_IMAGE_JOB_QUEUE", False)
+
+
+def visibility_timeout() -> int:
+    return getattr(
+        settings, "EXIF_IMAGE_JOB_VISIBILITY_TIMEOUT", DEFAULT_VISIBILITY_TIMEOUT
+    )
+
+
+def max_attempts() -> int:
+    return getattr(settings, "EXIF_IMAGE_JOB_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """
+    Returns how long to wait before retrying a job that failed on its given
+    attempt, doubling for every attempt.
+    """
+    delay = getattr(settings, "EXIF_IMAGE_JOB_RETRY_DELAY", DEFAULT_RETRY_DELAY)
+    return timedelta(seconds=delay * 2 ** (attempts - 1))
+
+
+def enqueue_upload(user, data: dict, file) -> MetadataJob:
+    """
+    Stores an uploaded file and its fields as a job for the workers.
+    """
+    job = MetadataJob(user=user, filename=os.path.basename(file.name), metadata=data)
+    job.file.save(job.filename, file, save=False)
+    job.save()
+    return job
+
+
+def job_status(job: MetadataJob) -> dict:
+    return {
+        "job": job.pk,
+        "status": job.status,
+        "attempts": job.attempts,
+        "error": job.error,
+        "image": job.image_id,
+    }
+
+
+def claim_job():
+    """
+    Claims the next available job, hiding it from other workers for the
+    visibility timeout. Returns None when there is nothing to do.
+
+    The claim is a conditional UPDATE on the row, so when several workers
+    race for the same job only one of them gets it, on any database.
+    """
+    now = timezone.now()
+    MetadataJob.objects.filter(
+        status=MetadataJob.RUNNING, available_at__lte=now, attempts__gte=max_attempts()
+    ).update(status=MetadataJob.FAILED, error="Timed out", updated_at=now)
+
+    candidates = (
+        MetadataJob.objects.filter(
+            status__in=[MetadataJob.PENDING, MetadataJob.RUNNING],
+            available_at__lte=now,
+        )
+        .order_by("available_at", "pk")
+        .values_list("pk", flat=True)[:10]
+    )
+    for job_id in candidates:
+        claimed = MetadataJob.objects.filter(
+            pk=job_id,
+            status__in=[MetadataJob.PENDING, MetadataJob.RUNNING],
+            available_at__lte=now,
+        ).update(
+            status=MetadataJob.RUNNING,
+            attempts=F("attempts") + 1,
+            available_at=now + timedelta(seconds=visibility_timeout()),
+            updated_at=now,
+        )
+        if claimed:
+            return MetadataJob.objects.select_related("user").get(pk=job_id)
+
+
+def run_job(job: MetadataJob):
+    """
+    Processes a claimed job like the upload view would. Form errors and
+    rejected duplicates fail the job at once, any other error is retried
+    until max_attempts is reached.
+    """
+    from .services import MetadataTransformationService
+
+    try:
+        with job.file.open("rb"), MetadataTransformationService(job.user) as service:
+            image, errors = service.upload_image(
+                job.metadata, {"file": File(job.file.file, name=job.filename)}
+            )
+    except DuplicateImage as e:
+        if e.linked:
+            job.status = MetadataJob.DONE
+            job.image_id = e.duplicate.image_id
+            job.error = ""
+        else:
+            job.status = MetadataJob.FAILED
+            job.error = str(e)
+        job.file.delete(save=False)
+        job.save()
+        return
+    except Exception as e:
+        logger.exception("Metadata job %s failed", job.pk)
+        job.error = f"{type(e).__name__}: {e}"
+        if job.attempts >= max_attempts():
+            job.status = MetadataJob.FAILED
+        else:
+            job.status = MetadataJob.PENDING
+            job.available_at = timezone.now() + retry_delay(job.attempts)
+        job.save(update_fields=["status", "error", "available_at", "updated_at"])
+        return
+
+    if errors:
+        job.status = MetadataJob.FAILED
+        job.error = errors.as_json()
+    else:
+        job.status = MetadataJob.DONE
+        job.image = image
+        job.error = ""
+        # The image has its own copy of the file.
+        job.file.delete(save=False)
+    job.save()
+
+
+def work(once: bool = False, poll_interval: float = 1.0):
+    """
+    Claims and runs jobs, polling while the queue is empty. With once set it
+    returns as soon as there is nothing left to claim.
+
+    Like Django does around each request, connections that broke or passed
+    CONN_MAX_AGE are closed before and after every job, so a long-running
+    worker reconnects instead of failing every job after a database restart.
+    """
+    while True:
+        close_old_connections()
+        job = claim_job()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        try:
+            run_job(job)
+        finally:
+            close_old_connections()
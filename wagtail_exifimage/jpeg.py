@@ -0,0 +1,162 @@
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+SOI = b"\xff\xd8"
+APP1 = 0xE1
+APP13 = 0xED
+SOS = 0xDA
+EOI = 0xD9
+# Markers without a length field; TEM and RST0-RST7.
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+
+EXIF_HEADER = b"Exif\x00\x00"
+EMPTY_JPEG = SOI + b"\xff\xd9"
+
+
+@dataclass
+class HeaderSegments:
+    is_jpeg: bool
+    exif: Optional[bytes] = None
+    iptc: Optional[bytes] = None
+    bytes_read: int = 0
+
+
+class JpegHeaderParser:
+    """
+    A push parser walking the marker segments of a JPEG header.
+
+    Data is fed in chunks of any size. The parser keeps the payload of the
+    first EXIF APP1 segment and the first APP13 segment, and is done when
+    it reaches the start of scan, the end of the image, or has both payloads.
+    Nothing past the header is ever buffered.
+    """
+
+    def __init__(self):
+        self.is_jpeg: Optional[bool] = None
+        self.exif: Optional[bytes] = None
+        self.iptc: Optional[bytes] = None
+        self.done = False
+        self.bytes_fed = 0
+        self._buffer = bytearray()
+        self._skip = 0
+
+    def feed(self, data: bytes) -> bool:
+        if self.done:
+            return True
+
+        self.bytes_fed += len(data)
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+
+        self._buffer += data
+        self._parse()
+        return self.done
+
+    def close(self) -> HeaderSegments:
+        self.done = True
+        self._buffer.clear()
+        return HeaderSegments(
+            is_jpeg=bool(self.is_jpeg),
+            exif=self.exif,
+            iptc=self.iptc,
+            bytes_read=self.bytes_fed,
+        )
+
+    def _parse(self):
+        buffer = self._buffer
+        pos = 0
+
+        if self.is_jpeg is None:
+            if len(buffer) < 2:
+                return
+            self.is_jpeg = bytes(buffer[:2]) == SOI
+            if not self.is_jpeg:
+                self.done = True
+                return
+            pos = 2
+
+        while not self.done:
+            if len(buffer) - pos < 2:
+                break
+
+            if buffer[pos] != 0xFF:
+                # Corrupt header, give up on what we have so far.
+                self.done = True
+                break
+
+            marker = buffer[pos + 1]
+            if marker == 0xFF:
+                # Fill byte before a marker.
+                pos += 1
+                continue
+
+            if marker in STANDALONE_MARKERS:
+                pos += 2
+                continue
+
+            if marker in (SOS, EOI):
+                self.done = True
+                break
+
+            if len(buffer) - pos < 4:
+                break
+
+            length = (buffer[pos + 2] << 8) | buffer[pos + 3]
+            if length < 2:
+                self.done = True
+                break
+
+            end = pos + 2 + length
+            wanted = (marker == APP1 and self.exif is None) or (
+                marker == APP13 and self.iptc is None
+            )
+            if not wanted:
+                if end > len(buffer):
+                    self._skip = end - len(buffer)
+                    pos = len(buffer)
+                    break
+                pos = end
+                continue
+
+            if end > len(buffer):
+                break
+
+            payload = bytes(buffer[pos + 4 : end])
+            if marker == APP1:
+                if payload.startswith(EXIF_HEADER):
+                    self.exif = payload
+            else:
+                self.iptc = payload
+            pos = end
+
+            if self.exif is not None and self.iptc is not None:
+                self.done = True
+
+        del buffer[:pos]
+        if self.done:
+            buffer.clear()
+
+
+def read_header_segments(fh: BinaryIO, chunk_size: int = 8192) -> HeaderSegments:
+    """
+    Reads a file handle until the JPEG header has been parsed and returns
+    the EXIF and IPTC payloads found.
+    """
+    parser = JpegHeaderParser()
+    while not parser.done:
+        data = fh.read(chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+    return parser.close()
+
+
+def wrap_segment(marker: int, payload: bytes) -> bytes:
+    """
+    Returns a minimal JPEG stream holding a single segment, suitable for
+    decoders expecting a file.
+    """
+    length = len(payload) + 2
+    return SOI + bytes([0xFF, marker, length >> 8, length & 0xFF]) + payload
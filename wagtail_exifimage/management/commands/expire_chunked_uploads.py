@@ -0,0 +1,15 @@
+import djclick as click
+
+from wagtail_exifimage.chunked_uploads import expire_uploads
+
+
+@click.command()
+@click.option(
+    "--ttl",
+    type=int,
+    help="Seconds without a chunk before an upload expires. "
+    "Defaults to EXIF_IMAGE_CHUNKED_UPLOAD_TTL.",
+)
+def expire_chunked_uploads(ttl):
+    expired = expire_uploads(ttl)
+    click.secho(f"Discarded {expired} abandoned chunked uploads", fg="green")
@@ -0,0 +1,27 @@
+import djclick as click
+
+from wagtail_exifimage.duplicates import image_hashes, phash_index
+from wagtail_exifimage.models import BasicExifImage
+
+
+@click.command()
+@click.option("--all", "rehash", is_flag=True, help="Hash images already hashed.")
+def index_image_hashes(rehash):
+    images = BasicExifImage.objects.order_by("pk")
+    if not rehash:
+        images = images.filter(content_digest__isnull=True)
+
+    hashed = failed = 0
+    for image in images.iterator():
+        try:
+            with image.open_file() as f:
+                image.content_digest, image.perceptual_hash = image_hashes(f)
+        except OSError as e:
+            click.secho(f"Could not read {image.file.name}: {e}", fg="red")
+            failed += 1
+            continue
+        image.save(update_fields=["content_digest", "perceptual_hash"])
+        hashed += 1
+
+    phash_index.clear()
+    click.secho(f"Hashed {hashed} images, {failed} could not be read", fg="green")
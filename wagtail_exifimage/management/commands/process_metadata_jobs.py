@@ -0,0 +1,29 @@
+import threading
+
+import djclick as click
+from django.db import connection
+
+from wagtail_exifimage.jobs import work
+
+
+def run_worker(once, poll_interval):
+    try:
+        work(once=once, poll_interval=poll_interval)
+    finally:
+        connection.close()
+
+
+@click.command()
+@click.option("--workers", default=4, help="Number of jobs processed at once.")
+@click.option("--once", is_flag=True, help="Exit when the queue is empty.")
+@click.option("--poll-interval", default=1.0, help="Seconds between polls.")
+def process_metadata_jobs(workers, once, poll_interval):
+    threads = [
+        threading.Thread(target=run_worker, args=(once, poll_interval), daemon=True)
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    click.secho(f"Processing metadata jobs with {workers} workers", fg="green")
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def lowercase_setups(apps, schema_editor):
+    """
+    Stores camera make and model in lower case, as MetadataTransformationSetup
+    now saves them. Rows that only differed in case could never be matched
+    after the first one, so only the oldest of them is kept.
+    """
+    MetadataTransformationSetup = apps.get_model(
+        "wagtail_exifimage", "MetadataTransformationSetup"
+    )
+    seen = set()
+    for setup in MetadataTransformationSetup.objects.order_by("pk"):
+        key = (setup.user_id, setup.camera_make.lower(), setup.camera_model.lower())
+        if key in seen:
+            setup.delete()
+            continue
+
+        seen.add(key)
+        if (setup.camera_make, setup.camera_model) != key[1:]:
+            setup.camera_make, setup.camera_model = key[1:]
+            setup.save(update_fields=["camera_make", "camera_model"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("wagtail_exifimage", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.RunPython(lowercase_setups, migrations.RunPython.noop),
+    ]
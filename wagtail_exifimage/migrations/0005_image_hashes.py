@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wagtail_exifimage", "0004_chunkedupload"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="basicexifimage",
+            name="content_digest",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=64, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="basicexifimage",
+            name="perceptual_hash",
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
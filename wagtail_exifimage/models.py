@@ -1,12 +1,23 @@
+import logging
+import uuid
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import IntegrityError, models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from wagtail.images.models import AbstractImage, AbstractRendition, Image
 
+from .cache import DEFAULT_MAX_ENTRIES, get_metadata_cache
+from .duplicates import image_hashes
+from .extraction import MetadataExtractionTimeout, get_extraction_pool
+from .upload_handlers import get_upload_metadata
 from .utils import get_basic_exif_data, remap_metadata_to_model_fields
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
 BASE_FIELDS = list(Image.admin_form_fields)
 BASE_FIELDS.append("story")
 
@@ -55,6 +66,51 @@ IPTC_FIELDS = [
 ]
 
 
+def metadata_cache():
+    """
+    Returns the metadata cache configured by EXIF_IMAGE_METADATA_CACHE, if any.
+    """
+    path = getattr(settings, "EXIF_IMAGE_METADATA_CACHE", None)
+    if path:
+        return get_metadata_cache(
+            path,
+            getattr(settings, "EXIF_IMAGE_METADATA_CACHE_SIZE", DEFAULT_MAX_ENTRIES),
+        )
+
+
+def extract_metadata(filename, digest: str = None):
+    """
+    Returns the metadata of a file, from the metadata cache when configured,
+    and extracted in the extraction pool when configured. A file whose
+    extraction times out gets no metadata. Uploaded files are never read
+    again when their header was parsed on the way in. Pass the SHA-256 of
+    the file as digest when it is known, so the cache does not hash it.
+    """
+    extract = get_basic_exif_data
+    pool = get_extraction_pool()
+    if pool:
+        extract = pool.get_basic_exif_data
+
+    upload_metadata = get_upload_metadata(filename)
+    if upload_metadata:
+        # The header was parsed and the file hashed while it was uploaded.
+        digest = digest or upload_metadata.sha256
+        read_file = extract
+
+        def extract(filename):
+            metadata = upload_metadata.get_basic_exif_data()
+            return read_file(filename) if metadata is None else metadata
+
+    cache = metadata_cache()
+    try:
+        if cache:
+            return cache.get_basic_exif_data(filename, digest, extract=extract)
+        return extract(filename)
+    except MetadataExtractionTimeout as e:
+        logger.warning("No metadata extracted from %s: %s", filename, e)
+        return {}
+
+
 class BasicExifImage(AbstractImage):
     """
     An image model supporting a story and basic EXIF fields.
@@ -86,21 +142,40 @@ class BasicExifImage(AbstractImage):
     longitude = models.FloatField(null=True, blank=True)
     altitude = models.IntegerField(null=True, blank=True)
 
+    # The SHA-256 of the file and its 64-bit perceptual hash, stored signed;
+    # see duplicates.
+    content_digest = models.CharField(
+        max_length=64, null=True, blank=True, editable=False, db_index=True
+    )
+    perceptual_hash = models.BigIntegerField(null=True, blank=True, editable=False)
+
     admin_form_fields = BASE_FIELDS + EXIF_FIELDS
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        if not self.has_processed_metadata:
-            from .services import MetadataTransformationService
-
-            with MetadataTransformationService(self.uploaded_by_user) as service:
-                default_metadata = service.get_default_metadata(
-                    remap_metadata_to_model_fields(
-                        get_basic_exif_data(self.file.file.name)
-                    )
+        """
+        Unprocessed images get their metadata extracted and applied before
+        the row is written, so the image is saved once. Saves limited by
+        update_fields never trigger processing.
+        """
+        if self.has_processed_metadata or kwargs.get("update_fields") is not None:
+            return super().save(*args, **kwargs)
+
+        from .services import MetadataTransformationService
+
+        if self.file.closed:
+            self.file.open("rb")
+        if not self.content_digest:
+            self.content_digest, self.perceptual_hash = image_hashes(self.file)
+        with MetadataTransformationService(self.uploaded_by_user) as service:
+            default_metadata = service.get_default_metadata(
+                remap_metadata_to_model_fields(
+                    extract_metadata(self.file, self.content_digest)
                 )
-                service.process_image(self, default_metadata)
-                self.save()
+            )
+            processed = service.apply_metadata(self, default_metadata)
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                service.add_tags(self, processed.tags)
 
 
 class AdvancedIPTCExifImage(BasicExifImage):
@@ -189,6 +264,10 @@ class ImageUploadAccessKey(models.Model):
     def get_user_by_key(cls, key: str) -> User:
         return cls.objects.filter(key=key).first()
 
+    @classmethod
+    async def aget_user_by_key(cls, key: str) -> User:
+        return await cls.objects.filter(key=key).select_related("user").afirst()
+
 
 class MetadataDefaultValue(models.Model):
     """
@@ -290,6 +369,8 @@ class MetadataTransformationSetup(models.Model):
         unique_together = ("user", "camera_make", "camera_model")
 
     def save(self, *args, **kwargs):
+        self.camera_make = self.camera_make.lower()
+        self.camera_model = self.camera_model.lower()
         if self.keywords_to_ignore:
             self.keywords_to_ignore = ", ".join(
                 [
@@ -298,3 +379,64 @@ class MetadataTransformationSetup(models.Model):
                 ]
             )
         super().save(*args, **kwargs)
+
+
+class MetadataJob(models.Model):
+    """
+    An upload waiting for its metadata to be processed by a worker, see the
+    process_metadata_jobs management command.
+
+    A claimed job is hidden from other workers until available_at, its
+    visibility timeout. If the worker dies, the job becomes available again
+    once that passes. A failing job is retried with a growing delay until
+    it has been attempted max_attempts times.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="metadata_jobs"
+    )
+    file = models.FileField(upload_to="exif_image_jobs", max_length=255)
+    filename = models.CharField(max_length=255)
+    metadata = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    error = models.TextField(blank=True)
+    image = models.ForeignKey(
+        BasicExifImage, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "available_at"])]
+
+
+class ChunkedUpload(models.Model):
+    """
+    A large upload sent in chunks, see chunked_uploads. The chunks are
+    appended to a part file until offset reaches size, when the upload is
+    completed and processed like any other.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="chunked_uploads"
+    )
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    metadata = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
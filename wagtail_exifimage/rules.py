@@ -0,0 +1,206 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import (
+    MetadataDefaultValue,
+    MetadataTransformationSetup,
+    MetadataTransformationValue,
+)
+
+DEFAULT_TIMEOUT = 300
+
+_lock = threading.Lock()
+_versions: Dict[int, int] = {}
+_rules: Dict[int, Tuple[int, float, "UserRules"]] = {}
+
+
+@dataclass
+class TransformationValue:
+    source_field: str
+    keywords: List[str]
+    target_value: str
+    target_field: str
+
+
+class TransformationRules:
+    """
+    A user's transformation values compiled into a lookup table keyed on
+    (source_field, lowercased value), mapping to every (target_field,
+    target_value) the value transforms into. Applying the rules costs one
+    dict probe per metadata field, however many rules there are.
+    """
+
+    def __init__(self, transformation_values: Iterable[TransformationValue]):
+        self.table: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        for transformation in transformation_values:
+            target = (transformation.target_field, transformation.target_value)
+            for keyword in {keyword.lower() for keyword in transformation.keywords}:
+                self.table.setdefault(
+                    (transformation.source_field, keyword), []
+                ).append(target)
+
+    def __len__(self):
+        return len(self.table)
+
+    def apply(self, metadata: Dict[str, str]) -> Dict[str, str]:
+        result = {}
+        result.update(metadata)
+        if not self.table:
+            return result
+
+        for field, value in metadata.items():
+            if not isinstance(value, str):
+                continue
+            for target_field, target_value in self.table.get(
+                (field, value.lower()), ()
+            ):
+                result[target_field] = target_value or value
+        return result
+
+
+@dataclass
+class UserRules:
+    """
+    Everything the transformation service needs to know about a user's
+    setups, default values and transformation values.
+    """
+
+    setups: Dict[Tuple[str, str], MetadataTransformationSetup]
+    default_values: Dict[Tuple[str, str], List[Tuple[str, str]]]
+    transformations: TransformationRules
+
+    @classmethod
+    def load(cls, user) -> "UserRules":
+        default_values = {}
+        for row in MetadataDefaultValue.objects.filter(user=user):
+            default_values.setdefault(
+                (row.camera_make.lower(), row.camera_model.lower()), []
+            ).append((row.target_field, row.target_value))
+
+        setups = {}
+        for setup in MetadataTransformationSetup.objects.filter(user=user):
+            setups.setdefault(
+                (setup.camera_make.lower(), setup.camera_model.lower()), setup
+            )
+
+        return cls(
+            setups=setups,
+            default_values=default_values,
+            transformations=TransformationRules(
+                transformation
+                for transformations in get_transformation_values(user).values()
+                for transformation in transformations
+            ),
+        )
+
+
+def get_transformation_values(user) -> Dict[str, List[TransformationValue]]:
+    result = {}
+    for row in MetadataTransformationValue.objects.filter(user=user):
+        keywords = [s.strip() for s in row.keywords.split(",")]
+        result.setdefault(row.source_field, []).append(
+            TransformationValue(
+                source_field=row.source_field,
+                keywords=keywords,
+                target_value=row.target_value,
+                target_field=row.target_field or row.source_field,
+            )
+        )
+    return result
+
+
+def shared_cache():
+    """
+    Returns the Django cache named by EXIF_IMAGE_RULES_CACHE, if any.
+    """
+    alias = getattr(settings, "EXIF_IMAGE_RULES_CACHE", None)
+    if alias:
+        return caches[alias]
+
+
+def cache_timeout() -> int:
+    return getattr(settings, "EXIF_IMAGE_RULES_CACHE_TIMEOUT", DEFAULT_TIMEOUT)
+
+
+def version_key(user_id) -> str:
+    return f"wagtail_exifimage:rules-version:{user_id}"
+
+
+def rules_key(user_id, version: int) -> str:
+    return f"wagtail_exifimage:rules:{user_id}:{version}"
+
+
+def get_rules_version(user_id) -> int:
+    """
+    Returns the current version of a user's rules. With a shared cache the
+    version lives there, so a change seen by one process reaches them all.
+    A missing shared version starts at the current time rather than at 1, so
+    an evicted counter never matches entries stored before the eviction.
+    """
+    cache = shared_cache()
+    if cache is None:
+        return _versions.get(user_id, 0)
+
+    key = version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_rules_version(user_id):
+    """
+    Marks a user's cached rules as stale.
+    """
+    with _lock:
+        _versions[user_id] = _versions.get(user_id, 0) + 1
+        _rules.pop(user_id, None)
+
+    cache = shared_cache()
+    if cache is not None:
+        try:
+            cache.incr(version_key(user_id))
+        except ValueError:
+            cache.add(version_key(user_id), time.time_ns(), timeout=None)
+
+
+def get_user_rules(user) -> UserRules:
+    """
+    Returns a user's rules, loaded from the database once per version and
+    shared by every request in the process.
+
+    Local entries are also dropped after EXIF_IMAGE_RULES_CACHE_TIMEOUT
+    seconds, which bounds how stale a process can be when it runs without a
+    shared cache and the rules change in another process.
+    """
+    user_id = getattr(user, "pk", None)
+    if user_id is None:
+        return UserRules.load(user)
+
+    version = get_rules_version(user_id)
+    timeout = cache_timeout()
+    cached = _rules.get(user_id)
+    if cached and cached[0] == version and time.monotonic() - cached[1] < timeout:
+        return cached[2]
+
+    cache = shared_cache()
+    rules = cache.get(rules_key(user_id, version)) if cache is not None else None
+    if rules is None:
+        rules = UserRules.load(user)
+        if cache is not None:
+            cache.set(rules_key(user_id, version), rules, timeout)
+
+    with _lock:
+        _rules[user_id] = (version, time.monotonic(), rules)
+    return rules
+
+
+def clear_rules_cache():
+    with _lock:
+        _rules.clear()
@@ -1,24 +1,40 @@
+import logging
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, Iterable, List, Set, Tuple
 
 from django.contrib.auth import get_user_model
-from wagtail.models import Collection
-
-from .models import (
-    MetadataDefaultValue,
-    MetadataTransformationSetup,
-    MetadataTransformationValue,
+from django.db import transaction
+from django.http import QueryDict
+
+from .collection_paths import collection_resolver
+from .duplicates import DuplicateImage, check_duplicates
+from .models import MetadataTransformationSetup, extract_metadata
+from .rules import (
+    TransformationRules,
+    TransformationValue,
+    get_transformation_values,
+    get_user_rules,
 )
+from .tags import add_tags, get_keyword_normalizer, unique_tags
+from .utils import FAST_TAGS, remap_metadata_to_model_fields
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+
+# The most queries one upload through the view may cost once its tags,
+# collections and the user's rules are cached: the access key and collection
+# lookups, the image and search/reference index writes, and a fixed number
+# of tag statements regardless of how many keywords the image has.
+UPLOAD_QUERY_BUDGET = 20
+
 
 @dataclass
-class TransformationValue:
-    source_field: str
-    keywords: List[str]
-    target_value: str
-    target_field: str
+class ProcessedMetadata:
+    tags: List[str]
+    fields: Set[str]
 
 
 class MetadataTransformationService:
@@ -28,7 +44,10 @@ class MetadataTransformationService:
 
     def __init__(self, user: User):
         self.user = user
-        self.setups = MetadataTransformationSetup.objects.filter(user=self.user)
+        self.rules = get_user_rules(user)
+        self.setups = self.rules.setups
+        # Collection ids by path, for the images processed by this service.
+        self.collection_ids = {}
 
     def setup_for_image(
         self, camera_make: str, camera_model: str
@@ -36,12 +55,7 @@ class MetadataTransformationService:
         if not camera_make or not camera_model:
             return
 
-        for setup in self.setups:
-            if (
-                setup.camera_make.lower() == camera_make.lower()
-                and setup.camera_model.lower() == camera_model.lower()
-            ):
-                return setup
+        return self.setups.get((camera_make.lower(), camera_model.lower()))
 
     def __enter__(self):
         return self
@@ -52,42 +66,20 @@ class MetadataTransformationService:
     def get_transformation_values(
         self,
     ) -> Dict[str, List[TransformationValue]]:
-        result = {}
-        for row in MetadataTransformationValue.objects.filter(user=self.user):
-            keywords = [s.strip() for s in row.keywords.split(",")]
-            result.setdefault(row.source_field, []).append(
-                TransformationValue(
-                    source_field=row.source_field,
-                    keywords=keywords,
-                    target_value=row.target_value,
-                    target_field=row.target_field or row.source_field,
-                )
-            )
-        return result
+        return get_transformation_values(self.user)
+
+    def get_transformation_rules(self) -> TransformationRules:
+        """
+        Returns the user's transformation values compiled into a lookup table.
+        """
+        return self.rules.transformations
 
     def transform_metadata(self, metadata: Dict[str, str]) -> Dict[str, str]:
         """
         Will transform metadata in the form of a key-value dictionary for a given user,
         based on values stored in the database. The provided metadata is not changed.
         """
-        result = {}
-        result.update(metadata)
-
-        transformation_values = self.get_transformation_values()
-        for t_field, t_values in transformation_values.items():
-            for transformation in t_values:
-                for field in metadata.keys():
-                    if field == t_field:
-                        transformated_value = None
-                        target_field = None
-                        if metadata[field].lower() in transformation.keywords:
-                            transformated_value = transformation.target_value
-                            target_field = transformation.target_field
-                        result[target_field or field] = (
-                            transformated_value or metadata[field]
-                        )
-
-        return result
+        return self.get_transformation_rules().apply(metadata)
 
     def get_default_metadata(self, metadata):
         """
@@ -100,53 +92,45 @@ class MetadataTransformationService:
         if not camera_make or not camera_model:
             return result
 
-        default_values = MetadataDefaultValue.objects.filter(
-            user=self.user,
-            camera_make=camera_make.lower(),
-            camera_model=camera_model.lower(),
+        default_values = self.rules.default_values.get(
+            (camera_make.lower(), camera_model.lower()), []
         )
-
-        if not default_values:
-            return result
-
-        for default_value in default_values:
-            if default_value.target_field not in result:
-                result[default_value.target_field] = default_value.target_value
+        for target_field, target_value in default_values:
+            if target_field not in result:
+                result[target_field] = target_value
 
         return result
 
-    def assign_missing_fields(self, image):
-        setup = self.setup_for_image(image.camera_make, image.camera_model)
+    def assign_missing_fields(self, image, setup=None):
+        setup = setup or self.setup_for_image(image.camera_make, image.camera_model)
         if (
             setup
             and setup.copy_caption_abstract_headline_to_title_if_missing
             and not image.title
         ):
-            image.title = image.caption or image.headline
+            image.title = getattr(image, "caption", None) or getattr(
+                image, "headline", None
+            )
 
     def clean_up_keywords(
         self, keywords, characters_to_remove, keywords_to_ignore
     ) -> List[str]:
-        result = []
-        for keyword in keywords:
-            keyword = keyword.lower().strip()
-            for character in characters_to_remove:
-                keyword = keyword.replace(character, "")
-
-            if keyword in [s.lower().strip() for s in keywords_to_ignore.split(",")]:
-                continue
-            result.append(keyword.capitalize())
-        return result
+        normalizer = get_keyword_normalizer(characters_to_remove, keywords_to_ignore)
+        return normalizer(keywords)
 
-    def assign_tags(self, image, keywords):
+    def get_tags(self, image, keywords, setup=None) -> List[str]:
         """
-        This will add tags to an image based on the IPTC keywords field.
+        Returns the tags for an image based on the IPTC keywords and category
+        fields, with case variants of the same tag removed.
         """
-        setup = self.setup_for_image(image.camera_make, image.camera_model)
-        tags = keywords
+        setup = setup or self.setup_for_image(image.camera_make, image.camera_model)
+        tags = list(keywords)
         tags += [
             s.strip().capitalize()
-            for s in image.category.split(setup and setup.category_divider or "/")
+            for s in (getattr(image, "category", None) or "").split(
+                setup and setup.category_divider or "/"
+            )
+            if s.strip()
         ]
 
         if image.software:
@@ -162,55 +146,171 @@ class MetadataTransformationService:
             if setup.convert_lens_model_to_tag and image.lens_model:
                 tags.append(image.lens_model)
 
-        for tag in tags:
-            image.tags.add(tag)
+        return unique_tags(tags)
 
-    def assign_collection(self, image, collections: List[str] = []):
+    def assign_tags(self, image, keywords):
+        """
+        This will add tags to an image based on the IPTC keywords field.
+        """
+        self.add_tags(image, self.get_tags(image, keywords))
+
+    def add_tags(self, image, tags: List[str]):
+        """
+        Adds tags to a saved image with a fixed number of statements, however
+        many tags there are.
+        """
+        add_tags(image, tags)
+
+    def assign_collection(self, image, collections: List[str] = [], setup=None):
         """
         This will assign an image to a collection based on either the supploed collection-list
         or based on the IPTC category field if the transformation setup has this turned on.
         """
-        if not collections and image.category:
-            setup = self.setup_for_image(image.camera_make, image.camera_model)
+        if not collections and getattr(image, "category", None):
+            setup = setup or self.setup_for_image(image.camera_make, image.camera_model)
             if setup and setup.convert_categories_to_collections:
                 collections = [
                     s.strip() for s in image.category.split(setup.category_divider)
                 ]
 
         if collections:
-            root_coll = Collection.get_first_root_node()
-            for collection in collections:
-                children = [c for c in root_coll.get_children()]
-                if collection not in [c.name for c in children]:
-                    root_coll = root_coll.add_child(name=collection)
-                else:
-                    root_coll = [c for c in children if c.name == collection][0]
-
-            image.collection = root_coll
-
-    def process_image(self, image, default_metadata: dict[str, str]):
+            path = tuple(collections)
+            if path not in self.collection_ids:
+                self.collection_ids[path] = collection_resolver.resolve(collections)
+            image.collection_id = self.collection_ids[path]
+
+    def apply_metadata(
+        self, image, default_metadata: dict[str, str]
+    ) -> ProcessedMetadata:
+        """
+        Transforms the metadata and applies it, the collection and any missing
+        fields to the image in memory, without saving it. Returns the changed
+        fields and the tags to add once the image has been saved.
+        """
+        metadata = self.transform_metadata(default_metadata)
+        # The setup is resolved once for the whole pipeline, matching either
+        # the camera as reported or as named by the transformation rules.
         setup = self.setup_for_image(
             default_metadata.get("camera_make"), default_metadata.get("camera_model")
+        ) or self.setup_for_image(
+            metadata.get("camera_make"), metadata.get("camera_model")
         )
-        metadata = self.transform_metadata(default_metadata)
-        keywords = (
-            setup
-            and self.clean_up_keywords(
-                metadata["keywords"].split(", "),
+        metadata.pop("collections", None)
+        keywords = [
+            keyword for keyword in metadata.get("keywords", "").split(", ") if keyword
+        ]
+        if setup:
+            keywords = self.clean_up_keywords(
+                keywords,
                 setup.characters_to_trim_from_keywords,
-                setup.keywords_to_ignore,
+                setup.keywords_to_ignore or "",
             )
-            or metadata["keywords"].split(", ")
-        )
 
         for attr, value in metadata.items():
             setattr(image, attr, value)
 
         image.keywords = ", ".join(keywords)
 
-        self.assign_tags(image, keywords)
-        self.assign_collection(image, default_metadata.get("collections", []))
-        self.assign_missing_fields(image)
+        self.assign_collection(image, default_metadata.get("collections", []), setup)
+        self.assign_missing_fields(image, setup)
         image.has_processed_metadata = True
-        image.save()
+        return ProcessedMetadata(
+            tags=self.get_tags(image, keywords, setup),
+            fields=set(metadata)
+            | {"keywords", "collection", "title", "has_processed_metadata"},
+        )
+
+    def process_image(self, image, default_metadata: dict[str, str]):
+        """
+        Processes the metadata for an image and saves it in one transaction,
+        with one write to the image row followed by the bulk tag assignment.
+
+        A new image is inserted with all its fields set. An existing image is
+        updated with update_fields, limited to the fields the metadata changed.
+        """
+        processed = self.apply_metadata(image, default_metadata)
+        with transaction.atomic():
+            if image._state.adding:
+                image.save()
+            else:
+                field_names = {field.name for field in image._meta.concrete_fields}
+                image.save(update_fields=processed.fields & field_names)
+            self.add_tags(image, processed.tags)
         return image
+
+    def upload_image(self, data, files):
+        """
+        Creates and processes an image from the fields and file of an upload,
+        as posted by the watcher. Returns the image and None, or None and the
+        form errors. Raises DuplicateImage when the duplicate policy turns the
+        file away.
+        """
+        from .forms import get_upload_form
+
+        # Duplicates are turned away before any metadata or image work.
+        hashes = (
+            check_duplicates(files["file"], self.user.pk)
+            if "file" in files
+            else (None, None)
+        )
+
+        if "file" in files and not any(tag in data for tag in FAST_TAGS):
+            # Nothing was extracted by the client. The header parsed while
+            # the file was received is used when there is one, otherwise the
+            # file is read, as for a non-JPEG or a queued upload.
+            data = {
+                **extract_metadata(files["file"], hashes[0]),
+                **dict(data.items()),
+            }
+        metadata = self.get_default_metadata(remap_metadata_to_model_fields(data))
+
+        form_data = QueryDict(mutable=True)
+        form_data.update(metadata)
+        form = get_upload_form()(form_data, files)
+        if not form.is_valid():
+            return None, form.errors
+
+        # The metadata came with the upload, so the image is processed here
+        # instead of having the model read the stored file back on save.
+        image = form.save(commit=False)
+        image.uploaded_by_user = self.user
+        image.content_digest, image.perceptual_hash = hashes
+        metadata["collections"] = [
+            collection
+            for collection in data.get("collections", "").split("/")
+            if collection
+        ]
+        self.process_image(image, metadata)
+        return image, None
+
+    def upload_images(
+        self, uploads: Iterable[Tuple[dict, dict]], batch_size: int = DEFAULT_BATCH_SIZE
+    ):
+        """
+        Creates and processes images for (data, files) pairs like upload_image,
+        committing batch_size of them per transaction. Each upload has its own
+        savepoint, so a failing one leaves the rest of its batch alone.
+
+        Yields the image and None, or None and the form errors, the
+        DuplicateImage or the exception, for every upload in order.
+        """
+        uploads = iter(uploads)
+        while True:
+            batch = [upload for _, upload in zip(range(batch_size), uploads)]
+            if not batch:
+                return
+
+            results = []
+            with transaction.atomic():
+                for data, files in batch:
+                    try:
+                        with transaction.atomic():
+                            results.append(self.upload_image(data, files))
+                    except DuplicateImage as e:
+                        results.append((None, e))
+                    except Exception as e:
+                        logger.exception("Uploading %s failed", files.get("file"))
+                        # The savepoint may have taken new collections with it.
+                        self.collection_ids.clear()
+                        results.append((None, e))
+            yield from results
@@ -0,0 +1,86 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from wagtail.images import get_image_model
+from wagtail.models import Collection
+
+from .collection_paths import collection_resolver
+from .duplicates import phash_index
+from .models import (
+    AdvancedIPTCExifImage,
+    BasicExifImage,
+    MetadataDefaultValue,
+    MetadataTransformationSetup,
+    MetadataTransformationValue,
+)
+from .rules import bump_rules_version
+from .tags import tag_resolver
+
+RULE_MODELS = (
+    MetadataDefaultValue,
+    MetadataTransformationSetup,
+    MetadataTransformationValue,
+)
+
+
+def rules_changed(sender, instance, **kwargs):
+    # Bumped again on commit, as a request reading the rows before the
+    # commit may have cached them under the first bump.
+    bump_rules_version(instance.user_id)
+    transaction.on_commit(lambda: bump_rules_version(instance.user_id))
+
+
+def user_changed(sender, instance, **kwargs):
+    # A new or deleted user must never see rules cached for an earlier user
+    # with the same primary key.
+    if kwargs.get("created", True):
+        bump_rules_version(instance.pk)
+
+
+def tag_changed(sender, instance, **kwargs):
+    # Renamed and deleted tags must not be resolved from stale ids.
+    if not kwargs.get("created", False):
+        tag_resolver.clear()
+
+
+def collection_changed(sender, instance, **kwargs):
+    collection_resolver.clear()
+
+
+def image_saved(sender, instance, **kwargs):
+    if instance.perceptual_hash is not None and kwargs.get("created"):
+        transaction.on_commit(
+            lambda: phash_index.add(
+                instance.uploaded_by_user_id, instance.pk, instance.perceptual_hash
+            )
+        )
+
+
+def image_deleted(sender, instance, **kwargs):
+    if instance.perceptual_hash is not None:
+        transaction.on_commit(
+            lambda: phash_index.remove(
+                instance.uploaded_by_user_id, instance.pk, instance.perceptual_hash
+            )
+        )
+
+
+def connect_signals():
+    for model in RULE_MODELS:
+        post_save.connect(rules_changed, sender=model)
+        post_delete.connect(rules_changed, sender=model)
+
+    user_model = get_user_model()
+    post_save.connect(user_changed, sender=user_model)
+    post_delete.connect(user_changed, sender=user_model)
+
+    tag_model = get_image_model().tags.through.tag_model()
+    post_save.connect(tag_changed, sender=tag_model)
+    post_delete.connect(tag_changed, sender=tag_model)
+
+    post_save.connect(collection_changed, sender=Collection)
+    post_delete.connect(collection_changed, sender=Collection)
+
+    for model in (BasicExifImage, AdvancedIPTCExifImage):
+        post_save.connect(image_saved, sender=model)
+        post_delete.connect(image_deleted, sender=model)
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List
+
+from django.db import transaction
+from django.db.models.functions import Lower
+
+DEFAULT_MAX_SIZE = 10_000
+# Bounds how long a tag deleted by another process can linger in the cache
+# of this one, where links to it would fail.
+CACHE_TIMEOUT = 300
+
+
+def unique_tags(tags: List[str]) -> List[str]:
+    """
+    Returns the tags without blanks and case variants, keeping the first
+    spelling of each.
+    """
+    result = {}
+    for tag in tags:
+        tag = tag.strip()
+        if tag:
+            result.setdefault(tag.lower(), tag)
+    return list(result.values())
+
+
+class KeywordNormalizer:
+    """
+    Lowercases and strips keywords, removes the characters to trim and drops
+    the keywords to ignore, returning the rest capitalized. The ignore list
+    and the translation table are built once, when the normalizer is made.
+    """
+
+    def __init__(self, characters_to_remove: str = "", keywords_to_ignore: str = ""):
+        self.table = str.maketrans("", "", characters_to_remove)
+        self.ignore = frozenset(
+            keyword.lower().strip() for keyword in keywords_to_ignore.split(",")
+        )
+
+    def __call__(self, keywords: List[str]) -> List[str]:
+        table = self.table
+        ignore = self.ignore
+        normalized = (keyword.lower().strip().translate(table) for keyword in keywords)
+        return [keyword.capitalize() for keyword in normalized if keyword not in ignore]
+
+
+@lru_cache(maxsize=256)
+def get_keyword_normalizer(
+    characters_to_remove: str = "", keywords_to_ignore: str = ""
+) -> KeywordNormalizer:
+    """
+    Returns the normalizer for a setup's trim characters and ignore list,
+    shared by every image processed with the same settings.
+    """
+    return KeywordNormalizer(characters_to_remove, keywords_to_ignore)
+
+
+class TagResolver:
+    """
+    Resolves tag names to tag ids in bulk, with an in-process LRU cache of
+    the ids seen in the last CACHE_TIMEOUT seconds.
+
+    Names are matched case-insensitively, so "Norway" reuses an existing
+    "norway" tag instead of creating a case variant. On a cache miss there
+    is one query for the existing tags, then one bulk insert and one lookup
+    for the tags that are new.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, tag_model, tags: List[str]) -> Dict[str, int]:
+        names = {tag.lower(): tag for tag in unique_tags(tags)}
+        label = tag_model._meta.label_lower
+        result = {}
+        expired = time.monotonic() - CACHE_TIMEOUT
+        with self._lock:
+            for lower_name in names:
+                tag_id, remembered_at = self._ids.get((label, lower_name), (None, 0))
+                if tag_id is not None and remembered_at > expired:
+                    self._ids.move_to_end((label, lower_name))
+                    result[lower_name] = tag_id
+
+        missing = [name for name in names if name not in result]
+        if missing:
+            found = self._find(tag_model, missing)
+            new_tags = [names[name] for name in missing if name not in found]
+            if new_tags:
+                found.update(self._create(tag_model, new_tags))
+            result.update(found)
+            # Ids from a transaction that is rolled back must never be cached.
+            transaction.on_commit(lambda: self._remember(label, found))
+        return {names[lower_name]: tag_id for lower_name, tag_id in result.items()}
+
+    def _find(self, tag_model, lower_names: List[str]) -> Dict[str, int]:
+        found = {}
+        rows = (
+            tag_model.objects.annotate(lower_name=Lower("name"))
+            .filter(lower_name__in=lower_names)
+            .order_by("pk")
+            .values_list("lower_name", "pk")
+        )
+        for lower_name, tag_id in rows:
+            found.setdefault(lower_name, tag_id)
+        return found
+
+    def _create(self, tag_model, names: List[str]) -> Dict[str, int]:
+        tag_model.objects.bulk_create(
+            [tag_model(name=name, slug=tag_model().slugify(name)) for name in names],
+            ignore_conflicts=True,
+        )
+        created = self._find(tag_model, [name.lower() for name in names])
+        for name in names:
+            if name.lower() not in created:
+                # The slug belongs to a tag with another name, so let taggit
+                # pick a unique one.
+                created[name.lower()] = tag_model.objects.create(name=name).pk
+        return created
+
+    def _remember(self, label: str, tag_ids: Dict[str, int]):
+        now = time.monotonic()
+        with self._lock:
+            for lower_name, tag_id in tag_ids.items():
+                self._ids[(label, lower_name)] = (tag_id, now)
+                self._ids.move_to_end((label, lower_name))
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+tag_resolver = TagResolver()
+
+
+def add_tags(image, tags: List[str]):
+    """
+    Links tags to a saved image with one bulk insert, creating the tags that
+    do not exist yet. Links the image already has are left alone.
+    """
+    if not tags:
+        return
+
+    through = image.tags.through
+    tag_ids = tag_resolver.resolve(through.tag_model(), tags)
+    lookup_kwargs = through.lookup_kwargs(image)
+    through.objects.bulk_create(
+        [through(tag_id=tag_id, **lookup_kwargs) for tag_id in tag_ids.values()],
+        ignore_conflicts=True,
+    )
@@ -1,10 +1,819 @@
+import asyncio
+import functools
+import hashlib
+import http.server
+import io
+import json
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from random import Random
+from unittest import mock, skipUnless
+from urllib.parse import urlsplit
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, transaction
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from PIL.TiffImagePlugin import IFDRational
+import requests
+from taggit.models import Tag
+from wagtail.models import Collection
 
 User = get_user_model()
 
-from .models import MetadataDefaultValue, MetadataTransformationValue
-from .services import MetadataTransformationService
+try:
+    from .bin import async_upload
+except ImportError:
+    async_upload = None
+
+from . import chunked_uploads
+from .bin.backfill import backfill, walk
+from .bin.chunked_upload import upload_in_chunks
+from .bin.http_client import make_session, upload_timeout
+from .bin.known_digests import find_known_digests
+from .bin.ledger import (
+    FAILED,
+    PENDING,
+    SKIPPED,
+    UPLOADED,
+    UploadLedger,
+    upload_state,
+)
+from .bin.pipeline import UploadPipeline
+from .cache import MetadataCache, get_file_digest
+from .collection_paths import CollectionPathResolver, collection_resolver
+from .duplicates import (
+    DEFAULT_MAX_DISTANCE,
+    MultiIndexHash,
+    hamming_distance,
+    perceptual_hash,
+    phash_index,
+    to_signed,
+    to_unsigned,
+)
+from .extraction import ExtractionPool, MetadataExtractionTimeout, _source
+from .jobs import claim_job, run_job, work
+from .jpeg import HeaderSegments, JpegHeaderParser, read_header_segments
+from .models import (
+    AdvancedIPTCExifImage,
+    ChunkedUpload,
+    ImageUploadAccessKey,
+    MetadataDefaultValue,
+    MetadataJob,
+    MetadataTransformationSetup,
+    MetadataTransformationValue,
+    extract_metadata,
+    metadata_cache,
+)
+from .rules import clear_rules_cache
+from .services import UPLOAD_QUERY_BUDGET, MetadataTransformationService
+from .tags import CACHE_TIMEOUT, add_tags, get_keyword_normalizer, tag_resolver
+from .upload_handlers import MetadataUploadHandler
+from .utils import get_basic_exif_data, remap_metadata_to_model_fields
+
+
+def make_iptc_segment(records):
+    """
+    Builds an APP13 Photoshop payload holding the given IPTC record 2 datasets.
+    """
+    iim = b""
+    for dataset, value in records:
+        value = value.encode("utf-8")
+        iim += struct.pack("!BBBH", 0x1C, 2, dataset, len(value)) + value
+    if len(iim) % 2:
+        iim += b"\x00"
+    return (
+        b"Photoshop 3.0\x00"
+        + b"8BIM"
+        + struct.pack("!H", 0x0404)
+        + b"\x00\x00"
+        + struct.pack("!I", len(iim))
+        + iim
+    )
+
+
+def make_jpeg(
+    make="FUJIFILM",
+    model="X-T5",
+    date_time_original="2023:04:24 16:00:00",
+    iptc=((105, "A headline"), (25, "Norway"), (25, "Lofoten"), (15, "2023/Norway")),
+    size=(64, 48),
+    picture=None,
+):
+    """
+    Returns the bytes of a small JPEG with EXIF and, optionally, IPTC metadata.
+    The picture is a solid color unless an image is given.
+    """
+    exif = Image.Exif()
+    exif[0x010F] = make
+    exif[0x0110] = model
+    exif[0x0131] = "Darktable"
+    exif[0x8769] = {
+        0x9003: date_time_original,
+        0x829A: IFDRational(1, 250),
+        0x829D: IFDRational(28, 5),
+        0x8827: 400,
+        0x8822: 3,
+        0x9207: 5,
+        0x9000: b"0232",
+        0xA432: (
+            IFDRational(16, 1),
+            IFDRational(50, 1),
+            IFDRational(14, 5),
+            IFDRational(4, 1),
+        ),
+    }
+    exif[0x8825] = {
+        0x0001: "N",
+        0x0002: (IFDRational(68, 1), IFDRational(14, 1), IFDRational(2957, 100)),
+        0x0003: "E",
+        0x0004: (IFDRational(14, 1), IFDRational(33, 1), IFDRational(0, 1)),
+        0x0006: IFDRational(123, 1),
+    }
+
+    output = io.BytesIO()
+    picture = picture or Image.new("RGB", size, (120, 80, 40))
+    picture.save(output, "JPEG", exif=exif)
+    data = output.getvalue()
+    if iptc:
+        payload = make_iptc_segment(iptc)
+        length = len(payload) + 2
+        data = (
+            data[:2]
+            + bytes([0xFF, 0xED, length >> 8, length & 0xFF])
+            + payload
+            + data[2:]
+        )
+    return data
+
+
+class JpegFileTestCase(SimpleTestCase):
+    def write_jpeg(self, data):
+        fh = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+        fh.write(data)
+        fh.close()
+        self.addCleanup(os.unlink, fh.name)
+        return fh.name
+
+
+class MetadataExtractionTestCase(JpegFileTestCase):
+    def test_segments_found_before_start_of_scan(self):
+        data = make_jpeg(size=(1024, 768))
+        segments = read_header_segments(io.BytesIO(data), chunk_size=512)
+        self.assertTrue(segments.is_jpeg)
+        self.assertTrue(segments.exif.startswith(b"Exif\x00\x00"))
+        self.assertTrue(segments.iptc.startswith(b"Photoshop 3.0"))
+        self.assertLess(segments.bytes_read, len(data))
+
+    def test_parser_accepts_any_chunk_size(self):
+        data = make_jpeg()
+        parser = JpegHeaderParser()
+        for i in range(len(data)):
+            if parser.feed(data[i : i + 1]):
+                break
+        segments = parser.close()
+        expected = read_header_segments(io.BytesIO(data))
+        self.assertEqual(segments.exif, expected.exif)
+        self.assertEqual(segments.iptc, expected.iptc)
+
+    def test_basic_exif_data(self):
+        metadata = get_basic_exif_data(self.write_jpeg(make_jpeg()))
+        self.assertEqual(metadata["Image Make"], "FUJIFILM")
+        self.assertEqual(metadata["Image Model"], "X-T5")
+        self.assertEqual(metadata["EXIF ExposureTime"], "1/250")
+        self.assertEqual(metadata["EXIF FNumber"], "28/5")
+        self.assertEqual(
+            metadata["EXIF DateTimeOriginal"], datetime(2023, 4, 24, 16, 0, 0)
+        )
+        self.assertEqual(metadata["headline"], "A headline")
+        self.assertEqual(metadata["keywords"], "Norway, Lofoten")
+        self.assertEqual(metadata["category"], "2023/Norway")
+
+    def test_basic_exif_data_without_iptc(self):
+        metadata = get_basic_exif_data(self.write_jpeg(make_jpeg(iptc=None)))
+        self.assertEqual(metadata["Image Make"], "FUJIFILM")
+        self.assertEqual(metadata["keywords"], "")
+        self.assertNotIn("headline", metadata)
+
+    def test_fast_mode_matches_full_decode(self):
+        filename = self.write_jpeg(make_jpeg())
+        fast = get_basic_exif_data(filename)
+        full = get_basic_exif_data(filename, fast=False)
+        self.assertEqual(fast, full)
+        self.assertEqual(fast["EXIF MeteringMode"], "Pattern")
+        self.assertEqual(fast["EXIF LensSpecification"], "[16, 50, 14/5, 4]")
+
+    def test_gps_fields(self):
+        metadata = remap_metadata_to_model_fields(
+            get_basic_exif_data(self.write_jpeg(make_jpeg()))
+        )
+        self.assertAlmostEqual(metadata["latitude"], 68.24154, places=4)
+        self.assertAlmostEqual(metadata["longitude"], 14.55, places=4)
+        self.assertEqual(metadata["altitude"], 123)
+
+
+class ExtractionPoolTestCase(JpegFileTestCase):
+    def test_extraction_in_worker_processes(self):
+        pool = ExtractionPool(1, timeout=60, max_tasks_per_child=1)
+        self.addCleanup(pool.shutdown)
+        filename = self.write_jpeg(make_jpeg())
+        expected = get_basic_exif_data(filename)
+
+        self.assertEqual(pool.get_basic_exif_data(filename), expected)
+        with open(filename, "rb") as fh:
+            self.assertEqual(pool.get_basic_exif_data(fh), expected)
+            self.assertEqual(fh.tell(), 0)
+
+    def test_only_jpeg_header_sent_to_workers(self):
+        data = make_jpeg(picture=make_picture(size=(1024, 768)))
+        source = _source(io.BytesIO(data))
+        self.assertIsInstance(source, HeaderSegments)
+        self.assertLess(len(pickle.dumps(source)), len(data) / 10)
+
+        pool = ExtractionPool(1, timeout=60)
+        self.addCleanup(pool.shutdown)
+        self.assertEqual(
+            pool.get_basic_exif_data(io.BytesIO(data)),
+            get_basic_exif_data(io.BytesIO(data)),
+        )
+
+    def test_timeout_replaces_pool(self):
+        pool = ExtractionPool(1, timeout=0.001)
+        self.addCleanup(pool.shutdown)
+        filename = self.write_jpeg(make_jpeg())
+        executor = pool._executor
+
+        # Spawning the worker alone takes longer than the timeout.
+        with self.assertRaises(MetadataExtractionTimeout):
+            pool.get_basic_exif_data(filename)
+        self.assertIsNot(pool._executor, executor)
+
+        pool.timeout = 60
+        self.assertEqual(pool.get_basic_exif_data(filename)["Image Model"], "X-T5")
+
+    def test_timeout_leaves_queued_extractions_alone(self):
+        pool = ExtractionPool(1, max_pending=8, timeout=2)
+        self.addCleanup(pool.shutdown)
+        filename = self.write_jpeg(make_jpeg())
+        # Start the worker, so only the hung extraction runs into the timeout.
+        expected = pool.get_basic_exif_data(filename)
+        # Opening a FIFO nobody writes to blocks the worker.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        hung = os.path.join(directory.name, "hung.jpg")
+        os.mkfifo(hung)
+
+        results = {}
+
+        def extract(name, path):
+            try:
+                results[name] = pool.get_basic_exif_data(path)
+            except Exception as e:
+                results[name] = e
+
+        threads = [threading.Thread(target=extract, args=("hung", hung))]
+        threads[0].start()
+        time.sleep(0.5)
+        threads += [
+            threading.Thread(target=extract, args=(i, filename)) for i in range(4)
+        ]
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIsInstance(results.pop("hung"), MetadataExtractionTimeout)
+        self.assertEqual(results, {i: expected for i in range(4)})
+
+    def test_timed_out_file_gets_no_metadata(self):
+        pool = mock.Mock()
+        pool.get_basic_exif_data.side_effect = MetadataExtractionTimeout()
+        with mock.patch(
+            "wagtail_exifimage.models.get_extraction_pool", return_value=pool
+        ), self.assertLogs("wagtail_exifimage.models", "WARNING"):
+            self.assertEqual(extract_metadata(self.write_jpeg(make_jpeg())), {})
+
+
+class MetadataCacheTestCase(JpegFileTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = MetadataCache(os.path.join(directory.name, "cache.sqlite3"), 2)
+        self.addCleanup(self.cache.close)
+
+    def test_identical_bytes_parsed_once(self):
+        data = make_jpeg()
+        first, second = self.write_jpeg(data), self.write_jpeg(data)
+        metadata = self.cache.get_basic_exif_data(first)
+        self.assertEqual(self.cache.get_basic_exif_data(second), metadata)
+        self.assertEqual(metadata, get_basic_exif_data(first))
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "entries": 1})
+
+    def test_least_recently_used_entries_evicted(self):
+        filenames = [self.write_jpeg(make_jpeg(model=f"X-T{i}")) for i in range(3)]
+        for filename in filenames:
+            self.cache.get_basic_exif_data(filename)
+        self.assertEqual(self.cache.stats()["entries"], 2)
+        self.assertIsNone(self.cache.get(get_file_digest(filenames[0])))
+        self.assertIsNotNone(self.cache.get(get_file_digest(filenames[2])))
+
+
+class UploadLedgerTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "ledger.sqlite3")
+        self.ledger = UploadLedger(self.path)
+        self.addCleanup(self.ledger.close)
+
+    def test_uploaded_file_done_until_changed(self):
+        self.ledger.record("/a.jpg", 10, 1, PENDING, "abc")
+        self.assertFalse(self.ledger.is_done("/a.jpg", 10, 1))
+        self.ledger.record("/a.jpg", 10, 1, UPLOADED, response='{"id": 1}')
+        self.assertTrue(self.ledger.is_done("/a.jpg", 10, 1))
+        self.assertFalse(self.ledger.is_done("/a.jpg", 10, 2))
+        self.assertFalse(self.ledger.is_done("/b.jpg", 10, 1))
+
+    def test_unfinished_resumed_after_reopening(self):
+        for i in range(5):
+            self.ledger.record(f"/{i}.jpg", 10, 1, FAILED if i % 2 else PENDING)
+        self.ledger.record("/5.jpg", 10, 1, SKIPPED)
+        self.ledger.close()
+
+        self.ledger = UploadLedger(self.path)
+        self.assertEqual(
+            list(self.ledger.unfinished(batch_size=2)),
+            [f"/{i}.jpg" for i in range(5)],
+        )
+        self.assertEqual(self.ledger.stats(), {PENDING: 3, FAILED: 2, SKIPPED: 1})
+
+    def test_failed_attempts_counted(self):
+        for _ in range(3):
+            self.ledger.record("/a.jpg", 10, 1, FAILED, response="timeout")
+        attempts = "SELECT attempts FROM files WHERE path = '/a.jpg'"
+        self.assertEqual(self.ledger._connection.execute(attempts).fetchone(), (3,))
+        self.ledger.record("/a.jpg", 11, 2, FAILED)
+        self.assertEqual(self.ledger._connection.execute(attempts).fetchone(), (1,))
+        self.assertEqual(upload_state(409), SKIPPED)
+        self.assertEqual(upload_state(503), FAILED)
+
+    def test_chunked_upload_kept_until_done_or_changed(self):
+        self.ledger.record("/a.jpg", 10, 1, PENDING)
+        self.ledger.set_upload("/a.jpg", 10, 1, "http://server/upload/1/")
+        self.ledger.record("/a.jpg", 10, 1, FAILED, response="timeout")
+        self.assertEqual(
+            self.ledger.get_upload("/a.jpg", 10, 1), "http://server/upload/1/"
+        )
+        self.assertIsNone(self.ledger.get_upload("/a.jpg", 11, 2))
+
+        self.ledger.record("/a.jpg", 10, 1, UPLOADED)
+        self.assertIsNone(self.ledger.get_upload("/a.jpg", 10, 1))
+        self.ledger.set_upload("/a.jpg", 10, 1, "http://server/upload/2/")
+        self.ledger.record("/a.jpg", 11, 2, PENDING)
+        self.assertIsNone(self.ledger.get_upload("/a.jpg", 11, 2))
+
+    def test_ledger_without_upload_column_upgraded(self):
+        self.ledger.close()
+        connection = sqlite3.connect(self.path)
+        with connection:
+            connection.execute("ALTER TABLE files DROP COLUMN upload")
+        connection.close()
+
+        self.ledger = UploadLedger(self.path)
+        self.ledger.record("/a.jpg", 10, 1, PENDING)
+        self.ledger.set_upload("/a.jpg", 10, 1, "http://server/upload/1/")
+        self.assertEqual(
+            self.ledger.get_upload("/a.jpg", 10, 1), "http://server/upload/1/"
+        )
+
+    def test_failed_files_given_up_after_max_attempts(self):
+        ledger = UploadLedger(self.path, max_attempts=2)
+        self.addCleanup(ledger.close)
+        ledger.record("/a.jpg", 10, 1, FAILED, response="400")
+        ledger.record("/b.jpg", 10, 1, FAILED, response="400")
+        ledger.record("/b.jpg", 10, 1, FAILED, response="400")
+
+        self.assertEqual(list(ledger.unfinished()), ["/a.jpg"])
+        self.assertFalse(ledger.is_done("/a.jpg", 10, 1))
+        self.assertTrue(ledger.is_done("/b.jpg", 10, 1))
+        self.assertEqual(
+            ledger.done_among([("/a.jpg", 10, 1), ("/b.jpg", 10, 1)]), {"/b.jpg"}
+        )
+        # A changed file is tried again.
+        self.assertFalse(ledger.is_done("/b.jpg", 11, 2))
+
+
+class UploadPipelineTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, data=b"0123456789", mode="wb"):
+        path = os.path.join(self.directory, name)
+        with open(path, mode) as f:
+            f.write(data)
+        return path
+
+    def test_files_uploaded_in_parallel(self):
+        # Each upload waits for the other two, so they must run together.
+        barrier = threading.Barrier(3, timeout=5)
+        uploaded = []
+        pipeline = UploadPipeline(
+            lambda path: uploaded.append((path, barrier.wait())), 3, 0.01
+        )
+        paths = [self.write(f"{i}.jpg") for i in range(3)]
+        with self.assertLogs("wagtail_exifimage.bin.pipeline", "INFO") as logs:
+            for path in paths + paths[:1]:
+                pipeline.submit(path)
+            time.sleep(0.2)
+            pipeline.stop()
+
+        self.assertEqual(sorted(path for path, _ in uploaded), paths)
+        self.assertEqual(len(logs.output), 3)
+        self.assertIn("queued", logs.output[0])
+
+    def test_growing_file_waits_until_settled(self):
+        sizes = []
+        uploaded = threading.Event()
+        pipeline = UploadPipeline(
+            lambda path: (sizes.append(os.path.getsize(path)), uploaded.set()), 1, 0.2
+        )
+        path = self.write("a.jpg")
+        with self.assertLogs("wagtail_exifimage.bin.pipeline", "INFO"):
+            pipeline.submit(path)
+            time.sleep(0.1)
+            self.write("a.jpg", mode="ab")
+            self.assertEqual(pipeline.stats(), {"settling": 1, "queued": 0})
+            self.assertTrue(uploaded.wait(5))
+            pipeline.stop()
+        self.assertEqual(sizes, [20])
+
+    def test_vanished_file_dropped(self):
+        upload = mock.Mock()
+        pipeline = UploadPipeline(upload, 1, 0.01)
+        pipeline.submit(os.path.join(self.directory, "missing.jpg"))
+        time.sleep(0.1)
+        pipeline.stop()
+        upload.assert_not_called()
+        self.assertEqual(pipeline.stats(), {"settling": 0, "queued": 0})
+
+    def test_bursts_of_events_coalesced(self):
+        sizes = []
+        pipeline = UploadPipeline(
+            lambda path: sizes.append(os.path.getsize(path)), 2, 0.1
+        )
+        path = self.write("a.jpg")
+        with self.assertLogs("wagtail_exifimage.bin.pipeline", "INFO"):
+            pipeline.submit(path)
+            for _ in range(4):
+                time.sleep(0.05)
+                self.write("a.jpg", mode="ab")
+                pipeline.submit(path)
+            time.sleep(0.5)
+            pipeline.stop()
+        self.assertEqual(sizes, [50])
+
+    def test_discarded_file_not_uploaded(self):
+        upload = mock.Mock()
+        pipeline = UploadPipeline(upload, 1, 0.05)
+        path = self.write("a.jpg.tmp")
+        pipeline.submit(path)
+        pipeline.discard(path)
+        time.sleep(0.2)
+        pipeline.stop()
+        upload.assert_not_called()
+
+    def test_file_changed_while_uploading_filed_again(self):
+        release = threading.Event()
+        uploads = []
+
+        def upload(path):
+            uploads.append(path)
+            release.wait(5)
+
+        pipeline = UploadPipeline(upload, 1, 0.01)
+        path = self.write("a.jpg")
+        with self.assertLogs("wagtail_exifimage.bin.pipeline", "INFO"):
+            pipeline.submit(path)
+            time.sleep(0.1)
+            pipeline.submit(path)
+            pipeline.submit(path)
+            self.assertEqual(pipeline.stats(), {"settling": 0, "queued": 0})
+            release.set()
+            time.sleep(0.1)
+            pipeline.stop()
+        self.assertEqual(uploads, [path, path])
+
+
+class BackfillTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.ledger = UploadLedger(os.path.join(self.root, "ledger.sqlite3"))
+        self.addCleanup(self.ledger.close)
+        self.paths = []
+        for folder in ("", "2023", os.path.join("2023", "Oslo"), "2024"):
+            os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+            for name in ("a.jpg", "B.JPG", "notes.txt"):
+                path = os.path.join(self.root, folder, name)
+                with open(path, "wb") as f:
+                    f.write(b"data")
+                if not name.endswith(".txt"):
+                    self.paths.append(path)
+
+    def test_walk_finds_images_in_parallel(self):
+        files = [file for batch in walk(self.root, (".jpg",), 3) for file in batch]
+        self.assertEqual(sorted(path for path, _, _ in files), sorted(self.paths))
+        self.assertTrue(all(size == 4 for _, size, _ in files))
+
+    def test_only_new_or_changed_files_queued(self):
+        uploaded, changed = self.paths[:2]
+        for path in self.paths[:2]:
+            self.ledger.record(path, *UploadLedger.stat(path), UPLOADED)
+        with open(changed, "ab") as f:
+            f.write(b"more")
+        self.assertEqual(
+            self.ledger.done_among([(p, *UploadLedger.stat(p)) for p in self.paths]),
+            {uploaded},
+        )
+
+        submitted = []
+        with self.assertLogs("wagtail_exifimage.bin.backfill", "INFO") as logs:
+            progress = backfill(self.root, (".jpg",), self.ledger, submitted.append, 0)
+        self.assertEqual(sorted(submitted), sorted(self.paths[1:]))
+        self.assertEqual((progress.directories, progress.files), (4, 8))
+        self.assertIn("7 new or changed files queued", logs.output[-1])
+
+    def test_rate_limited_and_stoppable(self):
+        submitted = []
+        stopped = threading.Event()
+
+        def submit(path):
+            submitted.append(path)
+            if len(submitted) == 3:
+                stopped.set()
+
+        started = time.monotonic()
+        with self.assertLogs("wagtail_exifimage.bin.backfill", "INFO"):
+            backfill(self.root, (".jpg",), self.ledger, submit, 20, stopped=stopped)
+        self.assertEqual(len(submitted), 3)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    def test_live_event_not_queued_behind_backfill(self):
+        backlog_root = os.path.join(self.root, "backlog")
+        os.makedirs(backlog_root)
+        for i in range(100):
+            with open(os.path.join(backlog_root, f"{i}.jpg"), "wb") as f:
+                f.write(b"data")
+        live = os.path.join(self.root, "live.jpg")
+
+        uploaded = []
+        live_submitted = threading.Event()
+
+        def upload(path):
+            uploaded.append(path)
+            if len(uploaded) == 10:
+                with open(live, "wb") as f:
+                    f.write(b"data")
+                pipeline.submit(live)
+                live_submitted.set()
+            time.sleep(0.01)
+
+        pipeline = UploadPipeline(upload, 1, 0.01)
+        stopped = threading.Event()
+        self.addCleanup(pipeline.stop, wait=False)
+        self.addCleanup(stopped.set)
+        with self.assertLogs("wagtail_exifimage.bin.pipeline", "INFO"):
+            scan = threading.Thread(
+                target=backfill,
+                args=(backlog_root, (".jpg",), self.ledger, pipeline.submit, 0),
+                kwargs={
+                    "stopped": stopped,
+                    "backlog": pipeline.backlog,
+                    "max_backlog": 4,
+                },
+            )
+            with self.assertLogs("wagtail_exifimage.bin.backfill", "INFO"):
+                scan.start()
+                self.assertTrue(live_submitted.wait(5))
+                deadline = time.monotonic() + 5
+                while live not in uploaded and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                stopped.set()
+                scan.join()
+
+        # Only the few files the backfill had waiting went first.
+        self.assertLessEqual(uploaded.index(live), 10 + 4 + 1)
+
+
+class ScriptedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers each POST with the next (status, headers[, body]) of the
+    server's script, keeping the request bodies, after the server's delay.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def read_body(self):
+        if "Content-Length" in self.headers:
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        body = b""
+        while size := int(self.rfile.readline(), 16):
+            body += self.rfile.read(size)
+            self.rfile.readline()
+        self.rfile.readline()
+        return body
+
+    def do_POST(self):
+        self.server.bodies.append(self.read_body())
+        self.server.requests.append(self.client_address)
+        status, headers, *body = self.server.script.pop(0)
+        time.sleep(self.server.delay)
+        body = body[0] if body else b""
+        try:
+            self.send_response(status)
+            for header in headers.items():
+                self.send_header(*header)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client gave up waiting.
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class ScriptedServerMixin:
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+        self.server.requests = []
+        self.server.bodies = []
+        self.server.delay = 0
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.01,), daemon=True
+        ).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/upload/"
+
+
+class HttpClientTestCase(ScriptedServerMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session = make_session(pool_size=2, retries=3, backoff=0.01)
+        self.addCleanup(self.session.close)
+
+    def post(self):
+        return self.session.post(
+            self.url, files={"file": io.BytesIO(b"x" * 1000)}, timeout=5
+        )
+
+    def test_retried_on_server_errors_over_one_connection(self):
+        self.server.script = [(503, {"Retry-After": "0"}), (502, {}), (201, {})]
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(len(self.server.requests), 3)
+        # Kept alive: the retries reuse the first connection.
+        self.assertEqual(len(set(self.server.requests)), 1)
+
+    def test_last_response_returned_once_retries_used_up(self):
+        self.server.script = [(429, {})] * 4
+        self.assertEqual(self.post().status_code, 429)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_client_errors_not_retried(self):
+        self.server.script = [(400, {})]
+        self.assertEqual(self.post().status_code, 400)
+
+    def test_unanswered_upload_not_sent_again(self):
+        # The server may have stored the upload before timing out.
+        self.server.script = [(201, {})] * 2
+        self.server.delay = 0.3
+        with self.assertRaises(requests.ConnectionError):
+            self.session.post(
+                self.url, files={"file": io.BytesIO(b"x")}, timeout=(5, 0.05)
+            )
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_timeout_scales_with_size(self):
+        self.assertEqual(upload_timeout(0), (5, 10))
+        self.assertEqual(upload_timeout(10 * 1024 * 1024), (5, 50))
+
+
+@skipUnless(async_upload, "aiohttp is not installed")
+class AsyncUploaderTestCase(ScriptedServerMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "a.jpg")
+        with open(self.filename, "wb") as f:
+            f.write(b"jpeg" * 1000)
+
+    def run_uploader(self, method, *args):
+        async def run():
+            async with async_upload.AsyncUploader(retries=2, backoff=0.01) as uploader:
+                return await getattr(uploader, method)(*args)
+
+        return asyncio.run(run())
+
+    def test_upload_streamed_and_retried(self):
+        self.server.script = [(503, {"Retry-After": "0"}), (201, {}, b'{"id": 1}')]
+        status, text = self.run_uploader(
+            "upload", self.url, self.filename, {"keywords": ["a", "b"], "iso": 200}
+        )
+        self.assertEqual((status, text), (201, '{"id": 1}'))
+        self.assertEqual(len(self.server.requests), 2)
+        for body in self.server.bodies:
+            self.assertIn(b"jpeg" * 1000, body)
+            self.assertIn(b'name="iso"\r\n\r\n200', body)
+            self.assertEqual(body.count(b'name="keywords"'), 2)
+
+    def test_last_response_returned_once_retries_used_up(self):
+        self.server.script = [(502, {})] * 3
+        status, _ = self.run_uploader("upload", self.url, self.filename, {})
+        self.assertEqual(status, 502)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_unanswered_upload_not_sent_again(self):
+        self.server.script = [(201, {})] * 2
+        self.server.delay = 0.3
+        with mock.patch.object(async_upload, "upload_timeout", return_value=(5, 0.05)):
+            with self.assertRaises(async_upload.aiohttp.ServerTimeoutError):
+                self.run_uploader("upload", self.url, self.filename, {})
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_known_digests(self):
+        self.server.script = [(200, {}, b'{"known": ["abc"]}'), (403, {})]
+        self.assertEqual(
+            self.run_uploader("known_digests", self.url, "key", ["abc", "def"]),
+            {"abc"},
+        )
+        self.assertEqual(json.loads(self.server.bodies[0]), {"digests": ["abc", "def"]})
+        with self.assertRaises(async_upload.aiohttp.ClientError):
+            self.run_uploader("known_digests", self.url, "key", ["abc"])
+
+    def test_pipeline_keeps_async_uploads_in_flight(self):
+        events = []
+        started = threading.Event()
+
+        async def upload(path):
+            events.append("start")
+            started.set()
+            await asyncio.sleep(0.2)
+            events.append("end")
+
+        runner = async_upload.EventLoopThread(concurrency=4)
+        pipeline = UploadPipeline(
+            functools.partial(runner.call, upload), 1, settle_time=0.01
+        )
+        with self.assertLogs("wagtail_exifimage.bin.pipeline", "INFO") as logs:
+            pipeline.submit(self.filename)
+            self.assertTrue(started.wait(5))
+            # Events for the file while it uploads wait for the upload.
+            pipeline.submit(self.filename)
+            pipeline.submit(self.filename)
+            time.sleep(0.5)
+            pipeline.stop()
+            runner.stop()
+        self.assertEqual(events, ["start", "end", "start", "end"])
+        self.assertRegex(logs.output[0], r"uploaded in 0\.[2-9]")
+
+    def test_event_loop_thread_caps_running_coroutines(self):
+        running = []
+        peak = []
+
+        async def work(number):
+            running.append(number)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(number)
+
+        runner = async_upload.EventLoopThread(concurrency=3)
+        for number in range(10):
+            runner.call(work, number)
+        runner.stop()
+        self.assertEqual((len(peak), max(peak)), (10, 3))
 
 
 class MetadataTransformationValueTestCase(TestCase):
@@ -96,6 +905,41 @@ class MetadataTransformationValueTestCase(TestCase):
         self.assertEqual(transformed_metadata["street"], "Some street")
         self.assertEqual(transformed_metadata["city"], "Some city")
 
+    def test_transform_metadata_with_compiled_rules(self):
+        for source_field, keywords, target_value, target_field in (
+            ("location", "home", "Some place", None),
+            ("location", "home", "Some street", "street"),
+            ("location", "home", "Some city", "city"),
+            ("location", "cabin", "Lofoten", None),
+            ("camera_model", "ilce7m3/b, ILCE7M3", "A7III", None),
+        ):
+            MetadataTransformationValue.objects.create(
+                user=self.user1,
+                source_field=source_field,
+                keywords=keywords,
+                target_value=target_value,
+                target_field=target_field,
+            )
+
+        service = MetadataTransformationService(self.user1)
+        metadata = {"location": "Home", "camera_model": "ILCE7M3", "aperture": 2.8}
+        transformed_metadata = service.transform_metadata(metadata)
+
+        self.assertEqual(metadata["location"], "Home")
+        self.assertEqual(
+            transformed_metadata,
+            {
+                "location": "Some place",
+                "street": "Some street",
+                "city": "Some city",
+                "camera_model": "A7III",
+                "aperture": 2.8,
+            },
+        )
+        self.assertEqual(
+            service.transform_metadata({"location": "office"}), {"location": "office"}
+        )
+
     def test_4(self):
         MetadataDefaultValue.objects.create(
             user=self.user1,
@@ -116,3 +960,1126 @@ class MetadataTransformationValueTestCase(TestCase):
         ).get_default_metadata(metadata)
         print(transformed_metadata)
         self.assertEqual(transformed_metadata.get("creator"), "Thomas Weholt")
+
+
+class RuleCacheTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="photographer")
+        MetadataTransformationValue.objects.create(
+            user=self.user,
+            source_field="camera_model",
+            keywords="ilce7m3",
+            target_value="A7III",
+        )
+        MetadataDefaultValue.objects.create(
+            user=self.user,
+            camera_make="Sony",
+            camera_model="ILCE7M3",
+            target_field="credit",
+            target_value="Thomas Weholt",
+        )
+        self.metadata = {"camera_make": "Sony", "camera_model": "ILCE7M3"}
+
+    def process(self):
+        service = MetadataTransformationService(self.user)
+        return service.transform_metadata(service.get_default_metadata(self.metadata))
+
+    def test_rules_loaded_once_for_many_uploads(self):
+        self.process()
+        with self.assertNumQueries(0):
+            for _ in range(100):
+                metadata = self.process()
+        self.assertEqual(metadata["camera_model"], "A7III")
+        self.assertEqual(metadata["credit"], "Thomas Weholt")
+
+    def test_changes_invalidate_cached_rules(self):
+        self.process()
+        rule = MetadataTransformationValue.objects.get()
+        rule.target_value = "Alpha 7 III"
+        rule.save()
+        self.assertEqual(self.process()["camera_model"], "Alpha 7 III")
+
+        MetadataDefaultValue.objects.all().delete()
+        self.assertNotIn("credit", self.process())
+
+    def test_rules_cached_before_commit_invalidated_on_commit(self):
+        rule = MetadataTransformationValue.objects.get()
+        rules = MetadataTransformationValue.objects.filter(pk=rule.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            rule.target_value = "Alpha 7 III"
+            rule.save()
+            # Another request still reading the committed rows caches them.
+            rules.update(target_value="A7III")
+            self.assertEqual(self.process()["camera_model"], "A7III")
+            rules.update(target_value="Alpha 7 III")
+
+        self.assertEqual(self.process()["camera_model"], "Alpha 7 III")
+
+    def test_setup_matched_on_normalized_camera(self):
+        for i in range(200):
+            MetadataTransformationSetup.objects.create(
+                user=self.user, camera_make="Sony", camera_model=f"ILCE-{i}"
+            )
+        setup = MetadataTransformationSetup.objects.create(
+            user=self.user,
+            camera_make="SONY",
+            camera_model="A7III",
+            copy_caption_abstract_headline_to_title_if_missing=True,
+        )
+        self.assertEqual((setup.camera_make, setup.camera_model), ("sony", "a7iii"))
+
+        service = MetadataTransformationService(self.user)
+        self.assertEqual(service.setup_for_image("Sony", "a7iii").pk, setup.pk)
+        self.assertIsNone(service.setup_for_image("Canon", "A7III"))
+
+        image = AdvancedIPTCExifImage()
+        with self.assertNumQueries(0):
+            # Found through the camera model the rules rename ILCE7M3 to.
+            service.apply_metadata(image, dict(self.metadata, caption="Beach"))
+        self.assertEqual(image.camera_model, "A7III")
+        self.assertEqual(image.title, "Beach")
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "rules": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "rules",
+            },
+        },
+        EXIF_IMAGE_RULES_CACHE="rules",
+    )
+    def test_rules_shared_through_django_cache(self):
+        self.process()
+        clear_rules_cache()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.process()["camera_model"], "A7III")
+
+        MetadataTransformationValue.objects.update(target_value="Alpha 7 III")
+        MetadataTransformationValue.objects.get().save()
+        clear_rules_cache()
+        self.assertEqual(self.process()["camera_model"], "Alpha 7 III")
+
+
+class KeywordNormalizerTestCase(SimpleTestCase):
+    def test_keywords_trimmed_and_ignored(self):
+        normalize = get_keyword_normalizer("~#", "Darktable, edited")
+        self.assertEqual(
+            normalize([" ~Norway~ ", "LOFOTEN", "dark#table", "Edited", "~"]),
+            ["Norway", "Lofoten", ""],
+        )
+
+    def test_normalizer_shared_between_images(self):
+        self.assertIs(
+            get_keyword_normalizer("~", "Darktable"),
+            get_keyword_normalizer("~", "Darktable"),
+        )
+
+
+class TagResolverTestCase(TestCase):
+    def setUp(self):
+        tag_resolver.clear()
+        self.addCleanup(tag_resolver.clear)
+        self.image = AdvancedIPTCExifImage.objects.create(
+            title="Tagged",
+            file="photo.jpg",
+            width=64,
+            height=48,
+            has_processed_metadata=True,
+        )
+
+    def test_keywords_added_with_fixed_number_of_queries(self):
+        Tag.objects.create(name="norway")
+        keywords = ["Norway", "NORWAY", " Lofoten "] + [
+            f"Keyword {i}" for i in range(40)
+        ]
+        with self.assertNumQueries(4):
+            # Existing tags, bulk insert of new tags, their ids, and the links.
+            add_tags(self.image, keywords)
+
+        self.assertEqual(self.image.tags.count(), 42)
+        self.assertTrue(self.image.tags.filter(name="norway").exists())
+        self.assertFalse(Tag.objects.filter(name="Norway").exists())
+
+    def test_resolved_tag_ids_cached_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            add_tags(self.image, ["Norway", "Lofoten"])
+
+        image = AdvancedIPTCExifImage.objects.create(
+            title="Tagged",
+            file="other.jpg",
+            width=64,
+            height=48,
+            has_processed_metadata=True,
+        )
+        with self.assertNumQueries(1):
+            add_tags(image, ["norway", "Lofoten"])
+        self.assertEqual(sorted(image.tags.names()), ["Lofoten", "Norway"])
+
+        Tag.objects.get(name="Lofoten").delete()
+        with self.assertNumQueries(2):
+            add_tags(image, ["Norway"])
+
+    def test_cached_tag_ids_expire(self):
+        # A tag deleted in another process sends no signal to this one.
+        with self.captureOnCommitCallbacks(execute=True):
+            add_tags(self.image, ["Norway"])
+        self.image.tags.through.objects.all()._raw_delete(Tag.objects.db)
+        Tag.objects.filter(name="Norway")._raw_delete(Tag.objects.db)
+
+        later = time.monotonic() + CACHE_TIMEOUT + 1
+        with mock.patch("wagtail_exifimage.tags.time.monotonic", return_value=later):
+            with self.assertNumQueries(4):
+                add_tags(self.image, ["Norway"])
+        self.assertEqual(list(self.image.tags.names()), ["Norway"])
+
+    def test_slug_collision_falls_back_to_unique_slug(self):
+        Tag.objects.create(name="Norway!", slug="norway")
+        add_tags(self.image, ["Norway"])
+        self.assertEqual(
+            sorted(self.image.tags.values_list("name", "slug")),
+            [("Norway", "norway_1")],
+        )
+
+
+class CollectionPathResolverTestCase(TestCase):
+    def setUp(self):
+        self.root = Collection.get_first_root_node()
+        self.resolver = CollectionPathResolver()
+
+    def test_missing_levels_created_once(self):
+        year = self.root.add_child(name="2023")
+        with self.captureOnCommitCallbacks(execute=True):
+            collection_id = self.resolver.resolve(["2023", "Norway", "Lofoten"])
+
+        lofoten = Collection.objects.get(pk=collection_id)
+        self.assertEqual(
+            [c.name for c in lofoten.get_ancestors()], ["Root", "2023", "Norway"]
+        )
+        self.assertEqual(lofoten.get_parent().get_parent(), year)
+
+        self.resolver.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.resolver.resolve(["2023"])
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.resolver.resolve(["2023", "Norway", "Lofoten"]), collection_id
+            )
+
+    def test_stale_index_never_duplicates_siblings(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.resolver.resolve(["2023"])
+        # Another process creates the same path after this index was loaded.
+        other = CollectionPathResolver()
+        collection_id = other.resolve(["2023", "Norway"])
+
+        self.assertEqual(self.resolver.resolve(["2023", "Norway"]), collection_id)
+        self.assertEqual(Collection.objects.filter(name="Norway").count(), 1)
+        self.assertEqual(Collection.objects.filter(name="2023").count(), 1)
+        Collection.fix_tree()
+        self.assertEqual(Collection.find_problems(), ([], [], [], [], []))
+
+
+class ImageSaveTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.settings_override = override_settings(
+            MEDIA_ROOT=media_root.name,
+            EXIF_IMAGE_METADATA_CACHE=os.path.join(media_root.name, "cache.sqlite3"),
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.user = User.objects.create(username="photographer")
+
+    def create_image(self, data=None):
+        image = AdvancedIPTCExifImage(title="Uploaded", uploaded_by_user=self.user)
+        image.file.save("photo.jpg", ContentFile(data or make_jpeg()), save=False)
+        image.save()
+        return image
+
+    def test_metadata_processed_on_save(self):
+        image = AdvancedIPTCExifImage.objects.get(pk=self.create_image().pk)
+        self.assertTrue(image.has_processed_metadata)
+        self.assertEqual(image.camera_make, "FUJIFILM")
+        self.assertEqual(image.headline, "A headline")
+
+    def test_existing_tags_linked_in_bulk(self):
+        self.create_image()
+        with CaptureQueriesContext(connection) as queries:
+            image = self.create_image()
+        tag_inserts = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith("INSERT")
+            and 'INTO "taggit_' in query["sql"].split("(")[0]
+        ]
+        self.assertEqual(len(tag_inserts), 1)
+        self.assertEqual(
+            sorted(image.tags.names()), ["2023", "Darktable", "Lofoten", "Norway"]
+        )
+
+    def test_identical_bytes_use_metadata_cache(self):
+        data = make_jpeg()
+        self.create_image(data)
+        self.create_image(data)
+        stats = metadata_cache().stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_file_hashed_once_on_save(self):
+        with mock.patch(
+            "wagtail_exifimage.cache.get_file_digest", wraps=get_file_digest
+        ) as cache_digest:
+            image = self.create_image()
+        cache_digest.assert_not_called()
+        self.assertEqual(
+            metadata_cache().get(image.content_digest)["Image Make"], "FUJIFILM"
+        )
+
+
+class UploadTestMixin(JpegFileTestCase):
+    url = "/exif-image/upload/"
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.user = User.objects.create(username="photographer")
+        self.key = ImageUploadAccessKey.get_key("photographer")
+
+    def upload(self, data=None, collections="2023/Norway", **extra):
+        """Posts an image the way the watcher does."""
+        data = data or make_jpeg()
+        post = {
+            key: str(value)
+            for key, value in get_basic_exif_data(self.write_jpeg(data)).items()
+        }
+        post.update(upload_key=self.key, collections=collections, **extra)
+        post["file"] = ContentFile(data, name="photo.jpg")
+        return self.client.post(self.url, post)
+
+
+class UploadTestCase(UploadTestMixin, TestCase):
+    pass
+
+
+class UploadViewTestCase(UploadTestCase):
+    def test_upload_processes_metadata_once(self):
+        opened = []
+        storage_open = FileSystemStorage._open
+
+        def counting_open(storage, name, mode="rb"):
+            opened.append(name)
+            return storage_open(storage, name, mode)
+
+        with mock.patch(
+            "wagtail_exifimage.models.extract_metadata"
+        ) as extract_metadata, mock.patch.object(
+            MetadataTransformationService,
+            "transform_metadata",
+            autospec=True,
+            side_effect=lambda service, metadata: dict(metadata),
+        ) as transform_metadata, mock.patch.object(
+            FileSystemStorage, "_open", counting_open
+        ), CaptureQueriesContext(
+            connection
+        ) as queries:
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 201)
+        extract_metadata.assert_not_called()
+        self.assertEqual(transform_metadata.call_count, 1)
+        # The one remaining open is Django's ImageField reading the dimensions
+        # of the stored file; the metadata is never read back from storage.
+        self.assertEqual(len(opened), 1)
+        image_writes = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith(("INSERT", "UPDATE"))
+            and '"wagtail_exifimage_basicexifimage"' in query["sql"].split("(")[0]
+        ]
+        self.assertEqual(len(image_writes), 1)
+
+        image = AdvancedIPTCExifImage.objects.get()
+        self.assertTrue(image.has_processed_metadata)
+        self.assertEqual(image.uploaded_by_user, self.user)
+        self.assertEqual(image.camera_model, "X-T5")
+        self.assertEqual(image.collection.name, "Norway")
+        self.assertEqual(
+            sorted(image.tags.names()), ["2023", "Darktable", "Lofoten", "Norway"]
+        )
+
+    def test_upload_without_metadata_uses_header_parsed_on_arrival(self):
+        data = make_jpeg()
+        with mock.patch(
+            "wagtail_exifimage.utils.read_basic_exif_data"
+        ) as read_basic_exif_data:
+            response = self.client.post(
+                self.url,
+                {
+                    "upload_key": self.key,
+                    "collections": "2023/Norway",
+                    "file": ContentFile(data, name="photo.jpg"),
+                },
+            )
+
+        self.assertEqual(response.status_code, 201)
+        read_basic_exif_data.assert_not_called()
+        image = AdvancedIPTCExifImage.objects.get()
+        self.assertEqual(image.camera_model, "X-T5")
+        self.assertEqual(
+            sorted(image.tags.names()), ["2023", "Darktable", "Lofoten", "Norway"]
+        )
+
+    def test_upload_of_other_format_without_metadata_reads_file(self):
+        exif = Image.Exif()
+        exif[0x010F] = "FUJIFILM"
+        exif[0x0110] = "X-T5"
+        output = io.BytesIO()
+        Image.new("RGB", (64, 48)).save(output, "PNG", exif=exif)
+        response = self.client.post(
+            self.url,
+            {
+                "upload_key": self.key,
+                "collections": "2023/Norway",
+                "file": ContentFile(output.getvalue(), name="photo.png"),
+            },
+        )
+
+        self.assertEqual(response.status_code, 201)
+        image = AdvancedIPTCExifImage.objects.get()
+        self.assertEqual((image.camera_make, image.camera_model), ("FUJIFILM", "X-T5"))
+
+    def test_upload_stays_within_query_budget(self):
+        many_keywords = make_jpeg(iptc=[(25, f"Keyword {i}") for i in range(20)])
+        # The caches fill once the first uploads commit.
+        self.addCleanup(tag_resolver.clear)
+        self.addCleanup(collection_resolver.clear)
+        self.addCleanup(phash_index.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload(many_keywords)
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(
+            connection
+        ) as queries:
+            response = self.upload(many_keywords)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertLessEqual(len(queries.captured_queries), UPLOAD_QUERY_BUDGET)
+
+
+class MetadataUploadHandlerTestCase(SimpleTestCase):
+    def receive(self, data, chunk_size=1000):
+        handler = MetadataUploadHandler()
+        handler.new_file("file", "photo.jpg", "image/jpeg", len(data))
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start : start + chunk_size]
+            self.assertEqual(handler.receive_data_chunk(chunk, start), chunk)
+        self.assertIsNone(handler.file_complete(len(data)))
+        return handler.completed
+
+    def test_hash_and_header_ready_when_file_is_received(self):
+        data = make_jpeg(size=(1024, 768))
+        [(field_name, upload_metadata)] = self.receive(data)
+
+        self.assertEqual(field_name, "file")
+        self.assertEqual(upload_metadata.sha256, hashlib.sha256(data).hexdigest())
+        self.assertLess(upload_metadata.segments.bytes_read, len(data))
+        self.assertEqual(
+            upload_metadata.get_basic_exif_data(), get_basic_exif_data(io.BytesIO(data))
+        )
+
+    def test_other_formats_left_to_extraction(self):
+        output = io.BytesIO()
+        Image.new("RGB", (64, 48)).save(output, "PNG")
+        [(field_name, upload_metadata)] = self.receive(output.getvalue())
+        self.assertIsNone(upload_metadata.get_basic_exif_data())
+
+
+def make_picture(extent=(-2.0, -1.5, 1.0, 1.5), size=(256, 192)):
+    """Returns a detailed RGB picture, a different one for every extent."""
+    return Image.effect_mandelbrot(size, extent, 64).convert("RGB")
+
+
+class PerceptualHashTestCase(SimpleTestCase):
+    def phash(self, picture, size=None, quality=90):
+        if size:
+            picture = picture.resize(size)
+        output = io.BytesIO()
+        picture.save(output, "JPEG", quality=quality)
+        return perceptual_hash(output)
+
+    def test_scaled_and_recompressed_copies_are_near(self):
+        picture = make_picture()
+        original = self.phash(picture)
+        self.assertLessEqual(
+            hamming_distance(original, self.phash(picture, (128, 96), quality=40)),
+            DEFAULT_MAX_DISTANCE,
+        )
+        other = self.phash(make_picture((-0.8, -0.2, -0.4, 0.2)))
+        self.assertGreater(hamming_distance(original, other), 16)
+
+    def test_signed_storage_round_trips(self):
+        for value in (0, 1, 2**63 - 1, 2**63, 2**64 - 1):
+            signed = to_signed(value)
+            self.assertTrue(-(2**63) <= signed < 2**63)
+            self.assertEqual(to_unsigned(signed), value)
+
+    def test_multi_index_search_matches_linear_scan(self):
+        random = Random(18)
+        values = [random.getrandbits(64) for _ in range(2000)]
+        # Some near copies, as a photo archive has.
+        values += [value ^ (1 << random.randrange(64)) for value in values[:200]]
+        index = MultiIndexHash()
+        for item, value in enumerate(values):
+            index.add(value, item)
+        index.remove(values[0], 0)
+
+        for query in values[:50] + [random.getrandbits(64) for _ in range(50)]:
+            expected = sorted(
+                (hamming_distance(query, value), item)
+                for item, value in enumerate(values)
+                if item and hamming_distance(query, value) <= 6
+            )
+            self.assertEqual(sorted(index.search(query, 6)), expected)
+
+
+class DuplicateUploadTestCase(UploadTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(tag_resolver.clear)
+        self.addCleanup(collection_resolver.clear)
+        self.addCleanup(phash_index.clear)
+
+    def upload_picture(self, picture, **extra):
+        return self.upload(make_jpeg(picture=picture), **extra)
+
+    def test_hashes_stored_without_policy(self):
+        data = make_jpeg(picture=make_picture())
+        self.assertEqual(self.upload(data).status_code, 201)
+        self.assertEqual(self.upload(data).status_code, 201)
+        digests = AdvancedIPTCExifImage.objects.values_list("content_digest", flat=True)
+        self.assertEqual(list(digests), [hashlib.sha256(data).hexdigest()] * 2)
+
+    def test_stored_images_hashed_by_command(self):
+        data = make_jpeg(picture=make_picture())
+        self.upload(data)
+        image = AdvancedIPTCExifImage.objects.get()
+        AdvancedIPTCExifImage.objects.update(content_digest=None, perceptual_hash=None)
+
+        call_command("index_image_hashes")
+
+        hashed = AdvancedIPTCExifImage.objects.get()
+        self.assertEqual(hashed.content_digest, hashlib.sha256(data).hexdigest())
+        self.assertEqual(hashed.perceptual_hash, image.perceptual_hash)
+
+    @override_settings(EXIF_IMAGE_DUPLICATES="reject")
+    def test_exact_and_near_duplicates_rejected(self):
+        picture = make_picture()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.upload_picture(picture).status_code, 201)
+        image = AdvancedIPTCExifImage.objects.get()
+
+        with mock.patch.object(
+            MetadataTransformationService, "process_image"
+        ) as process_image:
+            exact = self.upload_picture(picture)
+            near = self.upload_picture(picture.resize((128, 96)))
+
+        process_image.assert_not_called()
+        self.assertEqual(exact.status_code, 409)
+        self.assertEqual(exact.json()["duplicate_of"], image.pk)
+        self.assertEqual(exact.json()["distance"], 0)
+        self.assertEqual(near.status_code, 409)
+        self.assertEqual(near.json()["duplicate_of"], image.pk)
+
+        other = self.upload_picture(make_picture((-0.8, -0.2, -0.4, 0.2)))
+        self.assertEqual(other.status_code, 201)
+        self.assertEqual(AdvancedIPTCExifImage.objects.count(), 2)
+
+    @override_settings(EXIF_IMAGE_DUPLICATES="reject")
+    def test_duplicates_only_among_own_images(self):
+        picture = make_picture()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload_picture(picture)
+
+        User.objects.create(username="editor")
+        self.key = ImageUploadAccessKey.get_key("editor")
+        with self.captureOnCommitCallbacks(execute=True):
+            exact = self.upload_picture(picture)
+        near = self.upload_picture(picture.resize((128, 96)))
+
+        self.assertEqual(exact.status_code, 201)
+        self.assertEqual(near.status_code, 409)
+        self.assertEqual(
+            near.json()["duplicate_of"],
+            AdvancedIPTCExifImage.objects.get(uploaded_by_user__username="editor").pk,
+        )
+
+    def test_hash_index_loaded_once_per_transaction(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload_picture(make_picture())
+        value = to_unsigned(AdvancedIPTCExifImage.objects.get().perceptual_hash)
+
+        def search():
+            self.assertTrue(phash_index.search(self.user.pk, value, 0))
+
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(
+            connection
+        ) as queries:
+            with transaction.atomic():
+                search()
+                search()
+            search()
+        loads = [q for q in queries if "perceptual_hash" in q["sql"]]
+        self.assertEqual(len(loads), 1)
+
+    @override_settings(EXIF_IMAGE_DUPLICATES="link")
+    def test_duplicate_linked_to_stored_image(self):
+        picture = make_picture()
+        self.upload_picture(picture)
+        response = self.upload_picture(picture)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["duplicate_of"], AdvancedIPTCExifImage.objects.get().pk
+        )
+
+
+class BatchUploadTestCase(UploadTestCase):
+    url = "/exif-image/batch-upload/"
+
+    def metadata(self, data):
+        return {
+            key: str(value)
+            for key, value in get_basic_exif_data(self.write_jpeg(data)).items()
+        }
+
+    def test_manifest_uploads_each_file_with_its_metadata(self):
+        first, second = make_jpeg(), make_jpeg(model="X-H2")
+        manifest = "\n".join(
+            json.dumps(entry)
+            for entry in [
+                {"file": "a", **self.metadata(first)},
+                {"file": "b", "collections": "2022/Lofoten", **self.metadata(second)},
+                {"file": "missing"},
+            ]
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                self.url,
+                {
+                    "upload_key": self.key,
+                    "collections": "2023/Norway",
+                    "manifest": ContentFile(manifest.encode(), name="manifest.ndjson"),
+                    "a": ContentFile(first, name="a.jpg"),
+                    "b": ContentFile(second, name="b.jpg"),
+                },
+            )
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertFalse(response.json()["succes"])
+        self.assertEqual(
+            [(result["file"], result["succes"]) for result in results],
+            [("a", True), ("b", True), ("missing", False)],
+        )
+        first_image = AdvancedIPTCExifImage.objects.get(pk=results[0]["image"])
+        second_image = AdvancedIPTCExifImage.objects.get(pk=results[1]["image"])
+        self.assertEqual(first_image.collection.name, "Norway")
+        self.assertEqual(second_image.collection.name, "Lofoten")
+        self.assertEqual(second_image.camera_model, "X-H2")
+        key_lookups = [
+            query
+            for query in queries.captured_queries
+            if '"wagtail_exifimage_imageuploadaccesskey"' in query["sql"]
+        ]
+        self.assertEqual(len(key_lookups), 1)
+
+    def test_failing_file_leaves_the_rest_of_the_batch(self):
+        upload_image = MetadataTransformationService.upload_image
+
+        def failing_upload(service, data, files):
+            if files["file"].name == "b.jpg":
+                raise OSError("Disk full")
+            return upload_image(service, data, files)
+
+        with mock.patch.object(
+            MetadataTransformationService,
+            "upload_image",
+            autospec=True,
+            side_effect=failing_upload,
+        ), self.assertLogs("wagtail_exifimage.services", "ERROR"):
+            response = self.client.post(
+                self.url,
+                {
+                    "upload_key": self.key,
+                    "collections": "2023/Norway",
+                    "a": ContentFile(make_jpeg(), name="a.jpg"),
+                    "b": ContentFile(make_jpeg(), name="b.jpg"),
+                },
+            )
+
+        results = response.json()["results"]
+        self.assertEqual(
+            [(result["file"], result["succes"]) for result in results],
+            [("a", True), ("b", False)],
+        )
+        self.assertEqual(results[1]["reason"], "Processing failed")
+        self.assertEqual(AdvancedIPTCExifImage.objects.get().pk, results[0]["image"])
+
+    def test_files_sharing_a_field_name_all_uploaded(self):
+        response = self.client.post(
+            self.url,
+            {
+                "upload_key": self.key,
+                "collections": "2023/Norway",
+                "file": [
+                    ContentFile(make_jpeg(model=f"X-T{i}"), name=f"{i}.jpg")
+                    for i in range(3)
+                ],
+            },
+        )
+
+        self.assertTrue(response.json()["succes"])
+        results = response.json()["results"]
+        self.assertEqual([result["file"] for result in results], ["file"] * 3)
+        self.assertEqual(
+            sorted(
+                AdvancedIPTCExifImage.objects.values_list("camera_model", flat=True)
+            ),
+            ["X-T0", "X-T1", "X-T2"],
+        )
+
+    def test_invalid_manifest_rejected(self):
+        response = self.client.post(
+            self.url,
+            {
+                "upload_key": self.key,
+                "manifest": "{not json",
+                "a": ContentFile(make_jpeg(), name="a.jpg"),
+            },
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(AdvancedIPTCExifImage.objects.exists())
+
+
+class TestClientSession:
+    """Sends the requests of the watcher's upload client to the test client."""
+
+    def __init__(self, client):
+        self.client = client
+        self.put_hooks = []
+
+    def post(self, url, data=None, json=None, headers=None, timeout=None):
+        if json is not None:
+            return self.client.post(
+                urlsplit(url).path,
+                json,
+                content_type="application/json",
+                headers=headers,
+            )
+        return self.client.post(urlsplit(url).path, data, headers=headers)
+
+    def get(self, url, headers=None, timeout=None):
+        return self.client.get(urlsplit(url).path, headers=headers)
+
+    def head(self, url, headers=None, timeout=None):
+        return self.client.head(urlsplit(url).path, headers=headers)
+
+    def put(self, url, data=None, headers=None, timeout=None):
+        if self.put_hooks:
+            data = self.put_hooks.pop(0)(data)
+        return self.client.put(
+            urlsplit(url).path,
+            data,
+            content_type="application/octet-stream",
+            headers=headers,
+        )
+
+
+class ChunkedUploadTestCase(UploadTestCase):
+    url = "http://testserver/exif-image/chunked-upload/"
+
+    def setUp(self):
+        super().setUp()
+        self.session = TestClientSession(self.client)
+        self.data = make_jpeg(size=(1024, 768))
+        self.filename = self.write_jpeg(self.data)
+        self.metadata = {
+            key: str(value) for key, value in get_basic_exif_data(self.filename).items()
+        }
+        self.metadata.update(upload_key=self.key, collections="2023/Norway")
+
+    def start(self):
+        response = self.client.post(
+            self.url,
+            {"upload_key": self.key, "filename": "photo.jpg", "size": len(self.data)},
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()["url"]
+
+    def test_upload_resumes_after_interrupted_chunk(self):
+        def interrupted(data):
+            # Half the chunk reaches the server before the connection drops.
+            self.client.put(
+                upload_url,
+                data[: len(data) // 2],
+                content_type="application/octet-stream",
+                headers={"X-Upload-Key": self.key, "X-Upload-Offset": "4096"},
+            )
+            raise requests.ConnectionError("Connection reset")
+
+        upload_url = None
+        start_upload = chunked_uploads.start_upload
+
+        def remember_url(*args):
+            nonlocal upload_url
+            upload = start_upload(*args)
+            upload_url = f"/exif-image/chunked-upload/{upload.pk}/"
+            return upload
+
+        self.session.put_hooks = [lambda data: data, interrupted]
+        with mock.patch.object(
+            chunked_uploads, "start_upload", side_effect=remember_url
+        ), self.assertLogs(level="WARNING"):
+            response = upload_in_chunks(
+                self.session, self.url, self.filename, self.metadata, chunk_size=4096
+            )
+
+        self.assertEqual(response.status_code, 201)
+        image = AdvancedIPTCExifImage.objects.get()
+        self.assertEqual(image.camera_model, "X-T5")
+        self.assertEqual(image.collection.name, "Norway")
+        with image.file.open("rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertEqual(os.listdir(chunked_uploads.upload_dir()), [])
+
+    def test_abandoned_uploads_expired_by_command(self):
+        abandoned = self.start().rstrip("/").rsplit("/", 1)[1]
+        active = self.start().rstrip("/").rsplit("/", 1)[1]
+        ChunkedUpload.objects.filter(pk=abandoned).update(
+            updated_at=timezone.now() - timedelta(hours=2)
+        )
+
+        call_command("expire_chunked_uploads", "--ttl", "3600")
+
+        self.assertEqual(
+            [str(pk) for pk in ChunkedUpload.objects.values_list("pk", flat=True)],
+            [active],
+        )
+        self.assertEqual(os.listdir(chunked_uploads.upload_dir()), [f"{active}.part"])
+
+    def test_resumes_counted_per_chunk(self):
+        def flaky(data):
+            raise requests.ConnectionError("Connection reset")
+
+        # Every other chunk fails once, more often than max_resumes in all.
+        self.session.put_hooks = [flaky, lambda data: data] * 8
+        with self.assertLogs(level="WARNING"):
+            response = upload_in_chunks(
+                self.session,
+                self.url,
+                self.filename,
+                self.metadata,
+                chunk_size=len(self.data) // 4 + 1,
+                max_resumes=1,
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ChunkedUpload.objects.count(), 0)
+        self.assertEqual(AdvancedIPTCExifImage.objects.get().camera_model, "X-T5")
+
+    def test_upload_resumed_after_restart(self):
+        chunk_size = len(self.data) // 4 + 1
+        started = []
+
+        def stop(data):
+            raise KeyboardInterrupt
+
+        self.session.put_hooks = [lambda data: data, stop]
+        with self.assertRaises(KeyboardInterrupt):
+            upload_in_chunks(
+                self.session,
+                self.url,
+                self.filename,
+                self.metadata,
+                chunk_size=chunk_size,
+                on_start=started.append,
+            )
+        [upload_url] = started
+        self.assertEqual(ChunkedUpload.objects.get().offset, chunk_size)
+
+        sent = []
+        self.session.put_hooks = [lambda data: sent.append(data) or data] * 4
+        response = upload_in_chunks(
+            self.session,
+            self.url,
+            self.filename,
+            self.metadata,
+            chunk_size=chunk_size,
+            upload_url=upload_url,
+            on_start=started.append,
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(b"".join(sent), self.data[chunk_size:])
+        self.assertEqual(started, [upload_url])
+        with AdvancedIPTCExifImage.objects.get().file.open("rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_expired_upload_started_over(self):
+        upload_url = self.start()
+        chunked_uploads.expire_uploads(ttl=-1)
+        started = []
+
+        response = upload_in_chunks(
+            self.session,
+            self.url,
+            self.filename,
+            self.metadata,
+            upload_url=f"http://testserver{upload_url}",
+            on_start=started.append,
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(started), 1)
+        self.assertNotIn(upload_url, started[0])
+
+    def test_chunk_at_wrong_offset_refused(self):
+        upload_url = self.start()
+        response = self.client.put(
+            upload_url,
+            self.data[:100],
+            content_type="application/octet-stream",
+            headers={"X-Upload-Key": self.key, "X-Upload-Offset": "100"},
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 0)
+
+    def test_digest_checked_after_running_hash_is_rebuilt(self):
+        upload_url = self.start()
+        for offset in range(0, len(self.data), 8192):
+            self.client.put(
+                upload_url,
+                self.data[offset : offset + 8192],
+                content_type="application/octet-stream",
+                headers={"X-Upload-Key": self.key, "X-Upload-Offset": str(offset)},
+            )
+        # As if the upload was completed through another process.
+        chunked_uploads._hashers.clear()
+
+        response = self.client.post(
+            f"{upload_url}complete/",
+            {"sha256": hashlib.sha256(b"something else").hexdigest()},
+            headers={"X-Upload-Key": self.key},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["reason"], "Digest mismatch")
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(AdvancedIPTCExifImage.objects.exists())
+
+
+class KnownDigestsTestCase(UploadTestCase):
+    known_digests_url = "http://testserver/exif-image/known-digests/"
+
+    def test_known_digests_found_in_batches(self):
+        data = make_jpeg()
+        self.assertEqual(self.upload(data).status_code, 201)
+        digest = hashlib.sha256(data).hexdigest()
+        unknown = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(5)]
+
+        with CaptureQueriesContext(connection) as queries:
+            known = find_known_digests(
+                TestClientSession(self.client),
+                self.known_digests_url,
+                self.key,
+                unknown + [digest.upper()],
+                batch_size=4,
+            )
+
+        self.assertEqual(known, {digest})
+        # One key lookup and one digest lookup per batch.
+        self.assertEqual(len(queries.captured_queries), 4)
+
+    def test_other_users_images_not_known(self):
+        data = make_jpeg()
+        self.assertEqual(self.upload(data).status_code, 201)
+        User.objects.create(username="assistant")
+        known = find_known_digests(
+            TestClientSession(self.client),
+            self.known_digests_url,
+            ImageUploadAccessKey.get_key("assistant"),
+            [hashlib.sha256(data).hexdigest()],
+        )
+        self.assertEqual(known, set())
+
+    def test_unknown_key_refused(self):
+        with self.assertRaises(requests.HTTPError):
+            find_known_digests(
+                TestClientSession(self.client), self.known_digests_url, "nope", ["a"]
+            )
+
+    @override_settings(EXIF_IMAGE_KNOWN_DIGESTS_LIMIT=2)
+    def test_too_many_digests_refused(self):
+        response = self.client.post(
+            self.known_digests_url,
+            {"digests": ["a", "b", "c"]},
+            content_type="application/json",
+            headers={"X-Upload-Key": self.key},
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncUploadViewTestCase(UploadTestMixin, TransactionTestCase):
+    url = "/exif-image/async-upload/"
+
+    def setUp(self):
+        # The upload runs in executor threads with their own connections, so
+        # the data is committed and the tables are flushed between tests.
+        if not Collection.objects.exists():
+            Collection.add_root(name="Root")
+        super().setUp()
+        self.addCleanup(clear_rules_cache)
+        self.addCleanup(tag_resolver.clear)
+        self.addCleanup(collection_resolver.clear)
+        self.executor = ThreadPoolExecutor(2)
+        self.addCleanup(self.executor.shutdown)
+
+    def limits(self, slots):
+        return mock.patch(
+            "wagtail_exifimage.views.upload_limits",
+            return_value=(threading.BoundedSemaphore(slots), self.executor),
+        )
+
+    def test_upload_processed_in_executor(self):
+        with self.limits(1) as upload_limits:
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 201)
+        admission = upload_limits.return_value[0]
+        # The slot has been given back.
+        self.assertTrue(admission.acquire(blocking=False))
+        image = AdvancedIPTCExifImage.objects.get()
+        self.assertEqual(image.uploaded_by_user, self.user)
+        self.assertEqual(image.collection.name, "Norway")
+
+    def test_invalid_key_rejected(self):
+        with self.limits(1):
+            self.key = "nope"
+            response = self.upload()
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(EXIF_IMAGE_ASYNC_RETRY_AFTER=5)
+    def test_upload_over_admission_limit_rejected(self):
+        with self.limits(1) as upload_limits:
+            upload_limits.return_value[0].acquire()
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertFalse(AdvancedIPTCExifImage.objects.exists())
+
+
+@override_settings(EXIF_IMAGE_JOB_QUEUE=True, EXIF_IMAGE_JOB_MAX_ATTEMPTS=2)
+class MetadataJobTestCase(UploadTestCase):
+    def job_status(self, job_id, key=None):
+        return self.client.get(
+            f"/exif-image/jobs/{job_id}/", {"upload_key": key or self.key}
+        )
+
+    def test_upload_queued_and_processed_by_worker(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job"]
+        self.assertEqual(response.json()["status_url"], f"/exif-image/jobs/{job_id}/")
+        self.assertFalse(AdvancedIPTCExifImage.objects.exists())
+        self.assertEqual(self.job_status(job_id).json()["status"], "pending")
+
+        work(once=True)
+
+        status = self.job_status(job_id).json()
+        self.assertEqual((status["status"], status["attempts"]), ("done", 1))
+        image = AdvancedIPTCExifImage.objects.get(pk=status["image"])
+        self.assertEqual(image.uploaded_by_user, self.user)
+        self.assertEqual(image.collection.name, "Norway")
+        self.assertEqual(
+            sorted(image.tags.names()), ["2023", "Darktable", "Lofoten", "Norway"]
+        )
+        self.assertFalse(MetadataJob.objects.get().file)
+
+    def test_queued_upload_without_metadata_extracted_by_worker(self):
+        response = self.client.post(
+            self.url,
+            {
+                "upload_key": self.key,
+                "collections": "2023/Norway",
+                "file": ContentFile(make_jpeg(), name="photo.jpg"),
+            },
+        )
+        self.assertEqual(response.status_code, 202)
+
+        work(once=True)
+
+        image = AdvancedIPTCExifImage.objects.get()
+        self.assertEqual((image.camera_make, image.camera_model), ("FUJIFILM", "X-T5"))
+        self.assertEqual(
+            sorted(image.tags.names()), ["2023", "Darktable", "Lofoten", "Norway"]
+        )
+
+    def test_worker_closes_old_connections_around_jobs(self):
+        self.upload()
+        with mock.patch(
+            "wagtail_exifimage.jobs.close_old_connections"
+        ) as close_old_connections, mock.patch(
+            "wagtail_exifimage.jobs.run_job",
+            side_effect=lambda job: close_old_connections.assert_called_once(),
+        ):
+            work(once=True)
+        # Before claiming the job, after running it and before finding the
+        # queue empty.
+        self.assertEqual(close_old_connections.call_count, 3)
+
+    def test_status_only_visible_to_owner(self):
+        job_id = self.upload().json()["job"]
+        User.objects.create(username="other")
+        self.assertEqual(
+            self.job_status(job_id, ImageUploadAccessKey.get_key("other")).status_code,
+            404,
+        )
+        self.assertEqual(self.job_status(job_id, "wrong").status_code, 401)
+
+    def test_failing_job_retried_then_failed(self):
+        job_id = self.upload().json()["job"]
+        with mock.patch.object(
+            MetadataTransformationService, "process_image", side_effect=OSError("disk")
+        ), self.assertLogs("wagtail_exifimage.jobs", "ERROR"):
+            self.assertEqual(claim_job().pk, job_id)
+            run_job(MetadataJob.objects.get(pk=job_id))
+            job = MetadataJob.objects.get(pk=job_id)
+            self.assertEqual((job.status, job.error), ("pending", "OSError: disk"))
+            self.assertGreater(job.available_at, timezone.now())
+            self.assertIsNone(claim_job())
+
+            MetadataJob.objects.update(available_at=timezone.now())
+            run_job(claim_job())
+
+        job = MetadataJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts), ("failed", 2))
+
+    def test_job_reclaimed_after_visibility_timeout(self):
+        job_id = self.upload().json()["job"]
+        self.assertEqual(claim_job().pk, job_id)
+        self.assertIsNone(claim_job())
+
+        # The worker died; once the timeout passes another one takes over.
+        MetadataJob.objects.update(available_at=timezone.now())
+        self.assertEqual(claim_job().attempts, 2)
+
+        MetadataJob.objects.update(available_at=timezone.now())
+        self.assertIsNone(claim_job())
+        self.assertEqual(MetadataJob.objects.get().status, "failed")
@@ -0,0 +1,96 @@
+import hashlib
+from typing import Optional
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .jpeg import JpegHeaderParser
+from .utils import decode_header_segments
+
+
+class UploadMetadata:
+    """
+    The SHA-256 and JPEG header segments of an uploaded file, gathered while
+    it was received.
+    """
+
+    def __init__(self, sha256: str, segments):
+        self.sha256 = sha256
+        self.segments = segments
+        self._metadata = None
+
+    def get_basic_exif_data(self, filename=None) -> Optional[dict]:
+        """
+        Returns the metadata decoded from the header segments, or None for a
+        file that is not a JPEG and has to be read to get its metadata.
+        """
+        if not self.segments.is_jpeg:
+            return
+        if self._metadata is None:
+            self._metadata = decode_header_segments(self.segments)
+        return dict(self._metadata)
+
+
+class MetadataUploadHandler(FileUploadHandler):
+    """
+    Hashes uploaded files and parses their JPEG header as the chunks arrive,
+    then hands the chunks on to the handlers storing the file. Install it in
+    front of them, before the request body is read:
+
+        request.upload_handlers.insert(0, MetadataUploadHandler(request))
+
+    and call attach with request.FILES once the files have been parsed.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.completed = []
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+        self.parser = JpegHeaderParser()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        if not self.parser.done:
+            self.parser.feed(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.completed.append(
+            (
+                self.field_name,
+                UploadMetadata(self.hasher.hexdigest(), self.parser.close()),
+            )
+        )
+        # Leave the file to the next handler.
+        return None
+
+    def attach(self, files):
+        """
+        Sets upload_metadata on the files parsed from the request.
+        """
+        uploaded = {}
+        for field_name, metadata in self.completed:
+            uploaded.setdefault(field_name, []).append(metadata)
+        for field_name, file_list in files.lists():
+            for file, metadata in zip(file_list, uploaded.get(field_name, [])):
+                file.upload_metadata = metadata
+
+
+def install_metadata_handler(request) -> MetadataUploadHandler:
+    handler = MetadataUploadHandler(request)
+    request.upload_handlers.insert(0, handler)
+    return handler
+
+
+def get_upload_metadata(file) -> Optional[UploadMetadata]:
+    """
+    Returns the metadata gathered while a file was uploaded, given the
+    uploaded file or a field file still holding it.
+    """
+    while file is not None:
+        metadata = getattr(file, "upload_metadata", None)
+        if metadata is not None:
+            return metadata
+        file = getattr(file, "_file", None)
@@ -4,4 +4,23 @@ from . import views
 
 urlpatterns = [
     path("exif-image/upload/", views.upload_exif_image),
+    path("exif-image/async-upload/", views.upload_exif_image_async),
+    path("exif-image/batch-upload/", views.batch_upload_exif_images),
+    path(
+        "exif-image/jobs/<int:job_id>/",
+        views.metadata_job_status,
+        name="exif_image_job_status",
+    ),
+    path("exif-image/known-digests/", views.known_digests),
+    path("exif-image/chunked-upload/", views.start_chunked_upload),
+    path(
+        "exif-image/chunked-upload/<uuid:upload_id>/",
+        views.chunked_upload,
+        name="exif_image_chunked_upload",
+    ),
+    path(
+        "exif-image/chunked-upload/<uuid:upload_id>/complete/",
+        views.complete_chunked_upload,
+        name="exif_image_chunked_upload_complete",
+    ),
 ]
@@ -1,80 +1,163 @@
+import io
 from datetime import datetime
 
 import exifread
 from iptcinfo3 import IPTCInfo, c_datasets
 
+from .exif import decode_exif
+from .jpeg import APP1, APP13, EMPTY_JPEG, read_header_segments, wrap_segment
 
-def get_basic_exif_data(filename):
-    """ """
-    # 'EXIF DateTimeOriginal',
-    target_tags = [
-        "Image Make",
-        "Image Model",
-        "EXIF ExposureTime",
-        "Image Orientation",
-        "Image XResolution",
-        "Image YResolution",
-        "Image ResolutionUnit",
-        "EXIF FNumber",
-        "EXIF ExposureProgram",
-        "EXIF ISOSpeedRatings",
-        "EXIF ExifVersion",
-        "EXIF ShutterSpeedValue",
-        "EXIF ApertureValue",
-        "EXIF BrightnessValue",
-        "EXIF ExposureBiasValue",
-        "EXIF SubjectDistance",
-        "EXIF MeteringMode",
-        "EXIF LightSource",
-        "EXIF Flash",
-        "EXIF FocalLength",
-        "EXIF ColorSpace",
-        "EXIF Owner",
-        "Image Artist",
-        "Image Software",
-        "Image Copyright",
-        "EXIF BodySerialNumber",
-        "EXIF LensSpecification",
-        "EXIF LensMake",
-        "EXIF LensModel",
-        "EXIF LensSerialNumber",
-    ]
+# Bump whenever the output of get_basic_exif_data changes, so cached
+# metadata from older versions is never used.
+PARSER_VERSION = 1
+
+TARGET_TAGS = [
+    "Image Make",
+    "Image Model",
+    "EXIF ExposureTime",
+    "Image Orientation",
+    "Image XResolution",
+    "Image YResolution",
+    "Image ResolutionUnit",
+    "EXIF FNumber",
+    "EXIF ExposureProgram",
+    "EXIF ISOSpeedRatings",
+    "EXIF ExifVersion",
+    "EXIF ShutterSpeedValue",
+    "EXIF ApertureValue",
+    "EXIF BrightnessValue",
+    "EXIF ExposureBiasValue",
+    "EXIF SubjectDistance",
+    "EXIF MeteringMode",
+    "EXIF LightSource",
+    "EXIF Flash",
+    "EXIF FocalLength",
+    "EXIF ColorSpace",
+    "EXIF Owner",
+    "Image Artist",
+    "Image Software",
+    "Image Copyright",
+    "EXIF BodySerialNumber",
+    "EXIF LensSpecification",
+    "EXIF LensMake",
+    "EXIF LensModel",
+    "EXIF LensSerialNumber",
+    "GPS GPSLatitudeRef",
+    "GPS GPSLatitude",
+    "GPS GPSLongitudeRef",
+    "GPS GPSLongitude",
+    "GPS GPSAltitudeRef",
+    "GPS GPSAltitude",
+]
+
+# Everything get_exif_tags looks at, the only tags decoded in fast mode.
+FAST_TAGS = TARGET_TAGS + ["EXIF DateTimeOriginal"]
+
+
+def get_basic_exif_data(filename, fast=True):
+    """
+    Extracts EXIF and IPTC metadata from an image file, given either its path
+    or a binary file object.
+
+    JPEG files are read once, up to the start of the image data, and the
+    EXIF (APP1) and IPTC (APP13) segments are handed to the tag decoders.
+    Other formats are handed to exifread and a blind IPTC scan on the same
+    file handle.
+
+    In fast mode only the tags in FAST_TAGS are decoded; MakerNotes and
+    thumbnails are skipped. Use fast=False to have exifread decode everything.
+    """
+    if hasattr(filename, "read"):
+        filename.seek(0)
+        try:
+            return read_basic_exif_data(filename, fast)
+        finally:
+            filename.seek(0)
 
-    result = {}
     with open(filename, "rb") as fh:
-        tags = exifread.process_file(fh)
-        for target_tag in target_tags:
-            if target_tag in tags:
-                result[target_tag] = tags[target_tag].printable
+        return read_basic_exif_data(fh, fast)
+
+
+class _KeepOpen:
+    """
+    Proxies a file object, ignoring close() calls from IPTCInfo.
+    """
+
+    def __init__(self, fh):
+        self._fh = fh
+
+    def __getattr__(self, name):
+        return getattr(self._fh, name)
+
+    def close(self):
+        pass
+
+
+def read_basic_exif_data(fh, fast=True):
+    segments = read_header_segments(fh)
+    if segments.is_jpeg:
+        return decode_header_segments(segments, fast, getattr(fh, "name", None))
+
+    fh.seek(0)
+    tags = exifread.process_file(fh, details=not fast, extract_thumbnail=not fast)
+    fh.seek(0)
+    info = IPTCInfo(_KeepOpen(fh))
+
+    result = get_exif_tags(tags, getattr(fh, "name", None))
+    result.update(get_iptc_fields(info))
+    return result
+
+
+def decode_header_segments(segments, fast=True, filename=None):
+    """
+    Returns the metadata held in the header segments of a JPEG file.
+    """
+    tags = {}
+    if segments.exif and fast:
+        tags = decode_exif(segments.exif, FAST_TAGS)
+    elif segments.exif:
+        tags = exifread.process_file(io.BytesIO(wrap_segment(APP1, segments.exif)))
+    info = IPTCInfo(
+        io.BytesIO(segments.iptc and wrap_segment(APP13, segments.iptc) or EMPTY_JPEG)
+    )
+
+    result = get_exif_tags(tags, filename)
+    result.update(get_iptc_fields(info))
+    return result
+
+
+def get_exif_tags(tags, filename=None):
+    result = {}
+    for target_tag in TARGET_TAGS:
+        if target_tag in tags:
+            result[target_tag] = tags[target_tag].printable
+
+    if "EXIF DateTimeOriginal" in tags:
+        try:
+            result["EXIF DateTimeOriginal"] = datetime.strptime(
+                str(tags["EXIF DateTimeOriginal"]), "%Y:%m:%d %H:%M:%S"
+            )
+        except ValueError:
+            print(
+                "error parsing EXIF DateTimeOriginal: %s -> %s"
+                % (filename, str(tags["EXIF DateTimeOriginal"]))
+            )
+    return result
 
-        if "EXIF DateTimeOriginal" in tags:
+
+def get_iptc_fields(info):
+    result = {}
+    for key, value in info._data.items():
+        if key in c_datasets:
+            field = c_datasets[key]
             try:
-                result["EXIF DateTimeOriginal"] = datetime.strptime(
-                    str(tags["EXIF DateTimeOriginal"]), "%Y:%m:%d %H:%M:%S"
-                )
-            except ValueError:
-                print(
-                    "error parsing EXIF DateTimeOriginal: %s -> %s"
-                    % (filename, str(tags["EXIF DateTimeOriginal"]))
-                )
-
-        info = IPTCInfo(filename)
-        if info.__dict__ == "":
-            return result
-
-        for k, v in info.__dict__.items():
-            if k == "_data":
-                for key, value in v.items():
-                    if key in c_datasets:
-                        field = c_datasets[key]
-                        try:
-                            v = value.decode("utf-8")
-                        except:
-                            if isinstance(value, list):
-                                v = ", ".join([p.decode("utf-8") for p in value])
-                            else:
-                                v = str(value)
-                        result[field] = v
+                v = value.decode("utf-8")
+            except:
+                if isinstance(value, list):
+                    v = ", ".join([p.decode("utf-8") for p in value])
+                else:
+                    v = str(value)
+            result[field] = v
     return result
 
 
@@ -86,6 +169,24 @@ def split_and_divide(string_value):
         return
 
 
+def ratio_to_float(string_value):
+    if "/" in string_value:
+        return split_and_divide(string_value)
+    try:
+        return float(string_value)
+    except ValueError:
+        return
+
+
+def gps_to_decimal(value, ref):
+    try:
+        degrees, minutes, seconds = map(ratio_to_float, value.strip("[]").split(","))
+        result = degrees + minutes / 60 + seconds / 3600
+    except (TypeError, ValueError):
+        return
+    return ref in ("S", "W") and -result or result
+
+
 def remap_metadata_to_model_fields(metadata):
     result = {}
     result["date_time_original"] = metadata.get("EXIF DateTimeOriginal", None)
@@ -138,6 +239,19 @@ def remap_metadata_to_model_fields(metadata):
     result["lens_make"] = metadata.get("EXIF LensMake")
     result["story"] = metadata.get("story")
 
+    if metadata.get("GPS GPSLatitude") and metadata.get("GPS GPSLongitude"):
+        result["latitude"] = gps_to_decimal(
+            metadata["GPS GPSLatitude"], metadata.get("GPS GPSLatitudeRef")
+        )
+        result["longitude"] = gps_to_decimal(
+            metadata["GPS GPSLongitude"], metadata.get("GPS GPSLongitudeRef")
+        )
+    altitude = ratio_to_float(metadata.get("GPS GPSAltitude") or "")
+    if altitude is not None:
+        result["altitude"] = int(
+            metadata.get("GPS GPSAltitudeRef") == "1" and -altitude or altitude
+        )
+
     final_result = {}
     for key in result:
         if result[key]:
@@ -1,17 +1,139 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.db import close_old_connections
 from django.http import JsonResponse, QueryDict
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
 
+from . import chunked_uploads
+from .duplicates import DuplicateImage
 from .forms import get_upload_form
-from .models import ImageUploadAccessKey
-from .utils import remap_metadata_to_model_fields
+from .jobs import enqueue_upload, job_queue_enabled, job_status
+from .models import (
+    BasicExifImage,
+    ChunkedUpload,
+    ImageUploadAccessKey,
+    MetadataJob,
+)
 
 UploadForm = get_upload_form()
 
-from .services import MetadataTransformationService
+from .services import DEFAULT_BATCH_SIZE, MetadataTransformationService
+from .upload_handlers import install_metadata_handler
 
 
 @csrf_exempt
 def upload_exif_image(request):
+    metadata_handler = install_metadata_handler(request)
+    upload_key = request.POST.get("upload_key")
+    if not upload_key:
+        return JsonResponse(
+            {"succes": False, "reason": "Missing upload key"}, status=401
+        )
+
+    acces_key = ImageUploadAccessKey.get_user_by_key(upload_key)
+    if not acces_key:
+        return JsonResponse(
+            {"succes": False, "reason": "User has no upload access"}, status=401
+        )
+
+    metadata_handler.attach(request.FILES)
+    return process_upload(acces_key.user, request.POST, request.FILES)
+
+
+def process_upload(user, data, files):
+    if not files:
+        return JsonResponse({"succes": False, "reason": "Missing files"}, status=400)
+
+    if job_queue_enabled():
+        # Leave the processing to the process_metadata_jobs workers.
+        job = enqueue_upload(user, data.dict(), files["file"])
+        return JsonResponse(
+            {
+                "succes": True,
+                "job": job.pk,
+                "status_url": reverse("exif_image_job_status", args=[job.pk]),
+            },
+            status=202,
+        )
+
+    try:
+        with MetadataTransformationService(user) as service:
+            image, errors = service.upload_image(data, files)
+    except DuplicateImage as e:
+        return duplicate_response(e)
+
+    if errors:
+        return JsonResponse(
+            {"succes": False, "reason": "Form errors", "errors": errors},
+            status=400,
+        )
+
+    return JsonResponse({"succes": True}, status=201)
+
+
+def duplicate_response(e: DuplicateImage):
+    if e.linked:
+        return JsonResponse({"succes": True, **e.duplicate.as_dict()}, status=200)
+    return JsonResponse(
+        {"succes": False, "reason": "Duplicate image", **e.duplicate.as_dict()},
+        status=409,
+    )
+
+
+def read_manifest(request):
+    """
+    Returns the (data, files) pair of every file in a batch upload.
+
+    The manifest is NDJSON, posted as a field or a file named manifest, with
+    one object per file naming its part in "file" next to its metadata
+    fields; lines naming a part posted several times take its files in
+    order. Without a manifest every file posted is uploaded, however many
+    share a part name. The other posted fields, like collections, apply to
+    every file unless the manifest overrides them. Raises ValueError for a
+    manifest that is not NDJSON.
+    """
+    shared = request.POST.dict()
+    shared.pop("upload_key", None)
+    manifest = shared.pop("manifest", None)
+    if "manifest" in request.FILES:
+        manifest = request.FILES["manifest"].read().decode()
+
+    if manifest is None:
+        entries = [
+            {"file": name}
+            for name, file_list in request.FILES.lists()
+            for _ in file_list
+        ]
+    else:
+        entries = [json.loads(line) for line in manifest.splitlines() if line.strip()]
+        if not all(isinstance(entry, dict) for entry in entries):
+            raise ValueError("Every manifest line must be an object")
+
+    available = dict(request.FILES.lists())
+    uploads = []
+    for entry in entries:
+        name = str(entry.pop("file", ""))
+        data = {**shared, **{key: str(value) for key, value in entry.items()}}
+        file_list = available.get(name)
+        files = {"file": file_list.pop(0)} if file_list else {}
+        uploads.append((name, data, files))
+    return uploads
+
+
+@csrf_exempt
+def batch_upload_exif_images(request):
+    """
+    Uploads several files in one request, resolving the upload key and the
+    user's rules once, and answers with a result for every file.
+    """
+    metadata_handler = install_metadata_handler(request)
     upload_key = request.POST.get("upload_key")
     if not upload_key:
         return JsonResponse(
@@ -24,26 +146,324 @@ def upload_exif_image(request):
             {"succes": False, "reason": "User has no upload access"}, status=401
         )
 
-    if not request.FILES:
+    metadata_handler.attach(request.FILES)
+    try:
+        uploads = read_manifest(request)
+    except ValueError as e:
+        return JsonResponse(
+            {"succes": False, "reason": "Invalid manifest", "error": str(e)},
+            status=400,
+        )
+    if not uploads:
         return JsonResponse({"succes": False, "reason": "Missing files"}, status=400)
 
-    with MetadataTransformationService(acces_key.user) as service:
-        default_metadata = service.get_default_metadata(
-            remap_metadata_to_model_fields(request.POST)
+    results = [{"file": name, "succes": True} for name, data, files in uploads]
+    pending = []
+    for result, (name, data, files) in zip(results, uploads):
+        if files:
+            pending.append((result, data, files))
+        else:
+            result.update(succes=False, reason="Missing file")
+
+    if job_queue_enabled():
+        for result, data, files in pending:
+            job = enqueue_upload(acces_key.user, data, files["file"])
+            result.update(
+                job=job.pk, status_url=reverse("exif_image_job_status", args=[job.pk])
+            )
+        status = 202
+    else:
+        batch_size = getattr(settings, "EXIF_IMAGE_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+        with MetadataTransformationService(acces_key.user) as service:
+            processed = service.upload_images(
+                [(data, files) for result, data, files in pending], batch_size
+            )
+            for (result, data, files), (image, errors) in zip(pending, processed):
+                if image:
+                    result["image"] = image.pk
+                elif isinstance(errors, DuplicateImage):
+                    if errors.linked:
+                        result["image"] = errors.duplicate.image_id
+                    else:
+                        result.update(succes=False, reason="Duplicate image")
+                    result.update(errors.duplicate.as_dict())
+                elif isinstance(errors, Exception):
+                    result.update(succes=False, reason="Processing failed")
+                else:
+                    result.update(succes=False, reason="Form errors", errors=errors)
+        status = 200
+
+    return JsonResponse(
+        {"succes": all(result["succes"] for result in results), "results": results},
+        status=status,
+    )
+
+
+_admission = None
+_executor = None
+_limits_lock = threading.Lock()
+
+
+def upload_limits():
+    """
+    Returns the semaphore admitting async uploads and the executor running
+    their blocking work, sized by EXIF_IMAGE_ASYNC_UPLOAD_LIMIT and
+    EXIF_IMAGE_ASYNC_UPLOAD_WORKERS.
+    """
+    global _admission, _executor
+    with _limits_lock:
+        if _admission is None:
+            _admission = threading.BoundedSemaphore(
+                getattr(settings, "EXIF_IMAGE_ASYNC_UPLOAD_LIMIT", 32)
+            )
+            _executor = ThreadPoolExecutor(
+                getattr(settings, "EXIF_IMAGE_ASYNC_UPLOAD_WORKERS", 8),
+                thread_name_prefix="exif-image-upload",
+            )
+        return _admission, _executor
+
+
+def process_upload_in_thread(user, request, metadata_handler):
+    close_old_connections()
+    try:
+        metadata_handler.attach(request.FILES)
+        return process_upload(user, request.POST, request.FILES)
+    finally:
+        close_old_connections()
+
+
+async def upload_exif_image_async(request):
+    """
+    The upload endpoint for ASGI deployments. Uploads beyond the admission
+    limit are turned away with 429 and Retry-After rather than queued, and
+    the blocking form and metadata work runs in a bounded thread pool.
+    """
+    admission, executor = upload_limits()
+    if not admission.acquire(blocking=False):
+        response = JsonResponse(
+            {"succes": False, "reason": "Too many uploads"}, status=429
         )
-        metadata = service.transform_metadata(default_metadata)
+        response["Retry-After"] = str(
+            getattr(settings, "EXIF_IMAGE_ASYNC_RETRY_AFTER", 1)
+        )
+        return response
 
-        dict = QueryDict(mutable=True)
-        dict.update(metadata)
-        form = UploadForm(dict, request.FILES)
-        if not form.is_valid():
+    try:
+        metadata_handler = install_metadata_handler(request)
+        data = await sync_to_async(
+            lambda: request.POST, thread_sensitive=False, executor=executor
+        )()
+        upload_key = data.get("upload_key")
+        if not upload_key:
             return JsonResponse(
-                {"succes": False, "reason": "Form errors", "errors": form.errors},
-                status=400,
+                {"succes": False, "reason": "Missing upload key"}, status=401
             )
 
-        image = form.save()
-        metadata["collections"] = request.POST.get("collections").split("/")
-        service.process_image(image, metadata)
+        acces_key = await ImageUploadAccessKey.aget_user_by_key(upload_key)
+        if not acces_key:
+            return JsonResponse(
+                {"succes": False, "reason": "User has no upload access"}, status=401
+            )
 
-    return JsonResponse({"succes": True}, status=201)
+        return await sync_to_async(
+            process_upload_in_thread, thread_sensitive=False, executor=executor
+        )(acces_key.user, request, metadata_handler)
+    finally:
+        admission.release()
+
+
+# csrf_exempt only keeps views async from Django 5.0 on.
+upload_exif_image_async.csrf_exempt = True
+
+
+def metadata_job_status(request, job_id):
+    upload_key = request.GET.get("upload_key") or request.headers.get("X-Upload-Key")
+    if not upload_key:
+        return JsonResponse(
+            {"succes": False, "reason": "Missing upload key"}, status=401
+        )
+
+    acces_key = ImageUploadAccessKey.get_user_by_key(upload_key)
+    if not acces_key:
+        return JsonResponse(
+            {"succes": False, "reason": "User has no upload access"}, status=401
+        )
+
+    job = MetadataJob.objects.filter(pk=job_id, user=acces_key.user).first()
+    if not job:
+        return JsonResponse({"succes": False, "reason": "Unknown job"}, status=404)
+
+    return JsonResponse({"succes": True, **job_status(job)})
+
+
+def get_access_key(request):
+    """
+    Returns the access key named by the upload_key field or the X-Upload-Key
+    header, and None, or None and the response refusing the request.
+    """
+    upload_key = request.POST.get("upload_key") or request.headers.get("X-Upload-Key")
+    if not upload_key:
+        return None, JsonResponse(
+            {"succes": False, "reason": "Missing upload key"}, status=401
+        )
+
+    acces_key = ImageUploadAccessKey.get_user_by_key(upload_key)
+    if not acces_key:
+        return None, JsonResponse(
+            {"succes": False, "reason": "User has no upload access"}, status=401
+        )
+    return acces_key, None
+
+
+@csrf_exempt
+@require_POST
+def known_digests(request):
+    """
+    Answers which of the SHA-256 digests in the JSON body, {"digests": [...]},
+    belong to images the key's user uploaded, so the watcher can skip
+    sending those files. Other users' images are never revealed, and do not
+    keep a user from uploading the same file.
+    """
+    acces_key, error = get_access_key(request)
+    if error:
+        return error
+
+    try:
+        digests = json.loads(request.body)["digests"]
+        digests = {str(digest).lower() for digest in digests}
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse(
+            {"succes": False, "reason": "Expected a list of digests"}, status=400
+        )
+
+    limit = getattr(settings, "EXIF_IMAGE_KNOWN_DIGESTS_LIMIT", 1000)
+    if len(digests) > limit:
+        return JsonResponse(
+            {"succes": False, "reason": f"At most {limit} digests per request"},
+            status=400,
+        )
+
+    known = BasicExifImage.objects.filter(
+        uploaded_by_user_id=acces_key.user_id, content_digest__in=digests
+    ).values_list("content_digest", flat=True)
+    return JsonResponse({"succes": True, "known": sorted(set(known))})
+
+
+def chunked_upload_status(upload: ChunkedUpload, status=200):
+    response = JsonResponse(
+        {
+            "succes": True,
+            "upload": upload.pk,
+            "offset": upload.offset,
+            "size": upload.size,
+            "url": reverse("exif_image_chunked_upload", args=[upload.pk]),
+            "complete_url": reverse(
+                "exif_image_chunked_upload_complete", args=[upload.pk]
+            ),
+        },
+        status=status,
+    )
+    # Also answered to HEAD, which has no body.
+    response["X-Upload-Offset"] = str(upload.offset)
+    return response
+
+
+@csrf_exempt
+@require_POST
+def start_chunked_upload(request):
+    """
+    Starts a chunked upload of the posted filename and size in bytes. The
+    other posted fields are the metadata, as for a regular upload.
+    """
+    acces_key, error = get_access_key(request)
+    if error:
+        return error
+
+    metadata = request.POST.dict()
+    metadata.pop("upload_key", None)
+    filename = metadata.pop("filename", "")
+    try:
+        size = int(metadata.pop("size", ""))
+    except ValueError:
+        size = 0
+    if not filename or not 0 < size <= chunked_uploads.max_size():
+        return JsonResponse(
+            {"succes": False, "reason": "Missing filename or invalid size"},
+            status=400,
+        )
+
+    upload = chunked_uploads.start_upload(acces_key.user, filename, size, metadata)
+    return chunked_upload_status(upload, status=201)
+
+
+@csrf_exempt
+@require_http_methods(["GET", "HEAD", "PUT"])
+def chunked_upload(request, upload_id):
+    """
+    GET and HEAD return the offset to resume an upload from, also in the
+    X-Upload-Offset header. PUT appends the body at the offset in the
+    X-Upload-Offset header, streaming it to disk.
+    """
+    acces_key, error = get_access_key(request)
+    if error:
+        return error
+
+    upload = ChunkedUpload.objects.filter(pk=upload_id, user=acces_key.user).first()
+    if not upload:
+        return JsonResponse({"succes": False, "reason": "Unknown upload"}, status=404)
+
+    if request.method == "PUT":
+        try:
+            offset = int(request.headers.get("X-Upload-Offset", ""))
+            upload = chunked_uploads.append_chunk(upload, offset, request)
+        except ValueError:
+            return JsonResponse(
+                {"succes": False, "reason": "Missing X-Upload-Offset"}, status=400
+            )
+        except chunked_uploads.ChunkOffsetMismatch as e:
+            return JsonResponse(
+                {"succes": False, "reason": "Wrong offset", "offset": e.offset},
+                status=409,
+            )
+        except chunked_uploads.ChunkTooLarge as e:
+            return JsonResponse({"succes": False, "reason": str(e)}, status=413)
+
+    return chunked_upload_status(upload)
+
+
+@csrf_exempt
+@require_POST
+def complete_chunked_upload(request, upload_id):
+    """
+    Checks the posted sha256 of the whole file against the running hash and
+    processes the upload. A file that does not match is discarded.
+    """
+    acces_key, error = get_access_key(request)
+    if error:
+        return error
+
+    upload = ChunkedUpload.objects.filter(pk=upload_id, user=acces_key.user).first()
+    if not upload:
+        return JsonResponse({"succes": False, "reason": "Unknown upload"}, status=404)
+
+    if upload.offset != upload.size:
+        return JsonResponse(
+            {"succes": False, "reason": "Upload incomplete", "offset": upload.offset},
+            status=409,
+        )
+
+    if (
+        chunked_uploads.running_hash(upload).hexdigest()
+        != request.POST.get("sha256", "").lower()
+    ):
+        chunked_uploads.discard_upload(upload)
+        return JsonResponse({"succes": False, "reason": "Digest mismatch"}, status=400)
+
+    data = QueryDict(mutable=True)
+    data.update(upload.metadata)
+    with open(chunked_uploads.part_path(upload), "rb") as f:
+        response = process_upload(
+            acces_key.user, data, {"file": File(f, name=upload.filename)}
+        )
+    chunked_uploads.discard_upload(upload)
+    return response